@@ -10,7 +10,7 @@ __all__ = [
 ]
 
 __pkg_name__ = 'dircifrar'
-__pkg_version__ = '0.0.4'
+__pkg_version__ = '0.0.5'
 __pkg_license__ = 'MIT'
 __pkg_description__ = 'A directory synchronization and encryption tool'
 __pkg_author__ = 'Ching-Tsun Chou'
@@ -20,3 +20,10 @@ __pkg_url__ = 'https://github.com/ctchou/dircifrar'
 __config_filename__ = f'.{__pkg_name__}_config.json'
 __crypt_dirname__ = f'{__pkg_name__}_crypt'
 __crypt_metadir__ = f'{__pkg_name__}_meta'
+__crypt_treedir__ = f'{__pkg_name__}_tree'
+__crypt_packdir__ = f'{__pkg_name__}_pack'
+__crypt_objdir__ = f'{__pkg_name__}_object'
+
+# The format of the files in encrypted directories: 1 for those with only unsealed files,
+# and 2 for those which may also have sealed files.  Directories in a later format are refused.
+__crypt_format__ = 2
@@ -0,0 +1,319 @@
+
+from collections.abc import MutableMapping, MutableSet
+from pathlib import Path
+import stat, marshal, sqlite3, threading
+
+# The default number of bytes of memory used by the pages of a catalog; the rest is kept on disk.
+catalog_budget = 2 ** 28
+# Paths are read from a catalog, and the operations on them are generated, this many at a time.
+catalog_page = 10000
+
+def path_key(path):
+    """ The key of path in a catalog, whose order is the order of the paths """
+    return '\0'.join(path.parts)
+
+def key_path(key):
+    return Path(*key.split('\0')) if key else Path()
+
+def meta_type(meta):
+    mode = meta.get('mode', None)
+    if mode is None:
+        return None
+    if stat.S_ISDIR(mode):
+        return 'DIR'
+    if stat.S_ISREG(mode):
+        return 'FILE'
+    return None
+
+def prune_table(catalog, name, path):
+    """ Remove the contents of the directory path from the table name """
+    if path == Path():
+        catalog.execute(f'DELETE FROM {name}')
+        return
+    key = path_key(path)
+    catalog.execute(f'DELETE FROM {name} WHERE key > ? AND key < ?', (key + '\0', key + '\1'))
+
+class Catalog(object):
+    """ Temporary SQLite store of collected paths and comparison results, kept mostly on disk """
+
+    def __init__(self, budget=None):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect('', isolation_level=None, check_same_thread=False)
+        self.conn.execute(f'PRAGMA cache_size = {-max(1, (budget or catalog_budget) // 1024)}')
+        self.conn.execute('PRAGMA temp_store = FILE')
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        # Nothing is ever committed: the catalog does not outlive its connection.
+        self.conn.execute('BEGIN')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).rowcount
+
+    def executemany(self, sql, rows):
+        with self.lock:
+            self.conn.executemany(sql, rows)
+
+    def fetchone(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def mapping(self, name):
+        """ A new empty CatalogDict stored in the table name """
+        with self.lock:
+            self.conn.execute(f'DROP TABLE IF EXISTS {name}')
+            self.conn.execute(f'CREATE TABLE {name} (key TEXT PRIMARY KEY, depth INTEGER, type TEXT, '
+                              f'mtime INTEGER, ctime INTEGER, size INTEGER, meta BLOB) WITHOUT ROWID')
+            self.conn.execute(f'CREATE INDEX {name}_depth ON {name} (depth, key)')
+        return CatalogDict(self, name)
+
+    def set(self, name):
+        """ A new empty CatalogSet stored in the table name """
+        with self.lock:
+            self.conn.execute(f'DROP TABLE IF EXISTS {name}')
+            self.conn.execute(f'CREATE TABLE {name} (key TEXT PRIMARY KEY, depth INTEGER) WITHOUT ROWID')
+            self.conn.execute(f'CREATE INDEX {name}_depth ON {name} (depth, key)')
+        return CatalogSet(self, name)
+
+    def objects(self, name):
+        """ A new empty CatalogObjects stored in the table name """
+        with self.lock:
+            self.conn.execute(f'DROP TABLE IF EXISTS {name}')
+            self.conn.execute(f'CREATE TABLE {name} (ino INTEGER, size INTEGER, mtime INTEGER, object BLOB)')
+            self.conn.execute(f'CREATE INDEX {name}_size ON {name} (size)')
+            self.conn.execute(f'CREATE INDEX {name}_ino ON {name} (ino, size, mtime)')
+        return CatalogObjects(self, name)
+
+    def compare(self, src, dst, src_only, dst_only, changed, truly_changed, resolution, use_ctime):
+        """ Fill src_only, dst_only, changed and truly_changed as AbsDirSync.compare_paths does """
+        newer = '(s.mtime - d.mtime >= ?)'
+        params = (resolution,)
+        if use_ctime:
+            newer = '(s.mtime - d.mtime >= ? OR s.ctime - d.mtime >= ?)'
+            params = (resolution, resolution)
+        with self.lock:
+            for only, a, b in ((src_only, src, dst), (dst_only, dst, src)):
+                self.conn.execute(f'INSERT INTO {only.name} (key, depth) SELECT s.key, s.depth FROM {a.name} s '
+                                  f'WHERE NOT EXISTS (SELECT 1 FROM {b.name} d WHERE d.key = s.key)')
+            self.conn.execute(f'INSERT INTO {changed.name} (key, depth) SELECT s.key, s.depth '
+                              f'FROM {src.name} s JOIN {dst.name} d ON d.key = s.key '
+                              f"WHERE s.type IS NOT d.type OR s.type = 'DIR' OR {newer}", params)
+            self.conn.execute(f'INSERT INTO {truly_changed.name} (key, depth) SELECT s.key, s.depth '
+                              f'FROM {src.name} s JOIN {dst.name} d ON d.key = s.key '
+                              f"WHERE s.type IS NOT d.type OR (s.type = 'FILE' AND {newer})", params)
+
+    def move_candidates(self, src_only, src, dst_only, dst):
+        """ Generate the files of src_only with the files of dst_only of the same size and mtime """
+        with self.lock:
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS {dst.name}_size ON {dst.name} (size, mtime)')
+        for first, last in src_only.pages():
+            rows = self.fetchall(
+                f'SELECT s.key, d.key FROM {src_only.name} o JOIN {src.name} s ON s.key = o.key '
+                f'JOIN {dst.name} d ON d.size = s.size AND d.mtime = s.mtime JOIN {dst_only.name} r ON r.key = d.key '
+                f"WHERE o.key >= ? AND o.key <= ? AND s.type = 'FILE' AND d.type = 'FILE' ORDER BY s.key, d.key",
+                (first, last))
+            group_key, group = None, []
+            for key, old_key in rows:
+                if key != group_key:
+                    if group:
+                        yield (key_path(group_key), group)
+                    group_key, group = key, []
+                group.append(key_path(old_key))
+            if group:
+                yield (key_path(group_key), group)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class CatalogDict(MutableMapping):
+    """ Mapping of paths to their metadata stored in a table of a Catalog, iterated in path order """
+
+    def __init__(self, catalog, name):
+        self.catalog = catalog
+        self.name = name
+
+    def row(self, path, meta):
+        return (path_key(path), len(path.parts), meta_type(meta),
+                meta.get('mtime', None), meta.get('ctime', None), meta.get('size', None), marshal.dumps(meta))
+
+    def __getitem__(self, path):
+        row = self.catalog.fetchone(f'SELECT meta FROM {self.name} WHERE key = ?', (path_key(path),))
+        if row is None:
+            raise KeyError(path)
+        return marshal.loads(row[0])
+
+    def __setitem__(self, path, meta):
+        self.catalog.execute(f'INSERT OR REPLACE INTO {self.name} VALUES (?, ?, ?, ?, ?, ?, ?)', self.row(path, meta))
+
+    def __delitem__(self, path):
+        if self.catalog.execute(f'DELETE FROM {self.name} WHERE key = ?', (path_key(path),)) == 0:
+            raise KeyError(path)
+
+    def __contains__(self, path):
+        return self.catalog.fetchone(f'SELECT 1 FROM {self.name} WHERE key = ?', (path_key(path),)) is not None
+
+    def __len__(self):
+        return self.catalog.fetchone(f'SELECT COUNT(*) FROM {self.name}')[0]
+
+    def __iter__(self):
+        for key, _ in self.rows('key'):
+            yield key_path(key)
+
+    def items(self):
+        for key, meta in self.rows('meta'):
+            yield (key_path(key), marshal.loads(meta))
+
+    def values(self):
+        for _, meta in self.rows('meta'):
+            yield marshal.loads(meta)
+
+    def rows(self, column):
+        """ Generate the (key, column) of the paths in order """
+        last = None
+        while True:
+            if last is None:
+                rows = self.catalog.fetchall(f'SELECT key, {column} FROM {self.name} ORDER BY key LIMIT ?',
+                                             (catalog_page,))
+            else:
+                rows = self.catalog.fetchall(f'SELECT key, {column} FROM {self.name} WHERE key > ? ORDER BY key LIMIT ?',
+                                             (last, catalog_page))
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield from rows
+
+    def update(self, other):
+        self.catalog.executemany(f'INSERT OR REPLACE INTO {self.name} VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (self.row(path, meta) for path, meta in other.items()))
+
+    def prune(self, path):
+        prune_table(self.catalog, self.name, path)
+
+    def child_groups(self, all_types=False):
+        """ Generate the directories with children, deepest first, each with its (child, metadata) list """
+        where = '' if all_types else "type IN ('DIR', 'FILE') AND"
+        depth = None
+        last = None
+        group_dir, group = None, []
+        while True:
+            if depth is None:
+                rows = self.catalog.fetchall(f'SELECT key, depth, meta FROM {self.name} WHERE {where} 1 '
+                                             f'ORDER BY depth DESC, key LIMIT ?', (catalog_page,))
+            else:
+                rows = self.catalog.fetchall(f'SELECT key, depth, meta FROM {self.name} '
+                                             f'WHERE {where} (depth < ? OR (depth = ? AND key > ?)) '
+                                             f'ORDER BY depth DESC, key LIMIT ?', (depth, depth, last, catalog_page))
+            if not rows:
+                break
+            last, depth = rows[-1][0], rows[-1][1]
+            for key, _, meta in rows:
+                path = key_path(key)
+                if path.parent != group_dir:
+                    if group:
+                        yield (group_dir, group)
+                    group_dir, group = path.parent, []
+                group.append((path, marshal.loads(meta)))
+        if group:
+            yield (group_dir, group)
+
+class CatalogSet(MutableSet):
+    """ Set of paths stored in a table of a Catalog, which is iterated over in the order of the paths """
+
+    def __init__(self, catalog, name):
+        self.catalog = catalog
+        self.name = name
+
+    def __contains__(self, path):
+        return self.catalog.fetchone(f'SELECT 1 FROM {self.name} WHERE key = ?', (path_key(path),)) is not None
+
+    def __len__(self):
+        return self.catalog.fetchone(f'SELECT COUNT(*) FROM {self.name}')[0]
+
+    def __iter__(self):
+        return self.ordered()
+
+    def add(self, path):
+        self.catalog.execute(f'INSERT OR IGNORE INTO {self.name} VALUES (?, ?)', (path_key(path), len(path.parts)))
+
+    def discard(self, path):
+        self.catalog.execute(f'DELETE FROM {self.name} WHERE key = ?', (path_key(path),))
+
+    def update(self, paths):
+        self.catalog.executemany(f'INSERT OR IGNORE INTO {self.name} VALUES (?, ?)',
+                                 ((path_key(path), len(path.parts)) for path in paths))
+
+    def prune(self, path):
+        prune_table(self.catalog, self.name, path)
+
+    def ordered(self, reverse=False, included=None, kind=None, depth=None):
+        """ Generate the paths in order, optionally only those of type kind in included and of depth """
+        join = ''
+        conditions = []
+        params = []
+        if included is not None:
+            join = f'JOIN {included.name} i ON i.key = s.key'
+            conditions.append('i.type = ?')
+            params.append(kind)
+        if depth is not None:
+            conditions.append('s.depth = ?')
+            params.append(depth)
+        last = None
+        while True:
+            page_conditions = conditions if last is None else conditions + [ 's.key < ?' if reverse else 's.key > ?' ]
+            page_params = params if last is None else params + [last]
+            where = ('WHERE ' + ' AND '.join(page_conditions)) if page_conditions else ''
+            rows = self.catalog.fetchall(f"SELECT s.key FROM {self.name} s {join} {where} "
+                                         f"ORDER BY s.key {'DESC' if reverse else ''} LIMIT ?",
+                                         page_params + [catalog_page])
+            if not rows:
+                return
+            last = rows[-1][0]
+            for key, in rows:
+                yield key_path(key)
+
+    def pages(self):
+        """ Generate the first and last keys of each page of keys, in order """
+        last = None
+        while True:
+            if last is None:
+                rows = self.catalog.fetchall(f'SELECT key FROM {self.name} ORDER BY key LIMIT ?', (catalog_page,))
+            else:
+                rows = self.catalog.fetchall(f'SELECT key FROM {self.name} WHERE key > ? ORDER BY key LIMIT ?',
+                                             (last, catalog_page))
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield (rows[0][0], last)
+
+    def levels(self, included, kind, reverse=False):
+        """ Generate the paths of type kind in included grouped by depth """
+        depths = [ depth for depth, in self.catalog.fetchall(
+            f'SELECT DISTINCT s.depth FROM {self.name} s JOIN {included.name} i ON i.key = s.key AND i.type = ? '
+            f"ORDER BY s.depth {'DESC' if reverse else ''}", (kind,)) ]
+        for depth in depths:
+            yield self.ordered(included=included, kind=kind, depth=depth)
+
+class CatalogObjects(object):
+    """ Index of the object files of a DirCrypt, like ObjectIndex, stored in a table of a Catalog """
+
+    def __init__(self, catalog, name):
+        self.catalog = catalog
+        self.name = name
+
+    def add(self, meta):
+        self.catalog.execute(f'INSERT INTO {self.name} VALUES (?, ?, ?, ?)',
+                             (meta.get('ino', None), meta['size'], meta['mtime'], meta['object']))
+
+    def get(self, ino, size, mtime):
+        # The object added last wins, as in a dict.
+        row = self.catalog.fetchone(f'SELECT object FROM {self.name} WHERE ino = ? AND size = ? AND mtime = ? '
+                                    f'ORDER BY rowid DESC LIMIT 1', (ino, size, mtime))
+        return row[0] if row else None
+
+    def has_size(self, size):
+        return self.catalog.fetchone(f'SELECT 1 FROM {self.name} WHERE size = ? LIMIT 1', (size,)) is not None
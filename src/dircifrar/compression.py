@@ -0,0 +1,95 @@
+
+import os, io, zlib, lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The algorithm ids are recorded in encrypted files and must never change.
+
+algorithm_ids = {'zlib': 1, 'lzma': 2, 'zstd': 3}
+algorithm_names = {id: name for name, id in algorithm_ids.items()}
+
+# Files with these suffixes are almost always compressed already.
+
+incompressible_suffixes = {
+    '.7z', '.aac', '.avi', '.bz2', '.docx', '.epub', '.flac', '.gif', '.gz', '.heic',
+    '.jpeg', '.jpg', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.opus',
+    '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp', '.xlsx', '.xz', '.zip', '.zst',
+}
+
+sample_size = 2 ** 14
+sample_count = 4
+# A file is considered incompressible if zlib cannot shrink its samples by this much.
+sample_min_ratio = 0.9
+
+def available_algorithms():
+    return [ name for name in algorithm_ids if name != 'zstd' or zstandard is not None ]
+
+def check_algorithm(name):
+    if name not in algorithm_ids:
+        raise ValueError(f"Error: {name} is not a supported compression algorithm")
+    if name not in available_algorithms():
+        raise ValueError(f"Error: compression algorithm {name} requires the zstandard package")
+
+class Compressor(object):
+    """ Streaming compressor with the same interface for all algorithms """
+
+    def __init__(self, name):
+        check_algorithm(name)
+        self.id = algorithm_ids[name]
+        if name == 'zlib':
+            self.obj = zlib.compressobj(6)
+        elif name == 'lzma':
+            self.obj = lzma.LZMACompressor(preset=1)
+        else:
+            self.obj = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+class Decompressor(object):
+    """ Streaming decompressor with the same interface for all algorithms """
+
+    def __init__(self, id):
+        name = algorithm_names.get(id, None)
+        if name is None:
+            raise ValueError(f"Error: unknown compression algorithm id {id}")
+        check_algorithm(name)
+        if name == 'zlib':
+            self.obj = zlib.decompressobj()
+        elif name == 'lzma':
+            self.obj = lzma.LZMADecompressor()
+        else:
+            self.obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self.obj.decompress(data)
+
+    def flush(self):
+        return self.obj.flush() if hasattr(self.obj, 'flush') else b''
+
+def is_compressible(plain_file, plain_size):
+    """ Guess from its suffix and a few samples whether plain_file is worth compressing """
+    if isinstance(plain_file, (bytes, bytearray)):
+        return samples_compressible(io.BytesIO(plain_file), plain_size)
+    if os.path.splitext(str(plain_file))[1].lower() in incompressible_suffixes:
+        return False
+    with open(plain_file, 'rb') as plain_fp:
+        return samples_compressible(plain_fp, plain_size)
+
+def samples_compressible(plain_fp, plain_size):
+    total = 0
+    compressed = 0
+    for i in range(sample_count):
+        plain_fp.seek(max(0, plain_size - sample_size) * i // max(1, sample_count - 1))
+        sample = plain_fp.read(sample_size)
+        total += len(sample)
+        compressed += len(zlib.compress(sample, 1))
+        if plain_size <= sample_size:
+            break
+    return total > 0 and compressed < total * sample_min_ratio
@@ -1,17 +1,35 @@
 
 from .__init__ import (
+    __config_filename__,
     __crypt_dirname__,
     __crypt_metadir__,
+    __crypt_treedir__,
+    __crypt_packdir__,
+    __crypt_objdir__,
+    __crypt_format__,
 )
 from .filecrypt import (
     file_encrypt,
     file_decrypt,
+    file_reseal,
+    file_is_sealed,
+    install_file,
+    FileChangedError,
+    check_unchanged,
+    content_digest,
+    derive_key,
+    is_temp_name,
+    temp_file,
+    temp_prefix,
     path_encode,
     path_decode,
     path_hash,
 )
+from .prefetch import Prefetcher, read_ahead
+from .dirfds import DirFds
+from .exclude import Excluder
 from pathlib import Path
-import os, sys, stat, json, shutil, tempfile
+import os, io, re, sys, stat, json, shutil, hashlib, threading
 
 from nacl.utils import random as randombytes
 from nacl.pwhash import argon2i
@@ -20,20 +38,146 @@ from nacl.hash import generichash
 from nacl.bindings import crypto_secretstream_xchacha20poly1305_KEYBYTES as KEYBYTES
 
 chunk_size = 4096
+# The number of times a file that changes while it is being encrypted is tried.
+file_change_retries = 3
 
-def make_metadata(path, mode, mtime, ctime):
+# Pending small files are written into a pack file once their total size reaches pack_size.
+pack_size = 2 ** 22
+# A pack file is merged into a new one once its live members take up less than this fraction of it.
+pack_min_live = 0.5
+# The number of decrypted pack files kept in memory while pulling.
+pack_cache_size = 4
+pack_name_pattern = re.compile('[0-9a-f]{32}')
+# An object file is named by the hex digest of its contents, split into directories like path_hash.
+object_name_pattern = re.compile('[0-9a-f]{60}')
+# The paths referring to an object file are recorded by empty marker files, named by keyed hashes
+# of the paths, in the directory named like the object file with this suffix.
+object_refs_suffix = '.refs'
+
+# The version of the manifests, which is recorded in the config once they have been written in full
+# by a version that maintains them.  Without it, the manifests are not used to prune subtrees.
+manifest_version = 1
+
+# If the metadata has extra fields, this bit is set in the encoded mode and the extra fields
+# are encoded as (tag, length, value) triples between ctime and path.  Unknown tags are skipped.
+meta_ext_flag = 2 ** 31
+meta_ext_ints = {'size': 1, 'ino': 2, 'offset': 4}
+meta_ext_bytes = {'digest': 3, 'pack': 5, 'object': 6}
+meta_ext_names = {tag: name for name, tag in list(meta_ext_ints.items()) + list(meta_ext_bytes.items())}
+
+def make_metadata(path, mode, mtime, ctime, **ext):
+    ext_bytes = b''
+    for name, value in sorted(ext.items()):
+        if value is None:
+            continue
+        if name in meta_ext_ints:
+            tag = meta_ext_ints[name]
+            value = value.to_bytes(8, byteorder='little', signed=False)
+        else:
+            tag = meta_ext_bytes[name]
+        ext_bytes += bytes([tag, len(value)]) + value
+    if ext_bytes:
+        mode |= meta_ext_flag
+        ext_bytes = len(ext_bytes).to_bytes(2, byteorder='little', signed=False) + ext_bytes
     mode_bytes = mode.to_bytes(4, byteorder='little', signed=False)
     mtime_bytes = mtime.to_bytes(8, byteorder='little', signed=False)
     ctime_bytes = ctime.to_bytes(8, byteorder='little', signed=False)
     path_bytes = path_encode(path)
-    return mode_bytes + mtime_bytes + ctime_bytes + path_bytes
+    return mode_bytes + mtime_bytes + ctime_bytes + ext_bytes + path_bytes
 
 def dest_metadata(metadata):
     mode = int.from_bytes(metadata[0:4], byteorder='little', signed=False)
     mtime = int.from_bytes(metadata[4:12], byteorder='little', signed=False)
     ctime = int.from_bytes(metadata[12:20], byteorder='little', signed=False)
-    path = path_decode(metadata[20:])
-    return (path, mode, mtime, ctime)
+    meta = {'mode': mode & ~meta_ext_flag, 'mtime': mtime, 'ctime': ctime}
+    pos = 20
+    if mode & meta_ext_flag:
+        ext_end = 22 + int.from_bytes(metadata[20:22], byteorder='little', signed=False)
+        pos = 22
+        while pos < ext_end:
+            tag, size = metadata[pos], metadata[pos + 1]
+            value = metadata[pos + 2 : pos + 2 + size]
+            name = meta_ext_names.get(tag, None)
+            if name in meta_ext_ints:
+                meta[name] = int.from_bytes(value, byteorder='little', signed=False)
+            elif name in meta_ext_bytes:
+                meta[name] = value
+            pos += 2 + size
+        assert pos == ext_end
+    path = path_decode(metadata[pos:])
+    return (path, meta)
+
+def encode_meta(path, meta):
+    ext = {name: meta[name] for name in list(meta_ext_ints) + list(meta_ext_bytes) if name in meta}
+    return make_metadata(path, meta['mode'], meta['mtime'], meta['ctime'], **ext)
+
+# The manifest of a directory consists of its path, its tree digest, and the metadata
+# and (for subdirectories) tree digests of its children.
+
+def make_manifest(path, digest, entries):
+    path_bytes = path_encode(path)
+    data = [len(path_bytes).to_bytes(4, byteorder='little', signed=False), path_bytes, digest]
+    for metadata, child_digest in entries:
+        data.append(len(metadata).to_bytes(4, byteorder='little', signed=False))
+        data.append(metadata)
+        data.append(len(child_digest).to_bytes(1, byteorder='little', signed=False))
+        data.append(child_digest)
+    return b''.join(data)
+
+def dest_manifest(manifest):
+    path_size = int.from_bytes(manifest[0:4], byteorder='little', signed=False)
+    pos = 4 + path_size
+    path = path_decode(manifest[4:pos])
+    digest = manifest[pos : pos + 32]
+    pos += 32
+    entries = []
+    while pos < len(manifest):
+        metadata_size = int.from_bytes(manifest[pos : pos + 4], byteorder='little', signed=False)
+        metadata = manifest[pos + 4 : pos + 4 + metadata_size]
+        pos += 4 + metadata_size
+        digest_size = manifest[pos]
+        entries.append((metadata, manifest[pos + 1 : pos + 1 + digest_size]))
+        pos += 1 + digest_size
+    return (path, digest, entries)
+
+# The index of a pack file lists the metadata of its members, which record the id of
+# the pack file and the offsets of the members in it.
+
+def make_pack_index(entries):
+    return b''.join(len(metadata).to_bytes(4, byteorder='little', signed=False) + metadata
+                    for metadata in entries)
+
+def dest_pack_index(index):
+    entries = []
+    pos = 0
+    while pos < len(index):
+        size = int.from_bytes(index[pos : pos + 4], byteorder='little', signed=False)
+        entries.append(index[pos + 4 : pos + 4 + size])
+        pos += 4 + size
+    return entries
+
+# The metadata of an object file written by an earlier version lists the paths that refer to it.
+
+def make_object_refs(paths):
+    return make_pack_index([ path_encode(path) for path in sorted(paths) ])
+
+def dest_object_refs(refs):
+    if refs.startswith(object_id_magic):
+        return []
+    return [ path_decode(code) for code in dest_pack_index(refs) ]
+
+# The metadata of an object file is now its object id after this magic, which can never begin a list
+# of references, so that a pull can check that the object file is the one its path points to.
+object_id_magic = b'\xff' * 4
+
+def make_object_metadata(object_id):
+    return object_id_magic + object_id
+
+def dest_object_metadata(metadata):
+    """ The object id in the metadata of an object file, or None if it lists references instead """
+    if metadata.startswith(object_id_magic):
+        return metadata[len(object_id_magic):]
+    return None
 
 def meta_encode_metadata(data):
     return (len(data) + 1).to_bytes(4, byteorder='little', signed=False) + b'\x00' + data
@@ -42,9 +186,43 @@ def meta_encode_path(path):
     code = path_encode(path)
     return (len(code) + 1).to_bytes(4, byteorder='little', signed=False) + b'\x01' + code
 
+# The metadata files collected from dircifrar_meta are read in batches of this many, so that the
+# files waiting to be read need not all be in memory at once.
+collect_batch = 10000
+
 def exc_info():
     return str(sys.exc_info()[1])
 
+def child_groups(included, all_types=False, only=None):
+    """ Group the paths in included by parent, from the deepest parents to the root """
+    if hasattr(included, 'child_groups'):
+        return included.child_groups(all_types)
+    children = dict()
+    for path, meta in included.items():
+        if (only is None or path.parent in only) and \
+           (all_types or stat.S_ISDIR(meta['mode']) or stat.S_ISREG(meta['mode'])):
+            children.setdefault(path.parent, []).append((path, meta))
+    return [ (d, sorted(children[d], key=lambda item: item[0].name))
+             for d in sorted(children, key=lambda p: len(p.parts), reverse=True) ]
+
+class ObjectIndex(object):
+    """ Index of the object files of the collected paths by the inodes and sizes of their files """
+
+    def __init__(self):
+        self.inodes = dict()
+        self.sizes = set()
+
+    def add(self, meta):
+        self.sizes.add(meta['size'])
+        if 'ino' in meta:
+            self.inodes[(meta['ino'], meta['size'], meta['mtime'])] = meta['object']
+
+    def get(self, ino, size, mtime):
+        return self.inodes.get((ino, size, mtime), None)
+
+    def has_size(self, size):
+        return size in self.sizes
+
 class DirCrypt(object):
     """ API for accessing an encrypted directory """
 
@@ -52,62 +230,768 @@ class DirCrypt(object):
         self.dir_type = 'crypt'
         self.dir_root = dir_root
         self.version = version
-        self.exclude = exclude
+        self.exclude = exclude if isinstance(exclude, Excluder) else Excluder(exclude)
         self.config = config
         self.crypt_key = crypt_key
+        # The compression algorithm for pushed files, if any.
+        self.compress = config.get('compress', None)
+        # Files smaller than pack_threshold are stored in pack files rather than on their own.
+        self.pack_threshold = config.get('pack_threshold', None) or 0
+        # If dedup is set, the contents of other files are stored once per distinct contents in object files.
+        self.dedup = config.get('dedup', False)
         self.crypt_dir = dir_root / __crypt_dirname__
         self.crypt_meta = dir_root / __crypt_metadir__
+        self.crypt_tree = dir_root / __crypt_treedir__
+        self.crypt_pack = dir_root / __crypt_packdir__
+        self.crypt_object = dir_root / __crypt_objdir__
+        # The open fds of the shard directories of crypt_dir and crypt_meta.
+        self.data_dirs = DirFds(self.crypt_dir)
+        self.meta_dirs = DirFds(self.crypt_meta)
+        # The local MetaCache of the decrypted metadata files, if any.
+        self.meta_cache = None
+        # The Catalog keeping the collected paths on disk, if any, in tables prefixed by catalog_name.
+        self.catalog = None
+        self.catalog_name = 'crypt'
+        self.tree_key = derive_key(crypt_key, b'tree')
+        self.object_ref_key = derive_key(crypt_key, b'object-ref')
+        self.pruned = set()
+        self.tree_digest = dict()
+        self.tree_valid = False
+        self.tree_dirty = False
+        self.touched = set()
+        self.tree_stale = False
+        # If defer_tree is set, the manifests and the garbage in pack files are left to another
+        # object, which brings them up to date from the journal in finish_shards.
+        self.defer_tree = False
+        self.journal_lock = threading.Lock()
+        self.pack_lock = threading.Lock()
+        self.pack_pending = []
+        self.pack_pending_size = 0
+        self.pack_touched = set()
+        self.pack_cache = dict()
+        self.pack_cache_lock = threading.Lock()
+        self.object_lock = threading.Lock()
+        self.object_touched = set()
+        self.object_index = None
+        self.prefetcher = None
+        self.prefetch_index = dict()
+        # The token bucket limiting the rate of reading and writing plaintext, if any.
+        self.limiter = None
+        # The function used to read metadata, which may be replaced by a concurrent version of map.
+        self.mapper = map
 
-    def collect_paths(self, rebuild_meta=False):
-        self.included = dict()
-        self.excluded = set()
+    def collect_paths(self, rebuild_meta=False, reference=None):
+        """ Collect the paths under dir_root, pruning the subtrees identical to those in reference """
+        self.included = self.new_included()
+        self.excluded = self.new_excluded()
+        self.pruned = set()
+        self.tree_digest = dict()
+        self.object_index = None
+        if (self.crypt_tree / 'dirty').exists():
+            # The last synchronization was interrupted.
+            self.sweep_temp_files()
+        self.tree_valid = self.crypt_meta.exists() and not rebuild_meta and \
+            (self.check_tree() or self.recover_tree())
+
+        if self.tree_valid and reference is not None:
+            self.collect_tree(self.tree_digests(reference))
 
-        if rebuild_meta or not self.crypt_meta.exists():
+        elif rebuild_meta or not self.crypt_meta.exists():
             if self.crypt_meta.exists():
+                self.meta_dirs.close()
                 shutil.rmtree(self.crypt_meta)
             self.crypt_meta.mkdir(parents=True)
 
-            for cwd, dirs, files in os.walk(self.crypt_dir, followlinks=False):
-                for d in dirs:
-                    if any(pat.fullmatch(d) for pat in self.exclude):
-                        path = Path(os.path.relpath(os.path.join(cwd, d), self.crypt_dir))
-                        self.excluded.add(path)
-                        # This prevents os.walk from walking excluded directories.
-                        dirs.remove(d)
-                for f in files:
-                    crypt_file = os.path.join(cwd, f)
-                    crypt_path = Path(os.path.relpath(crypt_file, self.crypt_dir))
-                    crypt_mode = os.stat(crypt_file).st_mode
-                    if any(pat.fullmatch(f) for pat in self.exclude) or not stat.S_ISREG(crypt_mode):
-                        self.excluded.add(crypt_path)
-                    else:
-                        metadata = file_decrypt(self.crypt_key, crypt_file, None, metadata_only=True)
-                        path, mode, mtime, ctime = dest_metadata(metadata)
-                        assert path_hash(self.crypt_key, path) == crypt_path
-                        self.included[path] = {'mode': mode, 'mtime': mtime, 'ctime': ctime}
-                        meta_file = self.crypt_meta / crypt_path
-                        os.makedirs(meta_file.parent, exist_ok=True)
-                        file_encrypt(self.crypt_key, None, meta_file, metadata, chunk_size)
+            def rebuild(crypt_file, crypt_path):
+                metadata = file_decrypt(self.crypt_key, crypt_file, None, metadata_only=True)
+                self.write_meta(crypt_path, metadata)
+                return metadata
+            self.collect_files(self.crypt_dir, rebuild)
+            self.rebuild_packs()
+            self.rebuild_objects()
+            self.update_tree()
+
+        else:
+            def read(crypt_file, crypt_path):
+                return file_decrypt(self.crypt_key, crypt_file, None, metadata_only=True)
+            self.collect_files(self.crypt_meta, read, self.meta_cache)
+
+    def collect_files(self, top, read, cache=None, prefix=Path()):
+        """ Collect paths from the files under top, whose metadata are obtained by read """
+        files = []
+        cached = []
+        # The names of all metadata files, which are kept in the cache.
+        seen = []
+        def read_files():
+            metadatas = self.mapper(lambda file: read(*file[0:2]), files)
+            for (crypt_file, crypt_path, st), metadata in zip(files, metadatas):
+                path, meta = dest_metadata(metadata)
+                assert path_hash(self.crypt_key, path) == crypt_path
+                self.included[path] = meta
+                if cache:
+                    cache.put(crypt_path, st, metadata)
+                    seen.append(crypt_path)
+            files.clear()
+        for cwd, dirs, names in os.walk(top, followlinks=False):
+            for d in list(dirs):
+                path = prefix / os.path.relpath(os.path.join(cwd, d), top)
+                if self.exclude.excludes(path, is_dir=True):
+                    self.excluded.add(path)
+                    # This prevents os.walk from walking excluded directories.
+                    dirs.remove(d)
+                elif self.exclude.prunes(path):
+                    dirs.remove(d)
+            for f in names:
+                crypt_file = os.path.join(cwd, f)
+                crypt_path = prefix / os.path.relpath(crypt_file, top)
+                st = os.stat(crypt_file)
+                if is_temp_name(f):
+                    continue
+                if self.exclude.excludes(crypt_path) or not stat.S_ISREG(st.st_mode):
+                    self.excluded.add(crypt_path)
+                    continue
+                metadata = cache.get(crypt_path, st) if cache else None
+                if metadata is not None:
+                    cached.append((crypt_path, metadata))
+                else:
+                    files.append((crypt_file, crypt_path, st))
+                    if len(files) >= collect_batch:
+                        read_files()
+        read_files()
+        # The cached metadata were checked when they were read.
+        for crypt_path, metadata in cached:
+            path, meta = dest_metadata(metadata)
+            self.included[path] = meta
+        if cache:
+            cache.retain(seen + [ crypt_path for crypt_path, _ in cached ])
+
+    def prepare_shards(self):
+        """ Sweep temporary files and rebuild a missing dircifrar_meta before collect_shards """
+        if not self.crypt_meta.exists():
+            self.collect_paths()
+        elif (self.crypt_tree / 'dirty').exists():
+            self.sweep_temp_files()
+
+    def collect_shards(self, shards):
+        """ Collect only the paths whose metadata files are in the top-level directories named by shards """
+        self.included = dict()
+        self.excluded = set()
+        self.pruned = set()
+        self.tree_digest = dict()
+        def read(crypt_file, crypt_path):
+            return file_decrypt(self.crypt_key, crypt_file, None, metadata_only=True)
+        for shard in sorted(shards):
+            if (self.crypt_meta / shard).is_dir():
+                self.collect_files(self.crypt_meta / shard, read, prefix=Path(shard))
+
+    def read_meta_files(self, crypt_paths):
+        """ Read the metadata files named by crypt_paths and return the paths read and the files missing """
+        def read(crypt_path):
+            meta_file = self.crypt_meta / crypt_path
+            try:
+                return file_decrypt(self.crypt_key, meta_file, None, metadata_only=True)
+            except FileNotFoundError:
+                return None
+        crypt_paths = [ Path(crypt_path) for crypt_path in crypt_paths
+                        if not is_temp_name(Path(crypt_path).name) and not self.excludes_meta(Path(crypt_path)) ]
+        self.included = dict()
+        missing = set()
+        for crypt_path, metadata in zip(crypt_paths, self.mapper(read, crypt_paths)):
+            if metadata is None:
+                missing.add(crypt_path)
+                continue
+            path, meta = dest_metadata(metadata)
+            assert path_hash(self.crypt_key, path) == crypt_path
+            self.included[path] = meta
+        return (self.included, missing)
+
+    def excludes_meta(self, crypt_path):
+        """ Whether collect_files skips the metadata file at crypt_path """
+        return self.exclude.excludes(crypt_path) or \
+            any(self.exclude.excludes(parent, is_dir=True) or self.exclude.prunes(parent)
+                for parent in list(crypt_path.parents)[:-1])
+
+    def new_included(self):
+        """ An empty mapping of collected paths to their metadata, kept in the catalog if any """
+        if self.catalog is None:
+            return dict()
+        return self.catalog.mapping(f'{self.catalog_name}_included')
+
+    def new_excluded(self):
+        if self.catalog is None:
+            return set()
+        return self.catalog.set(f'{self.catalog_name}_excluded')
+
+    def check_tree(self):
+        """ Check that the manifests exist and are up to date """
+        return (self.crypt_tree / path_hash(self.crypt_key, Path())).is_file() and \
+            not (self.crypt_tree / 'dirty').exists() and \
+            self.config.get('manifests', None) == manifest_version and \
+            not self.tree_outdated()
 
+    def tree_outdated(self):
+        """ Check whether the metadata may have been written after the manifests were last updated """
+        try:
+            generation = os.stat(self.crypt_tree / 'generation').st_ctime_ns
+        except FileNotFoundError:
+            return True
+        # Every write adds a name to a directory and so changes its ctime, which is never copied from elsewhere.
+        for top in (self.crypt_meta, self.crypt_tree):
+            with os.scandir(top) as shards:
+                for shard in shards:
+                    if not shard.is_dir(follow_symlinks=False):
+                        continue
+                    if shard.stat(follow_symlinks=False).st_ctime_ns > generation:
+                        return True
+                    with os.scandir(shard.path) as subshards:
+                        for subshard in subshards:
+                            if subshard.is_dir(follow_symlinks=False) and \
+                               subshard.stat(follow_symlinks=False).st_ctime_ns > generation:
+                                return True
+        return False
+
+    def upgrade_format(self):
+        """ Record the current format in the config of an older directory before it is modified """
+        if self.config.get('format', 1) < __crypt_format__:
+            self.record_config({'format': __crypt_format__})
+
+    def record_config(self, fields):
+        """ Record fields in the config file, which is replaced by a temporary file """
+        self.config.update(fields)
+        config_file = self.dir_root / __config_filename__
+        if not config_file.is_file():
+            return
+        with open(config_file, 'r') as cf:
+            config = json.load(cf)
+        config.update(fields)
+        temp_config = config_file.with_name(temp_prefix + config_file.name)
+        with open(temp_config, 'w') as f:
+            json.dump(config, f, indent=4)
+        os.replace(temp_config, config_file)
+
+    def tree_digests(self, included, fixed={}):
+        """ Compute the tree digests of all directories in included, except those in fixed """
+        digests = dict()
+        # A directory without children in included has the tree digest of an empty directory.
+        empty = hashlib.blake2b(key=self.tree_key, digest_size=32).digest()
+        for d, children in child_groups(included):
+            hasher = hashlib.blake2b(key=self.tree_key, digest_size=32)
+            for path, meta in children:
+                name = path.name.encode('utf-8')
+                hasher.update(len(name).to_bytes(4, byteorder='little', signed=False) + name)
+                if stat.S_ISDIR(meta['mode']):
+                    digests[path] = fixed.get(path, None) or digests.get(path, empty)
+                    hasher.update(b'D' + digests[path])
+                else:
+                    hasher.update(b'F' + meta['mtime'].to_bytes(8, byteorder='little', signed=False))
+            digests[d] = fixed.get(d, None) or hasher.digest()
+        digests.update(fixed)
+        digests.setdefault(Path(), empty)
+        return digests
+
+    def read_manifest(self, path):
+        tree_file = self.crypt_tree / path_hash(self.crypt_key, path)
+        manifest = file_decrypt(self.crypt_key, tree_file, None, metadata_only=True)
+        manifest_path, digest, entries = dest_manifest(manifest)
+        assert manifest_path == path
+        return (digest, entries)
+
+    def collect_tree(self, ref_digests):
+        """ Collect paths from the manifests, descending only into subtrees that differ from ref_digests """
+        root = Path()
+        digest, _ = self.read_manifest(root)
+        self.tree_digest[root] = digest
+        self.collect_levels([root], ref_digests)
+
+    def collect_levels(self, level, ref_digests):
+        """ Collect paths from the manifests of level and below, pruning subtrees identical in ref_digests """
+        while level:
+            next_level = []
+            for path in level:
+                if ref_digests.get(path, None) == self.tree_digest[path]:
+                    self.pruned.add(path)
+                else:
+                    next_level.append(path)
+            level = []
+            for _, entries in self.mapper(self.read_manifest, next_level):
+                for metadata, digest in entries:
+                    path, meta = dest_metadata(metadata)
+                    self.included[path] = meta
+                    if stat.S_ISDIR(meta['mode']):
+                        self.tree_digest[path] = digest
+                        level.append(path)
+
+    def collect_subtrees(self, subpaths, reference=None):
+        """ Collect only the paths in the subtrees rooted at subpaths """
+        self.included = dict()
+        self.excluded = set()
+        self.pruned = set()
+        self.tree_digest = dict()
+        self.object_index = None
+        if (self.crypt_tree / 'dirty').exists():
+            # The last synchronization was interrupted.
+            self.sweep_temp_files()
+        self.tree_valid = self.crypt_meta.exists() and (self.check_tree() or self.recover_tree())
+        if not self.tree_valid:
+            self.collect_paths()
+            return
+        ancestors = { parent for subpath in subpaths for parent in subpath.parents }
+        level = [Path()]
+        subtrees = []
+        while level:
+            next_level = []
+            for _, entries in self.mapper(self.read_manifest, level):
+                for metadata, digest in entries:
+                    path, meta = dest_metadata(metadata)
+                    self.included[path] = meta
+                    if stat.S_ISDIR(meta['mode']):
+                        self.tree_digest[path] = digest
+                        if path in subpaths:
+                            subtrees.append(path)
+                        elif path in ancestors:
+                            next_level.append(path)
+                        else:
+                            self.pruned.add(path)
+            level = next_level
+        self.collect_levels(subtrees, self.tree_digests(reference) if reference is not None else dict())
+
+    def recover_tree(self):
+        """ Bring the manifests up to date from the journal, and return whether this was possible """
+        journal_file = self.crypt_tree / 'journal'
+        if not journal_file.is_file() or not (self.crypt_tree / path_hash(self.crypt_key, Path())).is_file():
+            return False
+        with open(journal_file, 'r') as fp:
+            crypt_paths = { Path(line.strip()) for line in fp if line.strip() }
+        try:
+            self.collect_tree(dict())
+        except Exception:
+            # Some manifests are missing or corrupted, so all of the metadata has to be read.
+            self.included = self.new_included()
+            self.tree_digest = dict()
+            return False
+        # Only the paths of the removed metadata files in the journal are looked up, so that
+        # nothing proportional to the size of the tree is kept in memory.
+        removed = { crypt_path for crypt_path in crypt_paths if not (self.crypt_meta / crypt_path).exists() }
+        old_paths = dict()
+        if removed:
+            for path in self.included:
+                crypt_path = path_hash(self.crypt_key, path)
+                if crypt_path in removed:
+                    old_paths[crypt_path] = path
+        for crypt_path in crypt_paths:
+            meta_file = self.crypt_meta / crypt_path
+            if meta_file.exists():
+                path, meta = dest_metadata(file_decrypt(self.crypt_key, meta_file, None, metadata_only=True))
+                assert path_hash(self.crypt_key, path) == crypt_path
+                self.included[path] = meta
+            elif crypt_path in old_paths:
+                path = old_paths[crypt_path]
+                meta = self.included.pop(path)
+            else:
+                continue
+            self.touched.add(path.parent)
+            if stat.S_ISDIR(meta['mode']):
+                self.touched.add(path)
+        self.tree_valid = True
+        self.update_tree()
+        self.included = self.new_included()
+        self.tree_digest = dict()
+        return True
+
+    def sweep_temp_files(self):
+        """ Remove the temporary files left behind by an interrupted synchronization """
+        for top in (self.crypt_dir, self.crypt_meta, self.crypt_tree, self.crypt_pack, self.crypt_object):
+            for cwd, dirs, names in os.walk(top, followlinks=False):
+                for d in [ d for d in dirs if is_temp_name(d) ]:
+                    shutil.rmtree(os.path.join(cwd, d))
+                    dirs.remove(d)
+                for f in names:
+                    if is_temp_name(f):
+                        os.remove(os.path.join(cwd, f))
+
+    def journal_path(self, path):
+        """ Record that the metadata of path is about to change """
+        crypt_path = path_hash(self.crypt_key, path).as_posix()
+        with self.journal_lock:
+            if not self.tree_dirty:
+                self.crypt_tree.mkdir(parents=True, exist_ok=True)
+                (self.crypt_tree / 'dirty').touch()
+                self.tree_dirty = True
+            with open(self.crypt_tree / 'journal', 'a') as fp:
+                fp.write(crypt_path + '\n')
+
+    def touch_tree(self, path, is_dir=False):
+        self.journal_path(path)
+        self.touched.add(path.parent)
+        if is_dir:
+            self.touched.add(path)
+
+    def update_tree(self):
+        """ Rewrite the manifests of the touched directories and their ancestors """
+        fixed = { path: self.tree_digest[path] for path in self.pruned }
+        digests = self.tree_digests(self.included, fixed)
+        if self.tree_valid:
+            dirs = set()
+            for path in self.touched:
+                dirs.add(path)
+                dirs.update(path.parents)
         else:
-            for cwd, dirs, files in os.walk(self.crypt_meta, followlinks=False):
-                for d in dirs:
-                    if any(pat.fullmatch(d) for pat in self.exclude):
-                        path = Path(os.path.relpath(os.path.join(cwd, d), self.crypt_meta))
-                        self.excluded.add(path)
-                        # This prevents os.walk from walking excluded directories.
-                        dirs.remove(d)
-                for f in files:
-                    crypt_file = os.path.join(cwd, f)
-                    crypt_path = Path(os.path.relpath(crypt_file, self.crypt_meta))
-                    crypt_mode = os.stat(crypt_file).st_mode
-                    if any(pat.fullmatch(f) for pat in self.exclude) or not stat.S_ISREG(crypt_mode):
-                        self.excluded.add(crypt_path)
-                    else:
-                        metadata = file_decrypt(self.crypt_key, crypt_file, None, metadata_only=True)
-                        path, mode, mtime, ctime = dest_metadata(metadata)
-                        assert path_hash(self.crypt_key, path) == crypt_path
-                        self.included[path] = {'mode': mode, 'mtime': mtime, 'ctime': ctime}
+            if self.crypt_tree.exists():
+                shutil.rmtree(self.crypt_tree)
+            dirs = set(digests.keys()) - self.pruned
+        self.crypt_tree.mkdir(parents=True, exist_ok=True)
+        written = set()
+        for d, children in child_groups(self.included, all_types=True, only=dirs):
+            if d in dirs and d in digests:
+                self.write_manifest(d, digests, children)
+                written.add(d)
+        for d in dirs - written:
+            if d in digests:
+                self.write_manifest(d, digests, [])
+            else:
+                tree_file = self.crypt_tree / path_hash(self.crypt_key, d)
+                if tree_file.exists():
+                    os.remove(tree_file)
+        # A new generation file marks the manifests as newer than all of the metadata files.
+        with temp_file(self.crypt_tree) as fp:
+            fp.write(randombytes(16).hex().encode('utf-8'))
+            fp.flush()
+            install_file(fp, self.crypt_tree / 'generation')
+        if self.config.get('manifests', None) != manifest_version:
+            self.record_config({'manifests': manifest_version})
+        # The journal is removed first, so that it never outlives the dirty marker.
+        for name in ('journal', 'dirty'):
+            if (self.crypt_tree / name).exists():
+                os.remove(self.crypt_tree / name)
+        self.tree_valid = True
+        self.tree_dirty = False
+        self.touched = set()
+
+    def write_manifest(self, d, digests, children):
+        tree_file = self.crypt_tree / path_hash(self.crypt_key, d)
+        entries = []
+        for path, meta in children:
+            entries.append((encode_meta(path, meta), digests[path] if stat.S_ISDIR(meta['mode']) else b''))
+        os.makedirs(tree_file.parent, exist_ok=True)
+        file_encrypt(self.crypt_key, None, tree_file, make_manifest(d, digests[d], entries), chunk_size)
+
+    def checkpoint(self):
+        """ Write the pending pack and bring the manifests up to date in the middle of a synchronization """
+        self.flush_pack()
+        if (self.tree_dirty or not self.tree_valid) and not self.tree_stale and not self.defer_tree:
+            self.update_tree()
+
+    def finish_sync(self):
+        """ Write the pending pack, collect garbage, and bring the manifests up to date """
+        if self.defer_tree:
+            self.flush_pack()
+            self.data_dirs.close()
+            self.meta_dirs.close()
+            return
+        # Live members of merged pack files are written together with the pending members.
+        if self.pack_touched:
+            self.collect_packs()
+        self.flush_pack()
+        if self.object_touched:
+            self.collect_objects()
+        if self.tree_dirty or not self.tree_valid:
+            self.update_tree()
+        if self.tree_stale:
+            # Some manifests outside the collected paths are out of date, so the next
+            # synchronization has to read all of the metadata and rewrite the manifests.
+            (self.crypt_tree / 'dirty').touch()
+            self.tree_stale = False
+        self.data_dirs.close()
+        self.meta_dirs.close()
+
+    def finish_shards(self, pack_touched):
+        """ Finish a synchronization whose shards have been synchronized with defer_tree set """
+        self.defer_tree = False
+        self.pack_touched |= set(pack_touched)
+        if self.pack_touched:
+            self.collect_packs()
+        self.flush_pack()
+        self.tree_stale = False
+        self.data_dirs.close()
+        self.meta_dirs.close()
+        if self.check_tree() or self.recover_tree():
+            return
+        self.collect_paths()
+        self.update_tree()
+
+    def write_crypt(self, dir_fds, crypt_path, plain_file, metadata, **options):
+        """ Encrypt plain_file into crypt_path relative to the cached fd of its directory """
+        with dir_fds(crypt_path.parent) as dir_fd:
+            return file_encrypt(self.crypt_key, plain_file, crypt_path.name, metadata, chunk_size,
+                                dir_fd=dir_fd, **options)
+
+    def write_meta(self, crypt_path, metadata):
+        """ Write the metadata file crypt_path and keep the metadata cache up to date """
+        with self.meta_dirs(crypt_path.parent) as dir_fd:
+            file_encrypt(self.crypt_key, None, crypt_path.name, metadata, chunk_size, dir_fd=dir_fd)
+            if self.meta_cache:
+                self.meta_cache.put(crypt_path, os.stat(crypt_path.name, dir_fd=dir_fd), metadata)
+
+    def pack_file(self, pack_id):
+        return self.crypt_pack / pack_id.hex()
+
+    def read_pack_index(self, pack_id):
+        """ Return the (metadata, path, meta) of the members of a pack file """
+        index = file_decrypt(self.crypt_key, self.pack_file(pack_id), None, metadata_only=True)
+        entries = []
+        for metadata in dest_pack_index(index):
+            path, meta = dest_metadata(metadata)
+            assert meta['pack'] == pack_id
+            entries.append((metadata, path, meta))
+        return entries
+
+    def load_pack(self, pack_id):
+        """ Return the members of a pack file keyed by (offset, path) and its decrypted contents """
+        with self.pack_cache_lock:
+            if pack_id in self.pack_cache:
+                return self.pack_cache[pack_id]
+        # The pack file is decrypted without holding the lock, so that other pack files can be loaded meanwhile.
+        contents = io.BytesIO()
+        index = file_decrypt(self.crypt_key, self.pack_file(pack_id), contents, limiter=self.limiter)
+        members = dict()
+        for metadata in dest_pack_index(index):
+            path, meta = dest_metadata(metadata)
+            assert meta['pack'] == pack_id
+            members[(meta['offset'], path)] = meta
+        pack = (members, contents.getvalue())
+        with self.pack_cache_lock:
+            self.pack_cache[pack_id] = pack
+            while len(self.pack_cache) > pack_cache_size:
+                del self.pack_cache[next(iter(self.pack_cache))]
+        return pack
+
+    def add_to_pack(self, path, meta, data, res):
+        """ Add a member to the pending pack, which is written once it is large enough """
+        with self.pack_lock:
+            self.pack_pending.append((path, meta, data, res))
+            self.pack_pending_size += len(data)
+            full = self.pack_pending_size >= pack_size
+        if full:
+            self.flush_pack()
+
+    def flush_pack(self):
+        """ Write the pending members into a new pack file and point their metadata to it """
+        with self.pack_lock:
+            members = self.pack_pending
+            self.pack_pending = []
+            self.pack_pending_size = 0
+        if not members:
+            return
+        pack_id = randombytes(16)
+        index = []
+        offset = 0
+        for path, meta, data, res in members:
+            index.append(encode_meta(path, dict(meta, pack=pack_id, offset=offset)))
+            offset += len(data)
+        try:
+            self.crypt_pack.mkdir(parents=True, exist_ok=True)
+            file_encrypt(self.crypt_key, b''.join(data for _, _, data, _ in members), self.pack_file(pack_id),
+                         make_pack_index(index), chunk_size, sealed=True, compress=self.compress,
+                         limiter=self.limiter)
+        except:
+            for path, _, _, res in members:
+                if res:
+                    res.log('PUSH FILE', path, error=exc_info())
+            raise
+        for (path, _, _, res), metadata in zip(members, index):
+            crypt_path = path_hash(self.crypt_key, path)
+            crypt_file = self.crypt_dir / crypt_path
+            try:
+                if path in self.included:
+                    self.touch_tree(path)
+                elif res is None:
+                    # A member of a pruned subtree has been moved into a new pack file.
+                    self.journal_path(path)
+                    self.tree_stale = True
+                # The metadata point to the pack file before the file stored on its own is removed.
+                self.write_meta(crypt_path, metadata)
+                if crypt_file.exists():
+                    os.remove(crypt_file)
+                _, self.included[path] = dest_metadata(metadata)
+                if res:
+                    res.log('PUSH FILE', path)
+            except:
+                if res:
+                    res.log('PUSH FILE', path, error=exc_info())
+                raise
+
+    def member_is_live(self, path, pack_id, offset):
+        if path in self.included:
+            meta = self.included[path]
+        else:
+            meta_file = self.crypt_meta / path_hash(self.crypt_key, path)
+            if not meta_file.exists():
+                return False
+            _, meta = dest_metadata(file_decrypt(self.crypt_key, meta_file, None, metadata_only=True))
+        return meta.get('pack', None) == pack_id and meta.get('offset', None) == offset
+
+    def collect_packs(self):
+        """ Drop the dead members of the touched pack files, merging those that are mostly dead """
+        with self.pack_lock:
+            pending = { path for path, _, _, _ in self.pack_pending }
+        merged = []
+        for pack_id in sorted(self.pack_touched):
+            pack_file = self.pack_file(pack_id)
+            if not pack_file.exists():
+                continue
+            entries = self.read_pack_index(pack_id)
+            live = [ (metadata, path, meta) for metadata, path, meta in entries
+                     if path not in pending and self.member_is_live(path, pack_id, meta['offset']) ]
+            total_size = sum(meta['size'] for _, _, meta in entries)
+            live_size = sum(meta['size'] for _, _, meta in live)
+            with self.pack_cache_lock:
+                self.pack_cache.pop(pack_id, None)
+            if not live:
+                os.remove(pack_file)
+            elif live_size < total_size * pack_min_live:
+                contents = io.BytesIO()
+                file_decrypt(self.crypt_key, pack_file, contents)
+                contents = contents.getvalue()
+                for _, path, meta in live:
+                    data = contents[meta['offset'] : meta['offset'] + meta['size']]
+                    del meta['pack'], meta['offset']
+                    self.add_to_pack(path, meta, data, None)
+                merged.append(pack_file)
+            elif len(live) < len(entries):
+                # The index is rewritten into a temporary file renamed into place, so that an
+                # interrupted rewrite does not lose the members of the pack file.
+                file_reseal(self.crypt_key, pack_file, make_pack_index([ metadata for metadata, _, _ in live ]))
+        self.flush_pack()
+        for pack_file in merged:
+            os.remove(pack_file)
+        self.pack_touched = set()
+
+    def rebuild_packs(self):
+        """ Rebuild the metadata of the members of the pack files """
+        if not self.crypt_pack.is_dir():
+            return
+        written = dict()
+        for name in sorted(os.listdir(self.crypt_pack)):
+            if not pack_name_pattern.fullmatch(name):
+                continue
+            pack_id = bytes.fromhex(name)
+            pack_time = os.stat(self.pack_file(pack_id)).st_mtime_ns
+            for metadata, path, meta in self.read_pack_index(pack_id):
+                crypt_path = path_hash(self.crypt_key, path)
+                if path in self.included and path not in written:
+                    written[path] = os.stat(self.crypt_dir / crypt_path).st_mtime_ns
+                if written.get(path, -1) > pack_time:
+                    continue
+                written[path] = pack_time
+                self.write_meta(crypt_path, metadata)
+                self.included[path] = meta
+
+    def object_file(self, object_id):
+        name = object_id.hex()
+        return self.crypt_object / name[0:2] / name[2:4] / name[4:]
+
+    def list_objects(self):
+        """ Return the (object_id, object_file) of the object files """
+        objects = []
+        for cwd, dirs, names in os.walk(self.crypt_object, followlinks=False):
+            dirs[:] = [ d for d in dirs if not d.endswith(object_refs_suffix) ]
+            for name in names:
+                object_file = Path(cwd, name)
+                code = ''.join(object_file.relative_to(self.crypt_object).parts)
+                if len(code) == 64 and object_name_pattern.fullmatch(code[4:]):
+                    objects.append((bytes.fromhex(code), object_file))
+        return objects
+
+    def object_refs_dir(self, object_id):
+        object_file = self.object_file(object_id)
+        return object_file.with_name(object_file.name + object_refs_suffix)
+
+    def object_ref_name(self, path):
+        return generichash(path_encode(path), key=self.object_ref_key).decode('utf-8')
+
+    def object_refs(self, object_id):
+        """ Return the directory of the reference markers of an object file (with object_lock held) """
+        refs_dir = self.object_refs_dir(object_id)
+        if not refs_dir.is_dir():
+            refs = file_decrypt(self.crypt_key, self.object_file(object_id), None, metadata_only=True)
+            self.reset_object_refs(object_id, dest_object_refs(refs))
+        return refs_dir
+
+    def reset_object_refs(self, object_id, paths):
+        """ Replace the reference markers of an object file by those of paths """
+        refs_dir = self.object_refs_dir(object_id)
+        temp_dir = refs_dir.with_name(f'{temp_prefix}{randombytes(8).hex()}')
+        os.makedirs(temp_dir)
+        for path in paths:
+            (temp_dir / self.object_ref_name(path)).touch()
+        if refs_dir.is_dir():
+            shutil.rmtree(refs_dir)
+        os.rename(temp_dir, refs_dir)
+
+    def add_object_ref(self, object_id, path):
+        with self.object_lock:
+            (self.object_refs(object_id) / self.object_ref_name(path)).touch()
+
+    def drop_object_ref(self, object_id, path):
+        """ Drop a reference to an object file, which is removed at the end of the sync if none is left """
+        with self.object_lock:
+            try:
+                refs_dir = self.object_refs(object_id)
+                os.remove(refs_dir / self.object_ref_name(path))
+            except FileNotFoundError:
+                pass
+            self.object_touched.add(object_id)
+
+    def collect_objects(self):
+        """ Remove the touched object files that are no longer referred to """
+        for object_id in sorted(self.object_touched):
+            try:
+                refs_dir = self.object_refs(object_id)
+                if not os.listdir(refs_dir):
+                    os.remove(self.object_file(object_id))
+                    os.rmdir(refs_dir)
+            except FileNotFoundError:
+                pass
+        self.object_touched = set()
+
+    def rebuild_objects(self):
+        """ Rewrite the reference markers of the object files from the collected metadata """
+        if not self.crypt_object.is_dir():
+            return
+        refs = dict()
+        for path, meta in self.included.items():
+            if 'object' in meta:
+                refs.setdefault(meta['object'], []).append(path)
+        for object_id, object_file in self.list_objects():
+            paths = refs.get(object_id, [])
+            if not paths and not self.excluded:
+                os.remove(object_file)
+                shutil.rmtree(self.object_refs_dir(object_id), ignore_errors=True)
+                continue
+            refs_dir = self.object_refs(object_id)
+            names = { self.object_ref_name(path) for path in paths }
+            present = set(os.listdir(refs_dir))
+            for name in names - present:
+                (refs_dir / name).touch()
+            for name in present - names:
+                os.remove(refs_dir / name)
+
+    def index_objects(self):
+        """ Index the object files of the collected paths by their inodes and sizes (with object_lock held) """
+        if self.object_index is None:
+            if self.catalog is None:
+                self.object_index = ObjectIndex()
+                # Other threads may change the dict while it is being indexed.
+                metas = list(self.included.values())
+            else:
+                self.object_index = self.catalog.objects(f'{self.catalog_name}_objects')
+                metas = self.included.values()
+            for meta in metas:
+                self.index_object(meta)
+
+    def index_object(self, meta):
+        if 'object' in meta and self.object_index is not None:
+            self.object_index.add(meta)
 
     def get_path_type(self, path):
         if path in self.included:
@@ -139,9 +1023,18 @@ class DirCrypt(object):
         crypt_path = path_hash(self.crypt_key, path)
         crypt_file = self.crypt_dir / crypt_path
         meta_file = self.crypt_meta / crypt_path
+        self.touch_tree(path, is_dir=is_dir)
         try:
-            os.remove(crypt_file)
+            meta = self.included.get(path, {})
+            if 'pack' in meta:
+                self.pack_touched.add(meta['pack'])
+            else:
+                os.remove(crypt_file)
             os.remove(meta_file)
+            if self.meta_cache:
+                self.meta_cache.discard(crypt_path)
+            if 'object' in meta:
+                self.drop_object_ref(meta['object'], path)
             del self.included[path]
             if is_dir:
                 res.log('REMOVE DIR', path)
@@ -158,13 +1051,10 @@ class DirCrypt(object):
         dir_mode = stat.S_IFDIR | stat.S_IMODE(mode)
         metadata = make_metadata(path, dir_mode, 0, 0)
         crypt_path = path_hash(self.crypt_key, path)
-        crypt_file = self.crypt_dir / crypt_path
-        meta_file = self.crypt_meta / crypt_path
+        self.touch_tree(path, is_dir=True)
         try:
-            os.makedirs(crypt_file.parent, exist_ok=True)
-            file_encrypt(self.crypt_key, None, crypt_file, metadata, chunk_size)
-            os.makedirs(meta_file.parent, exist_ok=True)
-            file_encrypt(self.crypt_key, None, meta_file, metadata, chunk_size)
+            self.write_crypt(self.data_dirs, crypt_path, None, metadata)
+            self.write_meta(crypt_path, metadata)
             self.included[path] = {'mode': dir_mode, 'mtime': 0, 'ctime': 0}
             res.log('ADD DIR', path)
         except:
@@ -172,6 +1062,15 @@ class DirCrypt(object):
             raise
 
     def push_file(self, path, src_file, res):
+        # A file that changes while it is being encrypted is encrypted again, from a new stat.
+        for attempt in range(file_change_retries):
+            try:
+                return self.try_push_file(path, src_file, res)
+            except FileChangedError:
+                pass
+        res.log('PUSH FILE', path, error='DirCrypt: Plaintext file keeps changing')
+
+    def try_push_file(self, path, src_file, res):
         try:
             st = os.stat(src_file, follow_symlinks=False)
         except FileNotFoundError:
@@ -180,35 +1079,237 @@ class DirCrypt(object):
         except:
             res.log('PUSH FILE', path, error=exc_info())
             raise
-        metadata = make_metadata(path, st.st_mode, st.st_mtime_ns, st.st_ctime_ns)
+        if st.st_size < self.pack_threshold and stat.S_ISREG(st.st_mode):
+            self.push_packed(path, src_file, st, res)
+            return
+        if self.dedup and stat.S_ISREG(st.st_mode):
+            self.push_object(path, src_file, st, res)
+            return
+        def make_md(digest):
+            return make_metadata(path, st.st_mode, st.st_mtime_ns, st.st_ctime_ns,
+                                 size=st.st_size, ino=st.st_ino, digest=digest)
         crypt_path = path_hash(self.crypt_key, path)
-        crypt_file = self.crypt_dir / crypt_path
-        meta_file = self.crypt_meta / crypt_path
+        self.touch_tree(path)
         try:
-            os.makedirs(crypt_file.parent, exist_ok=True)
-            file_encrypt(self.crypt_key, src_file, crypt_file, metadata, chunk_size)
-            os.makedirs(meta_file.parent, exist_ok=True)
-            file_encrypt(self.crypt_key, None, meta_file, metadata, chunk_size)
-            self.included[path] = {'mode': st.st_mode, 'mtime': st.st_mtime_ns, 'ctime': st.st_ctime_ns}
+            old_meta = self.included.get(path, {})
+            if 'pack' in old_meta:
+                self.pack_touched.add(old_meta['pack'])
+            metadata = self.write_crypt(self.data_dirs, crypt_path, src_file, make_md,
+                                        sealed=True, pipelined=True, compress=self.compress, limiter=self.limiter,
+                                        plain_stat=st)
+            self.write_meta(crypt_path, metadata)
+            _, self.included[path] = dest_metadata(metadata)
+            if 'object' in old_meta:
+                self.drop_object_ref(old_meta['object'], path)
             res.log('PUSH FILE', path)
         except FileNotFoundError:
             res.log('PUSH FILE', path, error='DirCrypt: Plaintext file does not exist')
             return
+        except FileChangedError:
+            raise
         except:
             res.log('PUSH FILE', path, error=exc_info())
             raise
 
-    def pull_file(self, path, dst_file, res):
+    def push_object(self, path, src_file, st, res):
+        """ Store the contents of src_file as an object file and point the file of path to it """
+        crypt_path = path_hash(self.crypt_key, path)
+        self.touch_tree(path)
+        try:
+            old_meta = self.included.get(path, {})
+            if 'pack' in old_meta:
+                self.pack_touched.add(old_meta['pack'])
+            with self.object_lock:
+                self.index_objects()
+                # A hard link to a stored file need not be read at all.
+                object_id = self.object_index.get(st.st_ino, st.st_size, st.st_mtime_ns)
+                same_size = self.object_index.has_size(st.st_size)
+            if object_id is None and same_size:
+                # Only a file of the same size as a known object file may be a duplicate,
+                # so only such a file is hashed before it is encrypted.
+                object_id = content_digest(self.crypt_key, src_file)
+                check_unchanged(src_file, st)
+            if object_id is not None and self.object_file(object_id).exists():
+                self.add_object_ref(object_id, path)
+                action = 'DEDUP FILE'
+            else:
+                object_id = self.encrypt_object(path, src_file, st)
+                action = 'PUSH FILE'
+            metadata = make_metadata(path, st.st_mode, st.st_mtime_ns, st.st_ctime_ns,
+                                     size=st.st_size, ino=st.st_ino, digest=object_id, object=object_id)
+            self.write_crypt(self.data_dirs, crypt_path, None, metadata)
+            self.write_meta(crypt_path, metadata)
+            _, meta = dest_metadata(metadata)
+            self.included[path] = meta
+            with self.object_lock:
+                self.index_object(meta)
+            if 'object' in old_meta and old_meta['object'] != object_id:
+                self.drop_object_ref(old_meta['object'], path)
+            res.log(action, path)
+        except FileNotFoundError:
+            res.log('PUSH FILE', path, error='DirCrypt: Plaintext file does not exist')
+            return
+        except FileChangedError:
+            raise
+        except:
+            res.log('PUSH FILE', path, error=exc_info())
+            raise
+
+    def encrypt_object(self, path, src_file, st):
+        """ Encrypt src_file into the object file named by its digest and return the digest """
+        self.crypt_object.mkdir(parents=True, exist_ok=True)
+        staging_file = self.crypt_object / f'{temp_prefix}{randombytes(8).hex()}'
+        digests = []
+        def make_refs(digest):
+            digests.append(digest)
+            return make_object_metadata(digest)
+        try:
+            file_encrypt(self.crypt_key, src_file, staging_file, make_refs, chunk_size,
+                         sealed=True, pipelined=True, compress=self.compress, limiter=self.limiter,
+                         plain_stat=st)
+            object_id = digests[0]
+            object_file = self.object_file(object_id)
+            with self.object_lock:
+                exists = object_file.exists()
+                if not exists:
+                    # The reference is recorded before the object file appears, so that it is never unreferenced.
+                    self.reset_object_refs(object_id, [path])
+                    os.rename(staging_file, object_file)
+            if exists:
+                self.add_object_ref(object_id, path)
+            return object_id
+        finally:
+            if staging_file.exists():
+                os.remove(staging_file)
+
+    def push_packed(self, path, src_file, st, res):
+        try:
+            with open(src_file, 'rb') as src_fp:
+                data = src_fp.read()
+                # The metadata should describe the contents that were read.
+                st = os.fstat(src_fp.fileno())
+        except FileNotFoundError:
+            res.log('PUSH FILE', path, error='DirCrypt: Plaintext file does not exist')
+            return
+        except:
+            res.log('PUSH FILE', path, error=exc_info())
+            raise
+        if st.st_size != len(data):
+            raise FileChangedError('file changed while being read')
+        self.touch_tree(path)
+        old_meta = self.included.get(path, {})
+        if 'pack' in old_meta:
+            self.pack_touched.add(old_meta['pack'])
+        if 'object' in old_meta:
+            self.drop_object_ref(old_meta['object'], path)
+        meta = {'mode': st.st_mode, 'mtime': st.st_mtime_ns, 'ctime': st.st_ctime_ns,
+                'size': len(data), 'ino': st.st_ino, 'digest': content_digest(self.crypt_key, data)}
+        self.add_to_pack(path, meta, data, res)
+
+    def file_digest(self, file):
+        return content_digest(self.crypt_key, file)
+
+    def move_file(self, old_path, path, meta, res):
+        """ Move the encrypted file of old_path to path without re-encrypting it, if possible """
+        old_crypt_path = path_hash(self.crypt_key, old_path)
+        old_crypt_file = self.crypt_dir / old_crypt_path
+        old_meta_file = self.crypt_meta / old_crypt_path
         crypt_path = path_hash(self.crypt_key, path)
         crypt_file = self.crypt_dir / crypt_path
-        def md_test(md):
-            p, m, _, _ = dest_metadata(md)
-            return p == path and stat.S_ISREG(m)
+        old_meta = self.included[old_path]
+        if 'pack' in old_meta:
+            # Members of pack files are not moved, because their paths are recorded in the pack index.
+            return False
+        object_id = old_meta.get('object', None)
+        metadata = make_metadata(path, meta['mode'], meta['mtime'], meta['ctime'],
+                                 size=meta.get('size', None), ino=meta.get('ino', None),
+                                 digest=old_meta.get('digest', None), object=object_id)
+        try:
+            if object_id is not None:
+                self.add_object_ref(object_id, path)
+            elif not file_is_sealed(old_crypt_file):
+                return False
+            self.touch_tree(old_path)
+            self.touch_tree(path)
+            os.makedirs(crypt_file.parent, exist_ok=True)
+            if object_id is not None:
+                # The encrypted file of a deduplicated file is only a pointer to its object file.
+                file_encrypt(self.crypt_key, None, crypt_file, metadata, chunk_size)
+                os.remove(old_crypt_file)
+            else:
+                # The ciphertext is copied with the new trailer and renamed into place before the old
+                # file is removed, so that no file ever has a trailer naming the wrong path.
+                file_reseal(self.crypt_key, old_crypt_file, metadata, crypt_file)
+                os.remove(old_crypt_file)
+            self.write_meta(crypt_path, metadata)
+            os.remove(old_meta_file)
+            if self.meta_cache:
+                self.meta_cache.discard(old_crypt_path)
+            if object_id is not None:
+                self.drop_object_ref(object_id, old_path)
+            del self.included[old_path]
+            _, self.included[path] = dest_metadata(metadata)
+            res.log('MOVE FILE', f'{old_path} -> {path}')
+            return True
+        except:
+            res.log('MOVE FILE', f'{old_path} -> {path}', error=exc_info())
+            raise
+
+    def read_ahead(self, crypt_file):
+        read_ahead(crypt_file)
+
+    def prefetch(self, paths, count, nbytes):
+        """ Start reading ahead the encrypted files of paths, which are about to be pulled """
+        self.stop_prefetch()
+        files = []
+        index = dict()
+        self.prefetch_index = dict()
+        for path in paths:
+            meta = self.included.get(path, {})
+            if 'pack' in meta:
+                crypt_file, size = self.pack_file(meta['pack']), pack_size
+            elif 'object' in meta:
+                crypt_file, size = self.object_file(meta['object']), meta.get('size', 0)
+            else:
+                crypt_file, size = self.crypt_dir / path_hash(self.crypt_key, path), meta.get('size', 0)
+            if crypt_file not in index:
+                index[crypt_file] = len(files)
+                files.append((crypt_file, size))
+            self.prefetch_index[path] = index[crypt_file]
+        self.prefetcher = Prefetcher(files, self.read_ahead, count, nbytes)
+
+    def stop_prefetch(self):
+        if self.prefetcher:
+            self.prefetcher.stop()
+            self.prefetcher = None
+            self.prefetch_index = dict()
+
+    def pull_file(self, path, dst_file, res):
+        if self.prefetcher and path in self.prefetch_index:
+            self.prefetcher.consume(self.prefetch_index[path])
+        meta = self.included.get(path, {})
+        if 'pack' in meta:
+            self.pull_packed(path, dst_file, res)
+            return
+        if 'object' in meta:
+            crypt_file = self.object_file(meta['object'])
+            def md_test(md):
+                object_id = dest_object_metadata(md)
+                if object_id is not None:
+                    return object_id == meta['object']
+                return path in dest_object_refs(md)
+        else:
+            crypt_file = self.crypt_dir / path_hash(self.crypt_key, path)
+            def md_test(md):
+                p, m = dest_metadata(md)
+                return p == path and stat.S_ISREG(m['mode'])
         try:
-            metadata = file_decrypt(self.crypt_key, crypt_file, dst_file, metadata_test=md_test)
-            _, mode, mtime, _ = dest_metadata(metadata)
-            os.chmod(dst_file, stat.S_IMODE(mode))
-            os.utime(dst_file, ns=(mtime, mtime))
+            metadata = file_decrypt(self.crypt_key, crypt_file, dst_file, metadata_test=md_test, pipelined=True,
+                                    limiter=self.limiter)
+            if 'object' not in meta:
+                _, meta = dest_metadata(metadata)
+            os.chmod(dst_file, stat.S_IMODE(meta['mode']))
+            os.utime(dst_file, ns=(meta['mtime'], meta['mtime']))
             res.log('COPY FILE', path)
         except FileNotFoundError:
             if not crypt_file.exists():
@@ -223,3 +1324,33 @@ class DirCrypt(object):
         except:
             res.log('PULL FILE', path, error=exc_info())
             raise
+
+    def pull_packed(self, path, dst_file, res):
+        meta = self.included[path]
+        try:
+            members, contents = self.load_pack(meta['pack'])
+            if (meta['offset'], path) not in members:
+                res.log('PULL FILE', path, error='DirCrypt: Packed file does not exist')
+                return
+            m = members[(meta['offset'], path)]
+            assert stat.S_ISREG(m['mode'])
+            with temp_file(os.path.dirname(dst_file)) as plain_fp:
+                plain_fp.write(contents[m['offset'] : m['offset'] + m['size']])
+                plain_fp.flush()
+                install_file(plain_fp, dst_file)
+            os.chmod(dst_file, stat.S_IMODE(m['mode']))
+            os.utime(dst_file, ns=(m['mtime'], m['mtime']))
+            res.log('COPY FILE', path)
+        except FileNotFoundError:
+            if not self.pack_file(meta['pack']).exists():
+                res.log('PULL FILE', path, error='DirCrypt: Encrypted pack file does not exist')
+                return
+            elif not dst_file.parent.exists():
+                res.log('PULL FILE', path, error='DirCrypt: Plaintext directory does not exist')
+                return
+            else:
+                res.log('PULL FILE', path, error=exc_info())
+                raise
+        except:
+            res.log('PULL FILE', path, error=exc_info())
+            raise
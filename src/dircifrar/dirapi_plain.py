@@ -1,10 +1,24 @@
 
+from .exclude import Excluder
+from .filecrypt import temp_prefix
+from .throttle import throttled_copy
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 import os, sys, stat, shutil
 
 def exc_info():
     return str(sys.exc_info()[1])
 
+def path_meta(st):
+    if stat.S_ISDIR(st.st_mode):
+        # We do not care about the timestamps of directories.
+        return { 'mode': st.st_mode, 'mtime': 0, 'ctime': 0 }
+    return { 'mode': st.st_mode,
+             'mtime': st.st_mtime_ns,
+             'ctime': st.st_ctime_ns,
+             'size': st.st_size,
+             'ino': st.st_ino }
+
 class DirPlain(object):
     """ API for accessing an unencrypted directory """
 
@@ -12,35 +26,137 @@ class DirPlain(object):
         self.dir_type = 'plain'
         self.dir_root = dir_root
         self.version = version
-        self.exclude = exclude
+        self.exclude = exclude if isinstance(exclude, Excluder) else Excluder(exclude)
         self.config = config
+        # The token bucket limiting the rate of copying files, if any.
+        self.limiter = None
+        # The number of directories scanned concurrently by collect_paths.
+        self.scan_jobs = 1
+        # The Catalog keeping the collected paths on disk, if any, in tables prefixed by catalog_name.
+        self.catalog = None
+        self.catalog_name = 'plain'
+
+    def new_included(self):
+        """ An empty mapping of collected paths to their metadata, kept in the catalog if any """
+        if self.catalog is None:
+            return dict()
+        return self.catalog.mapping(f'{self.catalog_name}_included')
+
+    def new_excluded(self):
+        if self.catalog is None:
+            return set()
+        return self.catalog.set(f'{self.catalog_name}_excluded')
 
     def collect_paths(self):
-        self.included = dict()
-        self.excluded = set()
+        self.included = self.new_included()
+        self.excluded = self.new_excluded()
+        if self.scan_jobs > 1:
+            self.collect_parallel()
+            return
         for cwd, dirs, files in os.walk(self.dir_root, followlinks=False):
-            for d in dirs:
+            for d in list(dirs):
                 path = Path(os.path.relpath(os.path.join(cwd, d), self.dir_root))
-                if any(pat.fullmatch(d) for pat in self.exclude):
+                if self.exclude.excludes(path, is_dir=True):
                     self.excluded.add(path)
                     # This prevents os.walk from walking excluded directories.
                     dirs.remove(d)
                 else:
                     st = os.stat(self.dir_root / path, follow_symlinks=False)
-                    self.included[path] = { 'mode': st.st_mode,
-                                            # We do not care about the timestamps of directories.
-                                            'mtime': 0,
-                                            'ctime': 0 }
+                    self.included[path] = path_meta(st)
+                    if self.exclude.prunes(path):
+                        # All contents of the directory are excluded, so it need not be walked.
+                        dirs.remove(d)
             for f in files:
+                if f.startswith(temp_prefix):
+                    # A file being decrypted into this directory, or left behind by an interrupted pull.
+                    continue
                 path = Path(os.path.relpath(os.path.join(cwd, f), self.dir_root))
                 st = os.stat(self.dir_root / path, follow_symlinks=False)
                 # Only regular files are currently covered.
-                if any(pat.fullmatch(f) for pat in self.exclude) or not stat.S_ISREG(st.st_mode):
+                if self.exclude.excludes(path) or not stat.S_ISREG(st.st_mode):
                     self.excluded.add(path)
                 else:
-                    self.included[path] = { 'mode': st.st_mode,
-                                            'mtime': st.st_mtime_ns,
-                                            'ctime': st.st_ctime_ns }
+                    self.included[path] = path_meta(st)
+
+    def collect_subtrees(self, subpaths):
+        """ Collect only the paths in the subtrees rooted at subpaths and their ancestors """
+        self.included = dict()
+        self.excluded = set()
+        tops = []
+        for subpath in sorted(subpaths):
+            for path in list(reversed(subpath.parents))[1:] + [subpath]:
+                if path not in self.included and path not in self.excluded:
+                    try:
+                        st = os.stat(self.dir_root / path, follow_symlinks=False)
+                    except FileNotFoundError:
+                        break
+                    is_dir = stat.S_ISDIR(st.st_mode)
+                    if self.exclude.excludes(path, is_dir=is_dir) or not (is_dir or stat.S_ISREG(st.st_mode)):
+                        self.excluded.add(path)
+                    else:
+                        self.included[path] = path_meta(st)
+                if path in self.excluded or self.get_path_type(path) != 'DIR' or self.exclude.prunes(path):
+                    break
+            else:
+                tops.append(subpath)
+        if tops:
+            self.collect_parallel(tops)
+
+    def collect_parallel(self, tops=(Path(),)):
+        """ Collect the paths like collect_paths, scanning up to scan_jobs directories at a time """
+        with ThreadPoolExecutor(max_workers=max(1, self.scan_jobs)) as executor:
+            pending = { executor.submit(self.scan_dir, top) for top in tops }
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    included, excluded, subdirs = future.result()
+                    self.included.update(included)
+                    self.excluded.update(excluded)
+                    pending.update(executor.submit(self.scan_dir, path) for path in subdirs)
+
+    def scan_dir(self, dir_path):
+        """ Scan dir_path and return the paths it includes and excludes and its subdirectories """
+        included = dict()
+        excluded = set()
+        subdirs = []
+        try:
+            entries = list(os.scandir(self.dir_root / dir_path))
+        except OSError:
+            # Like os.walk, a directory that cannot be read is skipped.
+            return (included, excluded, subdirs)
+        for entry in entries:
+            path = dir_path / entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if self.exclude.excludes(path, is_dir=True):
+                    excluded.add(path)
+                    continue
+                included[path] = path_meta(entry.stat(follow_symlinks=False))
+                # A symbolic link to a directory is not followed.
+                if not self.exclude.prunes(path) and not entry.is_symlink():
+                    subdirs.append(path)
+            elif not entry.name.startswith(temp_prefix):
+                st = entry.stat(follow_symlinks=False)
+                if self.exclude.excludes(path) or not stat.S_ISREG(st.st_mode):
+                    excluded.add(path)
+                else:
+                    included[path] = path_meta(st)
+        return (included, excluded, subdirs)
+
+    def update_path(self, path):
+        """ Bring the collected metadata of path up to date and return whether path is included """
+        try:
+            st = os.stat(self.dir_root / path, follow_symlinks=False)
+        except FileNotFoundError:
+            st = None
+        if st is None or not (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+            self.included.pop(path, None)
+            return False
+        self.included[path] = path_meta(st)
+        return True
 
     def get_path_type(self, path):
         if path in self.included:
@@ -93,12 +209,31 @@ class DirPlain(object):
             res.log('ADD DIR', path, error=exc_info())
             raise
 
+    def move_file(self, old_path, path, meta, res):
+        old_file = self.dir_root / old_path
+        plain_file = self.dir_root / path
+        try:
+            os.rename(old_file, plain_file)
+            os.chmod(plain_file, stat.S_IMODE(meta['mode']))
+            os.utime(plain_file, ns=(meta['mtime'], meta['mtime']))
+            res.log('MOVE FILE', f'{old_path} -> {path}')
+            return True
+        except:
+            res.log('MOVE FILE', f'{old_path} -> {path}', error=exc_info())
+            raise
+
     # shutil.copy2 copies both file contents and metadata.
 
+    def copy_file(self, src_file, dst_file):
+        if self.limiter and not os.path.islink(src_file):
+            throttled_copy(src_file, dst_file, self.limiter)
+        else:
+            shutil.copy2(src_file, dst_file, follow_symlinks=False)
+
     def push_file(self, path, src_file, res):
         dst_file = self.dir_root / path
         try:
-            shutil.copy2(src_file, dst_file, follow_symlinks=False)
+            self.copy_file(src_file, dst_file)
             res.log('COPY FILE', path)
         except:
             res.log('COPY FILE', path, error=exc_info())
@@ -107,7 +242,7 @@ class DirPlain(object):
     def pull_file(self, path, dst_file, res):
         src_file = self.dir_root / path
         try:
-            shutil.copy2(src_file, dst_file, follow_symlinks=False)
+            self.copy_file(src_file, dst_file)
             res.log('COPY FILE', path)
         except:
             res.log('COPY FILE', path, error=exc_info())
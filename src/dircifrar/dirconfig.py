@@ -3,11 +3,14 @@ from .__init__ import (
     __pkg_name__,
     __pkg_version__,
     __config_filename__,
+    __crypt_format__,
     __crypt_metadir__,
     __crypt_dirname__,
 )
 from .dirapi_plain import DirPlain
-from .dirapi_crypt import DirCrypt
+from .dirapi_crypt import DirCrypt, manifest_version
+from .compression import check_algorithm
+from .exclude import Excluder
 
 from nacl.utils import random as randombytes
 from nacl.pwhash import argon2i
@@ -16,7 +19,7 @@ from nacl.bindings import crypto_secretstream_xchacha20poly1305_KEYBYTES as KEYB
 
 from getpass import getpass
 from pathlib import Path
-import json, re
+import json
 
 def wrap_master_key(master_key, version, password,
                     kdf_opslimit=argon2i.OPSLIMIT_MODERATE,
@@ -52,7 +55,7 @@ def make_plain_config(version, exclude):
         'exclude': exclude,
     }
 
-def make_crypt_config(version, exclude, password):
+def make_crypt_config(version, exclude, password, compress=None, pack_threshold=None, dedup=False):
     random_data = randombytes(KEYBYTES)
     kdf_salt = randombytes(argon2i.SALTBYTES)
     master_key = argon2i.kdf(KEYBYTES, random_data, kdf_salt,
@@ -62,8 +65,12 @@ def make_crypt_config(version, exclude, password):
     return {
         'dir_type': 'crypt',
         'version': version,
+        'format': __crypt_format__,
         'exclude': exclude,
         'master_key_wrap': wrap,
+        'compress': compress,
+        'pack_threshold': pack_threshold,
+        'dedup': dedup,
     }
 
 def ask_password(dir_root):
@@ -78,7 +85,7 @@ def choose_password(dir_root):
     else:
         raise ValueError(f"Error: you typed two different passowords")
 
-def init_config(dir_type, dir_path, exclude, overwrite):
+def init_config(dir_type, dir_path, exclude, overwrite, compress=None, pack_threshold=None, dedup=False):
     dir_path = Path(dir_path).resolve()
     if dir_path.exists() and not dir_path.is_dir():
         raise ValueError(f"Error: {dir_path} exists but is not a directory")
@@ -89,11 +96,19 @@ def init_config(dir_type, dir_path, exclude, overwrite):
             print(f"Warning: existing {config_file} is overwritten")
         else:
             raise ValueError(f"Error: {config_file} already exists")
+    if compress:
+        if dir_type != 'crypt':
+            raise ValueError(f"Error: compression is only supported for encrypted directories")
+        check_algorithm(compress)
+    if dedup and dir_type != 'crypt':
+        raise ValueError(f"Error: deduplication is only supported for encrypted directories")
+    if pack_threshold is not None and pack_threshold < 0:
+        raise ValueError(f"Error: the pack threshold must not be negative")
     if dir_type == 'plain':
         config = make_plain_config(__pkg_version__, exclude)
     elif dir_type == 'crypt':
         password = choose_password(dir_path)
-        config = make_crypt_config(__pkg_version__, exclude, password)
+        config = make_crypt_config(__pkg_version__, exclude, password, compress, pack_threshold, dedup)
     else:
         raise ValueError(f"Error: {dir_type} is not a supported directory type")
     with open(config_file, 'w') as f:
@@ -132,13 +147,14 @@ def crypt_change_password(dir_path):
 
 # The optional argument 'test_key' is only for testing.
 
-def open_dirapi(dir_path, test_key=None):
+def open_dirapi(dir_path, test_key=None, crypt_key=None):
     if not dir_path.is_dir():
         raise ValueError(f"Error: {dir_path} does not exist or is not a directory")
 
     # When testing DirCrypt API, we want avoid the (intentional) overhead of KDF.
     if test_key:
-        return DirCrypt(dir_path, __pkg_version__, [], {}, test_key)
+        return DirCrypt(dir_path, __pkg_version__, [], {'format': __crypt_format__, 'manifests': manifest_version},
+                        test_key)
 
     config_file = dir_path / __config_filename__
     try:
@@ -159,16 +175,22 @@ def open_dirapi(dir_path, test_key=None):
         exclude = []
     if dir_type == 'crypt' and version <= '0.0.2':
         raise ValueError(f"Error: the encrypted directory is from version 0.0.2 or earlier, which is not supported anymore")
+    if dir_type == 'crypt':
+        crypt_format = config.get('format', 1)
+        if crypt_format > __crypt_format__:
+            raise ValueError(f"Error: the encrypted directory is in format {crypt_format}, which needs a later version of {__pkg_name__}")
     exclude = set(exclude + [__config_filename__])
-    exclude = [ re.compile(pat) for pat in exclude ]
+    exclude = Excluder(sorted(exclude))
     if dir_type == 'plain':
         return DirPlain(dir_path, version, exclude, config)
     elif dir_type == 'crypt':
-        password = ask_password(dir_path)
-        master_key, version_1 = unwrap_master_key(config['master_key_wrap'], password)
-        if version_1 != version:
-            raise ValueError(f"Error: {config_file} version check failed")
-        return DirCrypt(dir_path, version, exclude, config, master_key)
+        # The master key may have been unwrapped already, as by the coordinator of worker processes.
+        if not crypt_key:
+            password = ask_password(dir_path)
+            crypt_key, version_1 = unwrap_master_key(config['master_key_wrap'], password)
+            if version_1 != version:
+                raise ValueError(f"Error: {config_file} version check failed")
+        return DirCrypt(dir_path, version, exclude, config, crypt_key)
     else:
         raise ValueError(f"Error: {dir_type} is not a supported directory type")
 
@@ -178,4 +200,5 @@ def crypt_rebuild_meta(dir_path):
         raise ValueError(f"Error: {dir_path} does not exist or is not a directory")
     crypt_api = open_dirapi(dir_path)
     assert(crypt_api.dir_type == 'crypt')
+    crypt_api.upgrade_format()
     crypt_api.collect_paths(rebuild_meta=True)
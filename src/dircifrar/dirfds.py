@@ -0,0 +1,98 @@
+
+from collections import OrderedDict
+import os, threading
+
+# The number of directory fds kept open by each DirFds.
+dir_fds_size = 128
+
+class DirFds(object):
+    """ Thread-safe LRU cache of the open fds of the directories under root """
+
+    def __init__(self, root, size=dir_fds_size):
+        self.root = root
+        self.size = size
+        self.lock = threading.Lock()
+        self.root_fd = None
+        # The [fd, number of users] of each open directory, from the least recently used one.
+        self.entries = OrderedDict()
+
+    def open(self, path):
+        """ Return an fd of the directory path relative to root, which must be released once done with """
+        name = os.fspath(path)
+        with self.lock:
+            entry = self.entries.get(name, None)
+            if entry is not None:
+                self.entries.move_to_end(name)
+                entry[1] += 1
+                return entry[0]
+            if self.root_fd is None:
+                os.makedirs(self.root, exist_ok=True)
+                self.root_fd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY)
+            root_fd = self.root_fd
+        try:
+            fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=root_fd)
+        except FileNotFoundError:
+            self.make_dirs(name, root_fd)
+            fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=root_fd)
+        with self.lock:
+            entry = self.entries.get(name, None)
+            if entry is not None:
+                # Another thread has opened the same directory meanwhile.
+                os.close(fd)
+                entry[1] += 1
+                return entry[0]
+            self.entries[name] = [fd, 1]
+            self.evict()
+        return fd
+
+    def release(self, path):
+        with self.lock:
+            entry = self.entries.get(os.fspath(path), None)
+            if entry is not None:
+                entry[1] -= 1
+                self.evict()
+
+    def make_dirs(self, name, root_fd):
+        parts = name.split(os.sep)
+        for i in range(1, len(parts) + 1):
+            try:
+                os.mkdir(os.sep.join(parts[:i]), dir_fd=root_fd)
+            except FileExistsError:
+                pass
+
+    def evict(self):
+        excess = len(self.entries) - self.size
+        for name in list(self.entries):
+            if excess <= 0:
+                break
+            fd, users = self.entries[name]
+            if users == 0:
+                del self.entries[name]
+                os.close(fd)
+                excess -= 1
+
+    def close(self):
+        """ Close all of the fds, which must not be in use; they are opened again when needed """
+        with self.lock:
+            for fd, _ in self.entries.values():
+                os.close(fd)
+            self.entries = OrderedDict()
+            if self.root_fd is not None:
+                os.close(self.root_fd)
+                self.root_fd = None
+
+    def __call__(self, path):
+        return DirFd(self, path)
+
+class DirFd(object):
+    """ Context manager returning an fd of DirFds """
+
+    def __init__(self, dir_fds, path):
+        self.dir_fds = dir_fds
+        self.path = path
+
+    def __enter__(self):
+        return self.dir_fds.open(self.path)
+
+    def __exit__(self, *args):
+        self.dir_fds.release(self.path)
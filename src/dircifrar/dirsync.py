@@ -1,15 +1,79 @@
 
+from .catalog import Catalog, CatalogSet, catalog_page
 from .dirconfig import open_dirapi
+from .filecrypt import path_hash
+from .fanout import Fanout
+from .metacache import MetaCache, default_cache_file
+from .schedule import Scheduler
+from .throttle import TokenBucket
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import chain, islice
 from pathlib import Path
-import re, sys
+import os, re, sys, stat, asyncio, logging, functools, hashlib, threading
 
 time_resolution_ns = 10000  # in nanoseconds
+# The destination directory is brought up to date after every checkpoint_ops operations of a phase,
+# so that an interrupted synchronization loses little of its work.
+checkpoint_ops = 1000
+
+def by_depth(paths, reverse=False):
+    """ Group paths into sorted lists of paths of the same depth, from shallowest to deepest """
+    levels = dict()
+    for path in paths:
+        levels.setdefault(len(path.parts), []).append(path)
+    return [ sorted(levels[depth]) for depth in sorted(levels, reverse=reverse) ]
+
+def in_order(paths, reverse=False):
+    """ The paths in sorted order, which are read in order from a CatalogSet rather than sorted in memory """
+    if isinstance(paths, CatalogSet):
+        return paths.ordered(reverse)
+    return sorted(paths, reverse=reverse)
+
+def phases_of(ops, streamed):
+    """ The phase of ops, split into phases of at most catalog_page operations if streamed """
+    if not streamed:
+        yield list(ops)
+        return
+    ops = iter(ops)
+    while True:
+        phase = list(islice(ops, catalog_page))
+        if not phase:
+            return
+        yield phase
+
+def normalize_subpaths(subpaths):
+    """ Normalize the subpaths of a synchronization, or return None for the whole directory """
+    if not subpaths:
+        return None
+    paths = set()
+    for subpath in subpaths:
+        path = Path(os.path.normpath(subpath))
+        if path.is_absolute() or path.parts[0] == '..':
+            raise ValueError(f"Error: {subpath} is not a relative path inside the directory")
+        if path == Path():
+            return None
+        paths.add(path)
+    return { path for path in paths if not any(parent in paths for parent in path.parents) }
+
+def in_subtrees(path, subpaths):
+    return path in subpaths or any(parent in subpaths for parent in path.parents)
+
+def plain_digest(file, chunk_size=2 ** 16):
+    hasher = hashlib.blake2b(digest_size=32)
+    with open(file, 'rb') as fp:
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.digest()
 
 class DirCmp(object):
     """ Object for recording the result of directory comparison """
 
     def __init__(self, src_dir, dst_dir, src_exc, dst_exc,
-                 src_only, dst_only, changed, truly_changed):
+                 src_only, dst_only, changed, truly_changed, moved=None):
         self.src_dir = src_dir
         self.dst_dir = dst_dir
         self.src_exc = src_exc
@@ -18,6 +82,8 @@ class DirCmp(object):
         self.dst_only = dst_only
         self.changed = changed
         self.truly_changed = truly_changed
+        # moved maps the new path of each moved file to its old path.
+        self.moved = moved if moved is not None else dict()
 
     def output(self, logger, verbose):
         def src_file(path):
@@ -27,15 +93,17 @@ class DirCmp(object):
         logger.info(f"SOURCE DIR: {self.src_dir}")
         logger.info(f"TARGET DIR: {self.dst_dir}")
         if verbose:
-            for path in sorted(self.src_exc):
+            for path in in_order(self.src_exc):
                 logger.info(f"EXCLUDE: {src_file(path)}")
-            for path in sorted(self.dst_exc):
+            for path in in_order(self.dst_exc):
                 logger.info(f"EXCLUDE: {dst_file(path)}")
-        for path in sorted(self.src_only):
+        for path in sorted(self.moved):
+            logger.info(f"MOVE: {dst_file(self.moved[path])} -> {dst_file(path)}")
+        for path in in_order(self.src_only):
             logger.info(f"ADD: {src_file(path)} -> {dst_file(path)}")
-        for path in sorted(self.truly_changed):
+        for path in in_order(self.truly_changed):
             logger.info(f"COPY: {src_file(path)} -> {dst_file(path)}")
-        for path in sorted(self.dst_only):
+        for path in in_order(self.dst_only):
             logger.info(f"REMOVE: {dst_file(path)}")
         
 class DirSyncRes(object):
@@ -43,13 +111,33 @@ class DirSyncRes(object):
 
     def __init__(self, logger):
         self.logger = logger
+        self.lock = threading.Lock()
+        self.counts = dict()
+        self.errors = 0
+        self.nbytes = 0
 
     def log(self, msg, path, error=None):
         if error:
+            with self.lock:
+                self.errors += 1
             self.logger.error(f'{msg}: {path} -> ERROR: {error}')
         else:
+            with self.lock:
+                self.counts[msg] = self.counts.get(msg, 0) + 1
             self.logger.info(f'{msg}: {path}')
 
+    def add_bytes(self, file):
+        try:
+            size = os.stat(file, follow_symlinks=False).st_size
+        except OSError:
+            return
+        with self.lock:
+            self.nbytes += size
+
+    @property
+    def copied(self):
+        return self.counts.get('PUSH FILE', 0) + self.counts.get('COPY FILE', 0)
+
 class AbsDirSync(object):
     """ Object for comparing and synchronizing two directories """
 
@@ -62,6 +150,20 @@ class AbsDirSync(object):
         self.diffonly = options.get('diffonly', False)
         self.verbose = options.get('verbose', False)
         self.use_ctime = options.get('use_ctime', False)
+        # If collected is set, the paths of the source directory have already been collected.
+        self.collected = options.get('collected', False)
+        self.detect_renames = options.get('detect_renames', True)
+        # If subpaths is given, only the subtrees rooted at these paths are synchronized.
+        self.subpaths = normalize_subpaths(options.get('subpaths', None))
+        self.prefetch = options.get('prefetch', 0) or 0
+        self.prefetch_bytes = options.get('prefetch_bytes', None) or 2 ** 28
+        self.ops_limiter = options.get('ops_limiter', None) or TokenBucket(options.get('ops_rate', None))
+        # The files to be copied are ordered by a scheduler if a policy other than path order is given.
+        order = options.get('order', None) or 'path'
+        priority = options.get('priority', None) or []
+        self.scheduler = Scheduler(order, priority) if order != 'path' or priority else None
+        self.file_digest = getattr(dst_api, 'file_digest', None) or \
+                           getattr(src_api, 'file_digest', None) or plain_digest
 
     def compare_file_times(self, path):
         """
@@ -77,13 +179,60 @@ class AbsDirSync(object):
         else:
             return mtime_cmp
 
+    def collect_paths(self):
+        """ Collect the paths of both directories and return the set of pruned subtrees """
+        if self.use_ctime:
+            # Tree digests do not cover ctimes.
+            self.collect_src()
+            self.collect_api(self.dst_api)
+            return set()
+        if self.src_api.dir_type == 'crypt' and self.dst_api.dir_type == 'plain':
+            self.collect_api(self.dst_api)
+            self.collect_api(self.src_api, reference=self.dst_api.included)
+            return self.src_api.pruned
+        if self.src_api.dir_type == 'plain' and self.dst_api.dir_type == 'crypt':
+            self.collect_src()
+            self.collect_api(self.dst_api, reference=self.src_api.included)
+            return self.dst_api.pruned
+        self.collect_src()
+        self.collect_api(self.dst_api)
+        return set()
+
+    def collect_src(self):
+        if not self.collected:
+            self.collect_api(self.src_api)
+
+    def collect_api(self, api, reference=None):
+        """ Collect the paths of api, or only those in the subtrees of subpaths if given """
+        options = {} if reference is None else {'reference': reference}
+        if self.subpaths is None:
+            api.collect_paths(**options)
+        else:
+            api.collect_subtrees(self.subpaths, **options)
+
     def compare_dirs(self):
         """ Compare two directories """
-        self.src_api.collect_paths()
-        src_inc = set(self.src_api.included.keys())
+        pruned = self.collect_paths()
+        catalog = getattr(self.src_api.included, 'catalog', None)
+        if catalog is not None and catalog is getattr(self.dst_api.included, 'catalog', None):
+            return self.compare_catalog(catalog, pruned)
+        def unpruned(paths):
+            if not pruned:
+                return set(paths)
+            return { path for path in paths if not any(parent in pruned for parent in path.parents) }
+        src_inc = unpruned(self.src_api.included.keys())
+        dst_inc = unpruned(self.dst_api.included.keys())
+        if self.subpaths is not None:
+            # The ancestors of subpaths are made in the destination directory if needed, but never removed.
+            ancestors = { parent for subpath in self.subpaths for parent in subpath.parents } - { Path() }
+            src_dirs = { path for path in ancestors if self.src_api.get_path_type(path) == 'DIR' }
+            src_inc = { path for path in src_inc if path in src_dirs or in_subtrees(path, self.subpaths) }
+            dst_inc = { path for path in dst_inc if path in src_dirs or in_subtrees(path, self.subpaths) }
+        return self.compare_paths(src_inc, dst_inc)
+
+    def compare_paths(self, src_inc, dst_inc):
+        """ Compare the paths src_inc of the source directory with the paths dst_inc of the destination directory """
         src_exc = self.src_api.excluded
-        self.dst_api.collect_paths()
-        dst_inc = set(self.dst_api.included.keys())
         dst_exc = self.dst_api.excluded
         common_inc = src_inc & dst_inc
         src_only = src_inc - common_inc
@@ -97,43 +246,299 @@ class AbsDirSync(object):
                 changed.add(path)
                 if (src_type != dst_type) or (src_type == 'FILE'):
                     truly_changed.add(path)
+        moved = self.match_moves(src_only, dst_only, changed)
+        src_only -= set(moved.keys())
+        dst_only -= set(moved.values())
         return DirCmp(self.src_api.dir_root, self.dst_api.dir_root, \
-                      src_exc, dst_exc, src_only, dst_only, changed, truly_changed)
+                      src_exc, dst_exc, src_only, dst_only, changed, truly_changed, moved)
 
-    def sync_dirs(self):
-        """ Synchronize two directories """
-        dcmp = self.compare_dirs()
-        if self.diffonly:
-            dcmp.output(self.logger, self.verbose)
-            return
-        res = DirSyncRes(self.logger)
-        # dcmp.dst_only is sorted in reverse order because the contents of a directory
-        # should be removed before the directory itself is removed.
-        for path in sorted(dcmp.dst_only, reverse=True):
-            dst_type = self.dst_api.get_path_type(path)
-            if (dst_type == 'DIR'):
-                self.dst_api.remove_dir(path, res)
-            elif (dst_type == 'FILE'):
-                self.dst_api.remove_file(path, res)
-        for path in sorted(dcmp.changed):
+    def compare_catalog(self, catalog, pruned):
+        """ Compare the two directories like compare_paths, by joins in the catalog """
+        src_inc = self.src_api.included
+        dst_inc = self.dst_api.included
+        for path in pruned:
+            dst_inc.prune(path)
+        # The tables are named after the destination, whose paths are not shared with other syncs.
+        src_only, dst_only, changed, truly_changed = \
+            [ catalog.set(f'{self.dst_api.catalog_name}_{name}')
+              for name in ('src_only', 'dst_only', 'changed', 'truly_changed') ]
+        catalog.compare(src_inc, dst_inc, src_only, dst_only, changed, truly_changed,
+                        time_resolution_ns, self.use_ctime)
+        # The paths of the source may be shared with other syncs, so its pruned paths are dropped from the result.
+        for path in pruned:
+            src_only.prune(path)
+        moved = dict()
+        if self.detect_renames and hasattr(self.dst_api, 'move_file'):
+            matched = set()
+            for path, old_paths in catalog.move_candidates(src_only, src_inc, dst_only, dst_inc):
+                # A parent that is changed from a file to a directory does not exist yet when files are moved.
+                if any(parent in changed for parent in path.parents):
+                    continue
+                for old_path in old_paths:
+                    if old_path not in matched and self.same_contents(path, old_path):
+                        moved[path] = old_path
+                        matched.add(old_path)
+                        break
+        for path, old_path in moved.items():
+            src_only.discard(path)
+            dst_only.discard(old_path)
+        return DirCmp(self.src_api.dir_root, self.dst_api.dir_root, self.src_api.excluded, self.dst_api.excluded,
+                      src_only, dst_only, changed, truly_changed, moved)
+
+    def move_key(self, api, path):
+        meta = api.included[path]
+        if api.get_path_type(path) != 'FILE' or 'size' not in meta:
+            return None
+        return (meta['size'], meta['mtime'])
+
+    def get_digest(self, api, path):
+        meta = api.included[path]
+        if 'digest' not in meta and api.dir_type == 'plain':
+            try:
+                meta['digest'] = self.file_digest(api.dir_root / path)
+            except OSError:
+                return None
+        return meta.get('digest', None)
+
+    def same_contents(self, path, old_path):
+        """ Check if src/path has the same contents as dst/old_path """
+        src_meta = self.src_api.included[path]
+        dst_meta = self.dst_api.included[old_path]
+        if src_meta.get('ino', None) is not None and src_meta.get('ino', None) == dst_meta.get('ino', None):
+            return True
+        src_digest = self.get_digest(self.src_api, path)
+        return src_digest is not None and src_digest == self.get_digest(self.dst_api, old_path)
+
+    def match_moves(self, src_only, dst_only, changed):
+        """ Match the files of dst_only with the files of src_only they can be moved to """
+        moved = dict()
+        if not self.detect_renames or not hasattr(self.dst_api, 'move_file'):
+            return moved
+        removed = dict()
+        for path in sorted(dst_only):
+            key = self.move_key(self.dst_api, path)
+            if key:
+                removed.setdefault(key, []).append(path)
+        if not removed:
+            return moved
+        for path in sorted(src_only):
+            key = self.move_key(self.src_api, path)
+            # A parent that is changed from a file to a directory does not exist yet when files are moved.
+            if key not in removed or any(parent in changed for parent in path.parents):
+                continue
+            for old_path in removed[key]:
+                if self.same_contents(path, old_path):
+                    moved[path] = old_path
+                    removed[key].remove(old_path)
+                    break
+        return moved
+
+    def sync_phases(self, dcmp, res):
+        """ Generate the phases of a synchronization, each a list of independent (kind, path, op) """
+        def make_dir(path):
+            return functools.partial(self.dst_api.make_dir, path, self.src_api.get_path_mode(path), res)
+        def move_file(path):
+            old_path = dcmp.moved[path]
+            if not self.dst_api.move_file(old_path, path, self.src_api.included[path], res):
+                dcmp.src_only.add(path)
+                dcmp.dst_only.add(old_path)
+        def change(path):
             src_type = self.src_api.get_path_type(path)
             dst_type = self.dst_api.get_path_type(path)
             if (src_type == 'FILE') and (dst_type == 'FILE'):
-                self.copy_file(path, res)
+                return ('data', self.copy_file)
             elif (src_type == 'FILE') and (dst_type == 'DIR'):
-                self.dst_api.remove_dir(path, res)
-                self.copy_file(path, res)
+                def replace_dir(path, res):
+                    self.dst_api.remove_dir(path, res)
+                    self.copy_file(path, res)
+                return ('data', replace_dir)
             elif (src_type == 'DIR') and (dst_type == 'FILE'):
-                src_mode = self.src_api.get_path_mode(path)
-                self.dst_api.remove_file(path, res)
-                self.dst_api.make_dir(path, src_mode, res)
-        for path in sorted(dcmp.src_only):
-            src_type = self.src_api.get_path_type(path)
-            src_mode = self.src_api.get_path_mode(path)
-            if (src_type == 'DIR'):
-                self.dst_api.make_dir(path, src_mode, res)
-            elif (src_type == 'FILE'):
-                self.copy_file(path, res)
+                def replace_file(path, res):
+                    self.dst_api.remove_file(path, res)
+                    self.dst_api.make_dir(path, self.src_api.get_path_mode(path), res)
+                return ('meta', replace_file)
+            return (None, None)
+
+        # With a catalog, the paths are read from it in order, and large phases are split.
+        streamed = isinstance(dcmp.src_only, CatalogSet)
+        # Files are moved before anything is removed, because their old directories may be removed.
+        made = { parent for path in dcmp.moved for parent in path.parents if parent in dcmp.src_only }
+        for level in by_depth(made):
+            yield [ ('meta', path, make_dir(path)) for path in level ]
+        yield [ ('meta', path, functools.partial(move_file, path)) for path in sorted(dcmp.moved) ]
+        # The contents of a directory should be removed before the directory itself is removed.
+        yield from phases_of((('meta', path, functools.partial(self.dst_api.remove_file, path, res))
+                              for path in self.ordered(dcmp.dst_only, self.dst_api, 'FILE', reverse=True)), streamed)
+        for level in self.dir_levels(dcmp.dst_only, self.dst_api, reverse=True):
+            yield from phases_of((('meta', path, functools.partial(self.dst_api.remove_dir, path, res))
+                                  for path in level), streamed)
+        # With a scheduler, changed files are copied together with added ones, in the order of the scheduler.
+        deferred = []
+        def changes():
+            for path in in_order(dcmp.changed):
+                kind, op = change(path)
+                if op:
+                    item = (kind, path, functools.partial(op, path, res))
+                    if kind == 'data' and self.scheduler and not streamed:
+                        deferred.append(item)
+                    else:
+                        yield item
+        yield from phases_of(changes(), streamed)
+        # A directory should be created before its contents are added.
+        for level in self.dir_levels(dcmp.src_only, self.src_api):
+            yield from phases_of((('meta', path, make_dir(path)) for path in level if path not in made), streamed)
+        yield from phases_of(chain(deferred, (('data', path, functools.partial(self.copy_file, path, res))
+                                              for path in self.ordered(dcmp.src_only, self.src_api, 'FILE')
+                                              if path not in made)), streamed)
+
+    def ordered(self, paths, api, kind, reverse=False):
+        """ The paths whose type is kind in api, in sorted order """
+        if isinstance(paths, CatalogSet):
+            return paths.ordered(reverse, api.included, kind)
+        return [ path for path in sorted(paths, reverse=reverse) if api.get_path_type(path) == kind ]
+
+    def dir_levels(self, paths, api, reverse=False):
+        """ The paths that are directories in api, grouped by depth as by by_depth """
+        if isinstance(paths, CatalogSet):
+            return paths.levels(api.included, 'DIR', reverse)
+        return by_depth([ path for path in paths if api.get_path_type(path) == 'DIR' ], reverse)
+
+    def scheduled(self, phase):
+        """ Order the operations of phase by the scheduler, if any """
+        if self.scheduler is None:
+            return phase
+        return self.scheduler.sort(phase, self.src_api)
+
+    def start_prefetch(self, phase):
+        """ Let the source directory read ahead the files to be copied in phase """
+        if self.prefetch > 0 and hasattr(self.src_api, 'prefetch'):
+            paths = [ path for kind, path, op in phase if kind == 'data' ]
+            if paths:
+                self.src_api.prefetch(paths, self.prefetch, self.prefetch_bytes)
+
+    def stop_prefetch(self):
+        if hasattr(self.src_api, 'stop_prefetch'):
+            self.src_api.stop_prefetch()
+
+    def throttled(self, kind, op):
+        """ Limit the rate of the metadata operation op by ops_limiter """
+        if kind != 'meta':
+            return op
+        def throttled_op():
+            self.ops_limiter.consume(1)
+            return op()
+        return throttled_op
+
+    def checkpoint(self):
+        if hasattr(self.dst_api, 'checkpoint'):
+            self.dst_api.checkpoint()
+
+    def run_phases(self, phases):
+        for phase in phases:
+            phase = self.scheduled(phase)
+            self.start_prefetch(phase)
+            try:
+                for count, (kind, path, op) in enumerate(phase, 1):
+                    self.throttled(kind, op)()
+                    if count % checkpoint_ops == 0:
+                        self.checkpoint()
+            finally:
+                self.stop_prefetch()
+
+    def sync_dirs(self, paths=None, planned=None):
+        """ Synchronize two directories, or only the pair of sets of paths if given """
+        dcmp = self.compare_dirs() if paths is None else self.compare_paths(*paths)
+        if planned:
+            planned(dcmp)
+        if self.diffonly:
+            dcmp.output(self.logger, self.verbose)
+            return None
+        res = DirSyncRes(self.logger)
+        self.run_phases(self.sync_phases(dcmp, res))
+        if hasattr(self.dst_api, 'finish_sync'):
+            self.dst_api.finish_sync()
+        return res
+
+class AsyncDirSync(AbsDirSync):
+    """ Object for synchronizing two directories with the operations of each phase run concurrently """
+
+    def __init__(self, logger, src_api, dst_api, copy_file, options):
+        super().__init__(logger, src_api, dst_api, copy_file, options)
+        self.jobs = max(1, options.get('jobs', 1) or 1)
+        self.meta_jobs = max(1, options.get('meta_jobs', None) or 4 * self.jobs)
+
+    def collect_paths(self):
+        for api in (self.src_api, self.dst_api):
+            if hasattr(api, 'mapper'):
+                api.mapper = self.executors['meta'].map
+        if self.use_ctime or self.src_api.dir_type == self.dst_api.dir_type:
+            # Neither directory is collected with the other as reference.
+            futures = [ self.executors['data'].submit(self.collect_api, api) for api in (self.src_api, self.dst_api)
+                        if api is self.dst_api or not self.collected ]
+            for future in futures:
+                future.result()
+            return set()
+        return super().collect_paths()
+
+    async def run_phase(self, loop, phase):
+        if self.scheduler is None:
+            futures = [ loop.run_in_executor(self.executors[kind], self.throttled(kind, op)) for kind, path, op in phase ]
+            await asyncio.gather(*futures)
+            return
+        futures = [ loop.run_in_executor(self.executors[kind], self.throttled(kind, op))
+                    for kind, path, op in phase if kind != 'data' ]
+        await self.run_data_ops(loop, [ (path, op) for kind, path, op in phase if kind == 'data' ])
+        await asyncio.gather(*futures)
+
+    async def run_data_ops(self, loop, ops):
+        """ Copy the files of ops on up to jobs workers, at most half of them on large files """
+        small, large = deque(), deque()
+        for path, op in ops:
+            (large if self.scheduler.is_large(self.src_api, path) else small).append(op)
+        large_slots = self.jobs // 2
+        running = dict()
+        while small or large or running:
+            while (small or large) and len(running) < self.jobs:
+                large_running = sum(running.values())
+                is_large = bool(large) and (not small or large_running < large_slots)
+                op = large.popleft() if is_large else small.popleft()
+                running[loop.run_in_executor(self.executors['data'], op)] = is_large
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                future.result()
+
+    def run_phases(self, phases):
+        loop = asyncio.new_event_loop()
+        try:
+            for phase in phases:
+                if phase:
+                    phase = self.scheduled(phase)
+                    self.start_prefetch(phase)
+                    try:
+                        # The checkpoints are taken between batches, when no operation is in flight.
+                        for start in range(0, len(phase), checkpoint_ops):
+                            if start > 0:
+                                self.checkpoint()
+                            loop.run_until_complete(self.run_phase(loop, phase[start:start + checkpoint_ops]))
+                    finally:
+                        self.stop_prefetch()
+        finally:
+            loop.close()
+
+    def sync_dirs(self, paths=None, planned=None):
+        self.executors = {
+            'data': ThreadPoolExecutor(max_workers=max(2, self.jobs)),
+            'meta': ThreadPoolExecutor(max_workers=self.meta_jobs),
+        }
+        try:
+            return super().sync_dirs(paths, planned)
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            for api in (self.src_api, self.dst_api):
+                if hasattr(api, 'mapper'):
+                    api.mapper = map
 
 class DirSync(object):
     """ Object for directory synchronization and encryption """
@@ -146,25 +551,188 @@ class DirSync(object):
         self.local_api = open_dirapi(self.local_dir)
         assert self.local_api.dir_type == 'plain'
         test_key = options.get('test_key', None)
-        self.remote_api = open_dirapi(self.remote_dir, test_key=test_key)
+        self.remote_api = open_dirapi(self.remote_dir, test_key=test_key, crypt_key=options.get('crypt_key', None))
+        # The rates of reading and writing bytes and of metadata operations are limited by
+        # token buckets, which are shared by all syncs so that they can be adjusted at any time.
+        self.io_limiter = TokenBucket(options.get('io_rate', None))
+        self.ops_limiter = TokenBucket(options.get('ops_rate', None))
+        self.remote_api.limiter = self.io_limiter
+        for api in (self.local_api, self.remote_api):
+            if api.dir_type == 'plain':
+                api.scan_jobs = max(1, options.get('scan_jobs', None) or 1)
+        # The decrypted metadata of an encrypted remote_dir may be cached locally, so that only
+        # the metadata files that have changed since the last sync are decrypted.
+        # The cache is kept in memory, so it is not used together with a catalog.
+        if options.get('meta_cache', False) and not options.get('catalog', False) and \
+           self.remote_api.dir_type == 'crypt':
+            self.remote_api.meta_cache = MetaCache(default_cache_file(self.remote_dir), self.remote_api.crypt_key)
+        # The paths of both directories and the results of comparing them may be kept in an
+        # on-disk catalog instead of in memory, for directories with more paths than fit in memory.
+        self.catalog = None
+        if options.get('catalog', False):
+            self.catalog = Catalog(options.get('memory_budget', None))
+            for name, api in (('local', self.local_api), ('remote', self.remote_api)):
+                api.catalog = self.catalog
+                api.catalog_name = name
 
         def push_file(path, res):
             local_file = self.local_dir / path
-            self.remote_api.push_file(path, local_file, res)
+            if self.fanout is None:
+                self.remote_api.push_file(path, local_file, res)
+            else:
+                try:
+                    self.remote_api.push_file(path, self.fanout.source(self, path, local_file), res)
+                finally:
+                    self.fanout.release(self, path)
+            res.add_bytes(local_file)
 
         def pull_file(path, res):
             local_file = self.local_dir / path
             self.remote_api.pull_file(path, local_file, res)
+            res.add_bytes(local_file)
 
         self.push_file = push_file
         self.pull_file = pull_file
+        # The paths of local_dir indexed by the names of their metadata files, for pull_changes.
+        self.local_index = None
+        # The registry of the files read once for several remote directories, if any.
+        self.fanout = None
+
+    def set_rates(self, io_rate=None, ops_rate=None):
+        """ Change the limits on the rates of bytes and metadata operations per second """
+        self.io_limiter.set_rate(io_rate)
+        self.ops_limiter.set_rate(ops_rate)
+
+    def engine(self, src_api, dst_api, copy_file, **extra):
+        engine = AsyncDirSync if self.options.get('jobs', 1) > 1 else AbsDirSync
+        return engine(self.logger, src_api, dst_api, copy_file,
+                      dict(self.options, ops_limiter=self.ops_limiter, **extra))
+
+    def sync(self, command, collected=False, planned=None):
+        # The view of local_dir used by pull_changes has to be collected again.
+        self.local_index = None
+        try:
+            if command == 'push':
+                if self.remote_api.dir_type == 'crypt' and not self.options.get('diffonly', False):
+                    self.remote_api.upgrade_format()
+                ds = self.engine(self.local_api, self.remote_api, self.push_file, collected=collected)
+                return ds.sync_dirs(planned=planned)
+            elif command == 'pull':
+                return self.engine(self.remote_api, self.local_api, self.pull_file).sync_dirs()
+            else:
+                raise ValueError("Error: command must be 'push' or 'pull'")
+        finally:
+            if getattr(self.remote_api, 'meta_cache', None):
+                self.remote_api.meta_cache.save()
+
+    def pull_changes(self, crypt_paths):
+        """ Pull only the paths whose metadata files have changed, or return None if a full pull is needed """
+        if self.remote_api.dir_type != 'crypt':
+            return None
+        local_paths = self.local_api.included
+        if self.local_index is None:
+            self.local_api.collect_paths()
+            local_paths = self.local_api.included
+            self.local_index = { path_hash(self.remote_api.crypt_key, path): path for path in local_paths }
+        try:
+            remote_paths, missing = self.remote_api.read_meta_files(crypt_paths)
+        except Exception:
+            return None
+        for path, meta in list(remote_paths.items()):
+            if self.local_api.exclude.excludes(path, is_dir=stat.S_ISDIR(meta['mode'])):
+                del remote_paths[path]
+        removed = { self.local_index[crypt_path] for crypt_path in missing if crypt_path in self.local_index }
+        removed_dirs = { path for path in removed if stat.S_ISDIR(local_paths[path]['mode']) }
+        if removed_dirs:
+            removed |= { path for path in local_paths if any(parent in removed_dirs for parent in path.parents) }
+        removed -= set(remote_paths.keys())
+        # A new path has to be added to a directory that exists or is added too.
+        for path in remote_paths:
+            if path not in local_paths:
+                parent_meta = remote_paths.get(path.parent, None) or \
+                              (local_paths.get(path.parent, None) if path.parent not in removed else None)
+                if path.parent != Path() and not (parent_meta and stat.S_ISDIR(parent_meta['mode'])):
+                    return None
+        ds = self.engine(self.remote_api, self.local_api, self.pull_file)
+        try:
+            res = ds.sync_dirs((set(remote_paths.keys()), removed | (set(remote_paths.keys()) & set(local_paths))))
+        finally:
+            for path in removed | set(remote_paths.keys()):
+                self.local_index.pop(path_hash(self.remote_api.crypt_key, path), None)
+                if self.local_api.update_path(path):
+                    self.local_index[path_hash(self.remote_api.crypt_key, path)] = path
+        return res
+
+class PrefixLogger(logging.LoggerAdapter):
+    """ Logger adapter that prefixes every message with extra['prefix'] """
+
+    def process(self, msg, kwargs):
+        return (f"{self.extra['prefix']}{msg}", kwargs)
+
+class FanoutSync(object):
+    """ Object for pushing a directory to several remote directories at once """
+
+    def __init__(self, logger, local_dir, remote_dirs, **options):
+        self.logger = logger
+        self.syncers = []
+        for remote_dir in remote_dirs:
+            remote_logger = PrefixLogger(logger, {'prefix': f'[{remote_dir}] '})
+            self.syncers.append(DirSync(remote_logger, local_dir, remote_dir, **options))
+        self.local_api = self.syncers[0].local_api
+        # A single catalog, if any, holds the paths of local_dir and of all remote directories.
+        self.catalog = self.syncers[0].catalog
+        for i, syncer in enumerate(self.syncers):
+            syncer.local_api = self.local_api
+            if self.catalog is not None:
+                if syncer.catalog is not self.catalog:
+                    syncer.catalog.close()
+                syncer.catalog = self.catalog
+                syncer.remote_api.catalog = self.catalog
+                syncer.remote_api.catalog_name = f'remote_{i}'
+
+    def set_rates(self, io_rate=None, ops_rate=None):
+        for syncer in self.syncers:
+            syncer.set_rates(io_rate, ops_rate)
 
     def sync(self, command):
-        if command == 'push':
-            ds = AbsDirSync(self.logger, self.local_api, self.remote_api, self.push_file, self.options)
-            ds.sync_dirs()
-        elif command == 'pull':
-            ds = AbsDirSync(self.logger, self.remote_api, self.local_api, self.pull_file, self.options)
-            ds.sync_dirs()
+        """ Push to all remote directories and return the list of their results """
+        if command != 'push':
+            raise ValueError("Error: only push supports multiple remote directories")
+        subpaths = normalize_subpaths(self.syncers[0].options.get('subpaths', None))
+        if subpaths is None:
+            self.local_api.collect_paths()
         else:
-            raise ValueError("Error: command must be 'push' or 'pull'")
+            self.local_api.collect_subtrees(subpaths)
+        fanout = Fanout()
+        # The files to be shared are known once every remote directory has been compared.
+        barrier = threading.Barrier(len(self.syncers))
+        results = [ None ] * len(self.syncers)
+        errors = []
+
+        def run(i, syncer):
+            def planned(dcmp):
+                if syncer.remote_api.dir_type == 'crypt':
+                    fanout.expect(syncer, [ path for path in chain(dcmp.src_only, dcmp.truly_changed)
+                                            if self.local_api.get_path_type(path) == 'FILE' ])
+                try:
+                    barrier.wait()
+                except threading.BrokenBarrierError:
+                    pass
+            syncer.fanout = fanout
+            try:
+                results[i] = syncer.sync('push', collected=True, planned=planned)
+            except BaseException as ex:
+                errors.append(ex)
+                barrier.abort()
+            finally:
+                fanout.release_all(syncer)
+                syncer.fanout = None
+
+        threads = [ threading.Thread(target=run, args=(i, syncer)) for i, syncer in enumerate(self.syncers) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
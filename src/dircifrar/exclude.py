@@ -0,0 +1,151 @@
+
+from collections import OrderedDict
+from pathlib import Path
+import re
+
+# The number of decisions on names and on directories kept by each Excluder.
+exclude_cache_size = 4096
+
+glob_prefix = 'glob:'
+glob_wildcards = re.compile(r'[*?\[]')
+
+def glob_regex(glob):
+    """ Translate the body of a gitignore-style glob (without slashes at either end) into a regex """
+    out = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        at_part_start = (i == 0 or glob[i - 1] == '/')
+        if at_part_start and glob.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif at_part_start and glob[i:] == '**':
+            out.append('.*')
+            i += 2
+        elif c == '*':
+            out.append('[^/]*')
+            i += 1
+        elif c == '?':
+            out.append('[^/]')
+            i += 1
+        elif c == '[' and ']' in glob[i + 2:]:
+            j = glob.index(']', i + 2)
+            body = glob[i + 1 : j].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            out.append('[' + body + ']')
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return ''.join(out)
+
+def parse_glob(glob):
+    """ Parse a gitignore-style glob into (regex, dir_only, contents, prefix) """
+    dir_only = glob.endswith('/')
+    glob = glob.rstrip('/')
+    # As in gitignore, a glob with a slash before its end is anchored at the root.
+    anchored = '/' in glob
+    glob = glob.lstrip('/')
+    lead = '' if anchored else '(?:.*/)?'
+    contents = None
+    if glob.endswith('/**') and not dir_only:
+        contents = lead + glob_regex(glob[:-3])
+    prefix = []
+    if anchored:
+        for part in glob.split('/'):
+            if glob_wildcards.search(part):
+                break
+            prefix.append(part)
+    return (lead + glob_regex(glob), dir_only, contents, tuple(prefix))
+
+# Regexes with backreferences, named groups or global flags cannot be combined with others.
+unsafe_regex = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\)')
+
+def combine(regexes):
+    if not regexes:
+        return None
+    return re.compile('|'.join(f'(?:{regex})' for regex in regexes))
+
+class LruCache(object):
+    """ Mapping that keeps only the size most recently used entries """
+
+    def __init__(self, size=exclude_cache_size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = compute(key)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return value
+
+class Excluder(object):
+    """ Matcher for exclude patterns: globs on relative paths and regexes on names """
+
+    def __init__(self, patterns):
+        name_regexes = []
+        path_regexes = []
+        dir_regexes = []
+        contents_regexes = []
+        self.separate = []
+        self.prefixes = set()
+        for pat in patterns:
+            if pat.startswith(glob_prefix) or '/' in pat:
+                if pat.startswith(glob_prefix):
+                    pat = pat[len(glob_prefix):]
+                regex, dir_only, contents, prefix = parse_glob(pat)
+                (dir_regexes if dir_only else path_regexes).append(regex)
+                if contents:
+                    contents_regexes.append(contents)
+                self.prefixes.add(prefix)
+            elif unsafe_regex.search(pat):
+                self.separate.append(re.compile(pat))
+            else:
+                re.compile(pat)
+                name_regexes.append(pat)
+        try:
+            self.name_regex = combine(name_regexes)
+        except re.error:
+            # Some construct not caught above: match the regexes one by one.
+            self.separate.extend(re.compile(pat) for pat in name_regexes)
+            self.name_regex = None
+        self.path_regex = combine(path_regexes)
+        self.dir_regex = combine(dir_regexes)
+        self.contents_regex = combine(contents_regexes)
+        self.name_cache = LruCache()
+        self.relevant_cache = LruCache()
+
+    def excludes_name(self, name):
+        return self.name_cache.get(name, lambda name:
+            bool(self.name_regex and self.name_regex.fullmatch(name)) or
+            any(pat.fullmatch(name) for pat in self.separate))
+
+    def is_relevant(self, parent):
+        """ Whether any glob can exclude a child of the directory parent """
+        def compute(parent):
+            parts = parent.parts
+            return any(prefix[:len(parts)] == parts[:len(prefix)] for prefix in self.prefixes)
+        return self.relevant_cache.get(parent, compute)
+
+    def excludes(self, path, is_dir=False):
+        """ Whether the relative path is excluded """
+        path = Path(path)
+        if self.excludes_name(path.name):
+            return True
+        if not self.prefixes or not self.is_relevant(path.parent):
+            return False
+        posix = path.as_posix()
+        if self.path_regex and self.path_regex.fullmatch(posix):
+            return True
+        return bool(is_dir and self.dir_regex and self.dir_regex.fullmatch(posix))
+
+    def prunes(self, path):
+        """ Whether all contents of the (not excluded) directory at the relative path are excluded """
+        if not self.contents_regex or not self.is_relevant(Path(path).parent):
+            return False
+        return bool(self.contents_regex.fullmatch(Path(path).as_posix()))
@@ -0,0 +1,241 @@
+
+import os, time, threading
+
+# Shared files are read in blocks of this size.
+fanout_block_size = 2 ** 20
+# A reader of a shared file may get at most this many blocks ahead of the slowest other reader.
+fanout_max_blocks = 8
+# At most this many blocks of a shared file are kept for the readers still to come.
+fanout_cache_blocks = 2 * fanout_max_blocks
+# A reader past the kept blocks waits at most this many seconds for the expected users that have not opened the file.
+fanout_wait = 10.0
+
+class SharedSource(os.PathLike):
+    """ Plaintext file encrypted for several directories at once, whose blocks are read once """
+
+    def __init__(self, path, owners):
+        self.path = path
+        self.expected = len(owners)
+        # The expected users that have not opened the file yet.
+        self.absent = set(owners)
+        self.cond = threading.Condition()
+        self.fd = None
+        self.stamp = None
+        self.blocks = dict()
+        self.loading = set()
+        # The index of the block being read by each open reader.
+        self.positions = dict()
+        self.closed = False
+
+    def __fspath__(self):
+        return os.fspath(self.path)
+
+    def __str__(self):
+        return str(self.path)
+
+    def open(self, owner=None):
+        with self.cond:
+            self.absent.discard(owner)
+            self.cond.notify_all()
+            st = os.stat(self.path)
+            stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+            if stamp != self.stamp:
+                if self.positions:
+                    # The open readers see the old contents, so this one reads the file on its own.
+                    return open(self.path, 'rb')
+                self.stamp = stamp
+                self.blocks = dict()
+                if self.fd is not None:
+                    os.close(self.fd)
+                    self.fd = None
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY)
+            reader = SharedReader(self)
+            self.positions[reader] = 0
+            return reader
+
+    def release(self, owner=None):
+        """ Called when one of the expected users is done with the file """
+        with self.cond:
+            self.expected -= 1
+            self.absent.discard(owner)
+            self.drop_blocks()
+            self.cond.notify_all()
+
+    def close_reader(self, reader):
+        with self.cond:
+            self.positions.pop(reader, None)
+            self.drop_blocks()
+            self.close_fd()
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.close_fd()
+
+    def close_fd(self):
+        if self.closed and not self.positions and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def drop_blocks(self):
+        if self.expected > 0:
+            while len(self.blocks) > fanout_cache_blocks:
+                del self.blocks[min(self.blocks)]
+        else:
+            self.blocks = dict()
+
+    def read_block(self, reader, index):
+        """ Return the block at index for reader """
+        with self.cond:
+            self.positions[reader] = index
+            self.drop_blocks()
+            self.cond.notify_all()
+            deadline = None
+            while True:
+                if index - min(self.positions.values()) >= fanout_max_blocks or index in self.loading:
+                    self.cond.wait()
+                elif self.absent and index >= fanout_cache_blocks:
+                    deadline = deadline or time.monotonic() + fanout_wait
+                    if not self.cond.wait(max(0.0, deadline - time.monotonic())):
+                        # The users that are late read the first blocks again on their own.
+                        self.absent = set()
+                else:
+                    break
+            if index in self.blocks:
+                return self.blocks[index]
+            self.loading.add(index)
+            fd = self.fd
+        data = None
+        try:
+            data = os.pread(fd, fanout_block_size, index * fanout_block_size)
+        finally:
+            with self.cond:
+                self.loading.discard(index)
+                # The user of this reader is one of the expected ones.
+                if data is not None and (len(self.positions) > 1 or self.expected > 1):
+                    self.blocks[index] = data
+                    self.drop_blocks()
+                self.cond.notify_all()
+        return data
+
+class SharedUse(os.PathLike):
+    """ A SharedSource as seen by one of its expected users """
+
+    def __init__(self, source, owner):
+        self.source = source
+        self.owner = owner
+
+    def __fspath__(self):
+        return os.fspath(self.source)
+
+    def __str__(self):
+        return str(self.source)
+
+    def open(self):
+        return self.source.open(self.owner)
+
+class SharedReader(object):
+    """ File-like object reading a SharedSource from its own position """
+
+    def __init__(self, source):
+        self.source = source
+        self.pos = 0
+        self.closed = False
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        index, offset = divmod(self.pos, fanout_block_size)
+        data = self.source.read_block(self, index)
+        count = max(0, min(len(view), len(data) - offset))
+        view[0:count] = data[offset:offset + count]
+        self.pos += count
+        return count
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            index, offset = divmod(self.pos, fanout_block_size)
+            data = self.source.read_block(self, index)
+            chunk = data[offset:] if size < 0 else data[offset:offset + size]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self.source.fd).st_size
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def fileno(self):
+        return self.source.fd
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.source.close_reader(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Fanout(object):
+    """ Registry of the SharedSources of the files pushed to several directories at once """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.expected = dict()
+        self.sources = dict()
+
+    def expect(self, owner, paths):
+        with self.lock:
+            self.pending.setdefault(owner, set()).update(paths)
+            for path in paths:
+                self.expected[path] = self.expected.get(path, 0) + 1
+
+    def source(self, owner, path, file):
+        """ Return the SharedSource of path as seen by owner if owner expects it, and file itself otherwise """
+        with self.lock:
+            if path not in self.pending.get(owner, ()):
+                return file
+            if path not in self.sources:
+                owners = [ other for other, paths in self.pending.items() if path in paths ]
+                self.sources[path] = SharedSource(file, owners)
+            return SharedUse(self.sources[path], owner)
+
+    def release(self, owner, path):
+        with self.lock:
+            pending = self.pending.get(owner, set())
+            if path not in pending:
+                return
+            pending.remove(path)
+            self.expected[path] -= 1
+            source = self.sources.get(path, None)
+            last = self.expected[path] == 0
+            if last:
+                del self.expected[path]
+                self.sources.pop(path, None)
+        if source:
+            source.release(owner)
+            if last:
+                source.close()
+
+    def release_all(self, owner):
+        with self.lock:
+            paths = list(self.pending.get(owner, ()))
+        for path in paths:
+            self.release(owner, path)
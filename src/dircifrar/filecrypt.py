@@ -11,19 +11,574 @@ from nacl.bindings import (
     crypto_secretstream_xchacha20poly1305_state as crypto_state,
 )
 from nacl.hash import generichash
+from nacl.encoding import RawEncoder
+from nacl.exceptions import CryptoError
+from nacl.secret import SecretBox
 from pathlib import Path
-import os, io, tempfile
+from .compression import Compressor, Decompressor, is_compressible
+from .throttle import throttled
+from .fanout import SharedUse
+import os, io, re, errno, tempfile, hashlib, queue, threading
 
 exp2_32 = 2 ** 32
 exp2_64 = 2 ** 64
 
-def file_encrypt(key, plain_file, crypt_file, metadata, chunk_size):
+# A sealed file keeps its metadata in a trailer that is encrypted separately from
+# the contents, so that the metadata can be replaced without re-encrypting the contents.
+# Its first 4 bytes can never be the metadata size of an unsealed file.
+sealed_magic = b'DCS\xff'
+
+# The size of the blocks in which the contents of a sealed file are copied when it is resealed.
+reseal_block_size = 2 ** 20
+
+# Files are written into temporary files with this prefix, which are renamed into place once complete.
+# Those left behind by an interrupted process are recognized by is_temp_name, which also recognizes
+# the default names of NamedTemporaryFile used by earlier versions.
+temp_prefix = '.dircifrar-tmp-'
+temp_name_pattern = re.compile('tmp[a-z0-9_]{8}')
+
+def is_temp_name(name):
+    return name.startswith(temp_prefix) or temp_name_pattern.fullmatch(name) is not None
+
+def temp_file(dir, dir_fd=None):
+    if dir_fd is not None:
+        return TempFileAt(dir_fd)
+    return tempfile.NamedTemporaryFile(mode='wb', dir=dir, prefix=temp_prefix)
+
+def install_file(temp_fp, dst_file, dir_fd=None):
+    """ Put the contents of temp_fp in place as dst_file, which is a name in dir_fd if dir_fd is given """
+    if dir_fd is not None:
+        temp_fp.install(dst_file)
+        return
+    if os.path.exists(dst_file):
+        os.remove(dst_file)
+    os.link(temp_fp.name, dst_file)
+
+class TempFileAt(object):
+    """ Temporary file in the directory dir_fd, removed on close unless installed """
+
+    def __init__(self, dir_fd):
+        self.dir_fd = dir_fd
+        while True:
+            self.name = temp_prefix + os.urandom(6).hex()
+            try:
+                fd = os.open(self.name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_CLOEXEC', 0),
+                             0o600, dir_fd=dir_fd)
+                break
+            except FileExistsError:
+                pass
+        self.file = os.fdopen(fd, 'wb')
+        self.installed = False
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def install(self, name):
+        self.file.flush()
+        os.replace(self.name, name, src_dir_fd=self.dir_fd, dst_dir_fd=self.dir_fd)
+        self.installed = True
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if not self.installed:
+            try:
+                os.remove(self.name, dir_fd=self.dir_fd)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FileChangedError(Exception):
+    """ Raised when a file is truncated, grows or is modified while it is being encrypted """
+
+def derive_key(key, label):
+    return generichash(label, key=key, encoder=RawEncoder)
+
+def open_plain(plain_file):
+    if isinstance(plain_file, (bytes, bytearray)):
+        return io.BytesIO(plain_file)
+    if isinstance(plain_file, SharedUse):
+        return plain_file.open()
+    return open(plain_file, 'rb')
+
+def read_fully(fp, view):
+    """ Fill view from fp and return the number of bytes read, which is less only at the end of fp """
+    done = 0
+    while done < len(view):
+        count = fp.readinto(view[done:])
+        if not count:
+            break
+        done += count
+    return done
+
+def check_unchanged(plain_file, plain_stat):
+    """ Check that plain_file still has the size and mtime recorded in plain_stat """
+    if plain_stat is None:
+        return
+    st = os.stat(plain_file)
+    if (st.st_size, st.st_mtime_ns) != (plain_stat.st_size, plain_stat.st_mtime_ns):
+        raise FileChangedError('file changed while being encrypted')
+
+def content_digest(key, plain_file, chunk_size=2 ** 16):
+    hasher = hashlib.blake2b(key=derive_key(key, b'content'), digest_size=32)
+    with open_plain(plain_file) as plain_fp:
+        while True:
+            data = plain_fp.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.digest()
+
+def seal_metadata(key, header, metadata):
+    box = SecretBox(derive_key(key, b'metadata'))
+    trailer = bytes(box.encrypt(header + metadata))
+    return trailer + len(trailer).to_bytes(4, byteorder='little', signed=False)
+
+def open_metadata(key, crypt_fp, header):
+    crypt_fp.seek(-4, io.SEEK_END)
+    trailer_size = int.from_bytes(crypt_fp.read(4), byteorder='little', signed=False)
+    crypt_fp.seek(-(4 + trailer_size), io.SEEK_END)
+    trailer_start = crypt_fp.tell()
+    box = SecretBox(derive_key(key, b'metadata'))
+    plaintext = box.decrypt(crypt_fp.read(trailer_size))
+    assert plaintext[0:len(header)] == header
+    return (plaintext[len(header):], trailer_start)
+
+def file_is_sealed(crypt_file):
+    with open(crypt_file, 'rb') as crypt_fp:
+        return crypt_fp.read(len(sealed_magic)) == sealed_magic
+
+# Unlike crypto_push and crypto_pull, the following two functions accept any contiguous
+# buffer as input and write their output into a given buffer, so that buffers can be reused.
+# They call libsodium through the private bindings of PyNaCl when these are available, and
+# otherwise fall back to copying the results of crypto_push and crypto_pull.
+try:
+    from nacl._sodium import ffi, lib
+    zero_copy = hasattr(crypto_state(), 'statebuf') and \
+        hasattr(lib, 'crypto_secretstream_xchacha20poly1305_push')
+except ImportError:
+    zero_copy = False
+
+def crypto_push_into(state, plaintext, out, tag):
+    if not zero_copy:
+        ciphertext = crypto_push(state, bytes(plaintext), tag=tag)
+        out[0:len(ciphertext)] = ciphertext
+        return len(ciphertext)
+    rc = lib.crypto_secretstream_xchacha20poly1305_push(
+        state.statebuf, ffi.from_buffer(out), ffi.NULL,
+        ffi.from_buffer(plaintext), len(plaintext), ffi.NULL, 0, tag)
+    if rc != 0:
+        raise CryptoError('Encryption failed')
+    return len(plaintext) + crypto_ABYTES
+
+def crypto_pull_into(state, ciphertext, out):
+    if not zero_copy:
+        plaintext, tag = crypto_pull(state, bytes(ciphertext))
+        out[0:len(plaintext)] = plaintext
+        return (len(plaintext), tag)
+    tagbuf = ffi.new('unsigned char[1]')
+    rc = lib.crypto_secretstream_xchacha20poly1305_pull(
+        state.statebuf, ffi.from_buffer(out), ffi.NULL, tagbuf,
+        ffi.from_buffer(ciphertext), len(ciphertext), ffi.NULL, 0)
+    if rc != 0:
+        raise CryptoError('Decryption failed')
+    return (len(ciphertext) - crypto_ABYTES, tagbuf[0])
+
+pipeline_block_size = 2 ** 20
+pipeline_depth = 4
+# Files smaller than this are not worth the overhead of starting the reader and writer threads.
+pipeline_min_size = pipeline_block_size
+
+def run_pipeline(read_into, in_size, transform, out_size, write, depth=pipeline_depth):
+    """ Run read_into -> transform -> write, with reading and writing on their own threads """
+    in_free, in_full, out_free, out_full = queue.Queue(), queue.Queue(), queue.Queue(), queue.Queue()
+    for _ in range(depth):
+        in_free.put(bytearray(in_size))
+        out_free.put(bytearray(out_size))
+    errors = []
+
+    def reader():
+        try:
+            while True:
+                buf = in_free.get()
+                if buf is None:
+                    return
+                size = read_into(buf)
+                in_full.put((buf, size))
+                if size == 0:
+                    return
+        except BaseException as ex:
+            errors.append(ex)
+            in_full.put((None, 0))
+
+    def writer():
+        while True:
+            item = out_full.get()
+            if item is None:
+                return
+            buf, size = item
+            try:
+                if not errors:
+                    write(memoryview(buf)[0:size])
+            except BaseException as ex:
+                errors.append(ex)
+            out_free.put(buf)
+
+    threads = [ threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True) ]
+    for thread in threads:
+        thread.start()
+    try:
+        while not errors:
+            buf, size = in_full.get()
+            if not size:
+                break
+            out = out_free.get()
+            out_full.put((out, transform(memoryview(buf)[0:size], out)))
+            in_free.put(buf)
+    finally:
+        in_free.put(None)
+        out_full.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+def push_contents(state, plain_fp, crypt_fp, plain_size, chunk_size, sealed, hasher=None, pipelined=False):
+    """ Encrypt plain_size bytes from plain_fp into crypt_fp in chunks of chunk_size """
+    def chunk_tag(remaining, size):
+        if sealed:
+            return crypto_TAG_FINAL if remaining == size else crypto_TAG_MESSAGE
+        # The unsealed format tags a chunk as final only if it is shorter than chunk_size.
+        return crypto_TAG_MESSAGE if remaining >= chunk_size else crypto_TAG_FINAL
+
+    if not pipelined or plain_size < pipeline_min_size:
+        # The chunks are read into and encrypted from the same buffers.
+        buf = bytearray(min(chunk_size, plain_size))
+        out = bytearray(len(buf) + crypto_ABYTES)
+        while plain_size > 0:
+            plaintext = memoryview(buf)[0:min(chunk_size, plain_size)]
+            if read_fully(plain_fp, plaintext) < len(plaintext):
+                raise FileChangedError('file truncated while being encrypted')
+            size = crypto_push_into(state, plaintext, out, chunk_tag(plain_size, len(plaintext)))
+            crypt_fp.write(memoryview(out)[0:size])
+            if hasher:
+                hasher.update(plaintext)
+            plain_size -= len(plaintext)
+        return
+
+    to_read = plain_size
+    def read_into(buf):
+        nonlocal to_read
+        size = min(len(buf), to_read)
+        if read_fully(plain_fp, memoryview(buf)[0:size]) < size:
+            raise FileChangedError('file truncated while being encrypted')
+        to_read -= size
+        return size
+
+    to_push = plain_size
+    def transform(view, out):
+        nonlocal to_push
+        pos = 0
+        for start in range(0, len(view), chunk_size):
+            plaintext = view[start : start + chunk_size]
+            if hasher:
+                hasher.update(plaintext)
+            pos += crypto_push_into(state, plaintext, memoryview(out)[pos:], chunk_tag(to_push, len(plaintext)))
+            to_push -= len(plaintext)
+        return pos
+
+    num_chunks = max(1, pipeline_block_size // chunk_size)
+    run_pipeline(read_into, num_chunks * chunk_size,
+                 transform, num_chunks * (chunk_size + crypto_ABYTES), crypt_fp.write)
+
+def pull_contents(state, crypt_fp, plain_fp, plain_size, chunk_size, sealed, pipelined=False):
+    """ Decrypt plain_size bytes in chunks of chunk_size from crypt_fp into plain_fp """
+    if not pipelined or plain_size < pipeline_min_size:
+        # The chunks are read into and decrypted into the same buffers.
+        buf = bytearray(chunk_size + crypto_ABYTES)
+        out = bytearray(chunk_size)
+        while plain_size > 0:
+            if sealed:
+                ciphertext = memoryview(buf)[0:min(chunk_size, plain_size) + crypto_ABYTES]
+            else:
+                ciphertext = memoryview(buf)
+            ciphertext = ciphertext[0:read_fully(crypt_fp, ciphertext)]
+            size, tag = crypto_pull_into(state, ciphertext, out)
+            plain_fp.write(memoryview(out)[0:size])
+            if sealed:
+                assert size == min(chunk_size, plain_size)
+                plain_size -= size
+                assert (tag == crypto_TAG_FINAL) == (plain_size == 0)
+            else:
+                assert size > 0
+                if tag == crypto_TAG_FINAL:
+                    break
+                plain_size -= chunk_size
+        return
+
+    num_chunks = (plain_size + chunk_size - 1) // chunk_size
+    to_read = plain_size + num_chunks * crypto_ABYTES if sealed else None
+    def read_into(buf):
+        nonlocal to_read
+        size = len(buf) if to_read is None else min(len(buf), to_read)
+        done = read_fully(crypt_fp, memoryview(buf)[0:size])
+        if to_read is not None:
+            to_read -= done
+        return done
+
+    to_pull = plain_size
+    def transform(view, out):
+        nonlocal to_pull
+        pos = 0
+        for start in range(0, len(view), chunk_size + crypto_ABYTES):
+            if to_pull <= 0:
+                break
+            size, tag = crypto_pull_into(state, view[start : start + chunk_size + crypto_ABYTES], memoryview(out)[pos:])
+            pos += size
+            if sealed:
+                assert size == min(chunk_size, to_pull)
+                to_pull -= size
+                assert (tag == crypto_TAG_FINAL) == (to_pull == 0)
+            else:
+                assert size > 0
+                to_pull = 0 if tag == crypto_TAG_FINAL else to_pull - chunk_size
+        return pos
+
+    block_chunks = max(1, pipeline_block_size // chunk_size)
+    run_pipeline(read_into, block_chunks * (chunk_size + crypto_ABYTES),
+                 transform, block_chunks * chunk_size, plain_fp.write)
+    assert to_pull <= 0
+
+compress_block_size = 2 ** 16
+# Files smaller than this are never compressed.
+compress_min_size = 2 ** 7
+
+def push_compressed(state, plain_fp, crypt_fp, plain_size, chunk_size, compressor, hasher=None):
+    """ Compress plain_size bytes from plain_fp and encrypt them into crypt_fp """
+    pending = bytearray()
+    def push_pending(final):
+        pos = 0
+        while len(pending) - pos > chunk_size or (final and pos < len(pending)):
+            piece = bytes(pending[pos : pos + chunk_size])
+            pos += len(piece)
+            tag = crypto_TAG_FINAL if final and pos == len(pending) else crypto_TAG_MESSAGE
+            crypt_fp.write(crypto_push(state, piece, tag=tag))
+        del pending[0:pos]
+
+    while plain_size > 0:
+        plaintext = plain_fp.read(min(compress_block_size, plain_size))
+        if len(plaintext) < min(compress_block_size, plain_size):
+            raise FileChangedError('file truncated while being encrypted')
+        if hasher:
+            hasher.update(plaintext)
+        pending.extend(compressor.compress(plaintext))
+        push_pending(False)
+        plain_size -= len(plaintext)
+    pending.extend(compressor.flush())
+    assert len(pending) > 0
+    push_pending(True)
+
+def pull_compressed(state, crypt_fp, plain_fp, plain_size, chunk_size, decompressor, contents_end):
+    """ Decrypt and decompress the chunks of crypt_fp up to contents_end into plain_fp """
+    while True:
+        size = min(chunk_size + crypto_ABYTES, contents_end - crypt_fp.tell())
+        assert size > crypto_ABYTES
+        plaintext, tag = crypto_pull(state, crypt_fp.read(size))
+        data = decompressor.decompress(plaintext)
+        plain_fp.write(data)
+        plain_size -= len(data)
+        if tag == crypto_TAG_FINAL:
+            break
+    data = decompressor.flush()
+    plain_fp.write(data)
+    plain_size -= len(data)
+    assert plain_size == 0
+
+# Files smaller than this are never treated as sparse.
+sparse_min_size = 2 ** 20
+# Files with more data extents than this are not treated as sparse, so that descriptors stay small.
+sparse_max_extents = 2 ** 16
+zero_block = bytes(2 ** 16)
+
+def sparse_extents(plain_fp, plain_size):
+    """ Return the (offset, length) of the data extents of plain_fp, or None if not worth it """
+    if plain_size < sparse_min_size or not hasattr(os, 'SEEK_HOLE') or isinstance(plain_fp, io.BytesIO):
+        return None
+    fd = plain_fp.fileno()
+    extents = []
+    pos = 0
+    try:
+        while pos < plain_size:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+            if start >= plain_size:
+                break
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), plain_size)
+            extents.append((start, end - start))
+            pos = end
+    except OSError as ex:
+        # ENXIO means that there is no data after pos.
+        if ex.errno != errno.ENXIO:
+            return None
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    if len(extents) > sparse_max_extents or extents == [(0, plain_size)]:
+        return None
+    return extents
+
+def hash_zeros(hasher, size):
+    while size > 0:
+        hasher.update(zero_block[0:min(size, len(zero_block))])
+        size -= len(zero_block)
+
+def write_zeros(fp, size):
+    while size > 0:
+        fp.write(zero_block[0:min(size, len(zero_block))])
+        size -= len(zero_block)
+
+class SparseReader(object):
+    """ File-like object that reads the concatenated data extents of plain_fp """
+
+    def __init__(self, plain_fp, extents, plain_size, hasher=None):
+        self.fp = plain_fp
+        self.extents = extents
+        self.plain_size = plain_size
+        self.hasher = hasher
+        self.index = 0
+        self.left = 0
+        self.pos = 0
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        while self.left == 0:
+            if self.index == len(self.extents):
+                return 0
+            offset, self.left = self.extents[self.index]
+            self.index += 1
+            if self.hasher:
+                hash_zeros(self.hasher, offset - self.pos)
+            self.fp.seek(offset)
+            self.pos = offset
+        count = self.fp.readinto(view[0:min(len(view), self.left)])
+        if not count:
+            return 0
+        if self.hasher:
+            self.hasher.update(view[0:count])
+        self.pos += count
+        self.left -= count
+        return count
+
+    def read(self, size):
+        buf = bytearray(size)
+        return bytes(buf[0:read_fully(self, memoryview(buf))])
+
+    def finish(self):
+        """ Hash the hole at the end of the file """
+        if self.hasher:
+            hash_zeros(self.hasher, self.plain_size - self.pos)
+
+class SparseWriter(object):
+    """ File-like object that writes concatenated data extents into plain_fp at their offsets """
+
+    def __init__(self, plain_fp, extents, seekable):
+        self.fp = plain_fp
+        self.extents = extents
+        self.seekable = seekable
+        self.index = 0
+        self.left = 0
+        self.pos = 0
+
+    def skip_to(self, offset):
+        if self.seekable:
+            self.fp.seek(offset)
+        else:
+            write_zeros(self.fp, offset - self.pos)
+        self.pos = offset
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            if self.left == 0:
+                offset, self.left = self.extents[self.index]
+                self.index += 1
+                self.skip_to(offset)
+            count = min(self.left, len(view))
+            self.fp.write(view[0:count])
+            view = view[count:]
+            self.left -= count
+            self.pos += count
+        return len(data)
+
+    def finish(self, plain_size):
+        if self.seekable:
+            self.fp.truncate(plain_size)
+        else:
+            self.skip_to(plain_size)
+
+def make_descriptor(chunk_size, plain_size, compressor, extents):
+    descriptor = (
+        chunk_size.to_bytes(4, byteorder='little', signed=False) +
+        plain_size.to_bytes(8, byteorder='little', signed=False) )
+    # The compression algorithm and the data extents are only recorded for compressed
+    # or sparse files, so that other files keep the original descriptor.
+    if compressor or extents is not None:
+        descriptor += (compressor.id if compressor else 0).to_bytes(1, byteorder='little', signed=False)
+    if extents is not None:
+        descriptor += len(extents).to_bytes(4, byteorder='little', signed=False)
+        for offset, length in extents:
+            descriptor += offset.to_bytes(8, byteorder='little', signed=False)
+            descriptor += length.to_bytes(8, byteorder='little', signed=False)
+    return descriptor
+
+def parse_descriptor(descriptor):
+    """ Return the (chunk_size, plain_size, compression, extents) of the descriptor of a sealed file """
+    chunk_size = int.from_bytes(descriptor[0:4], byteorder='little', signed=False)
+    plain_size = int.from_bytes(descriptor[4:12], byteorder='little', signed=False)
+    compression = descriptor[12] if len(descriptor) > 12 else 0
+    extents = None
+    if len(descriptor) > 13:
+        count = int.from_bytes(descriptor[13:17], byteorder='little', signed=False)
+        assert len(descriptor) == 17 + 16 * count
+        extents = []
+        end = 0
+        for pos in range(17, len(descriptor), 16):
+            offset = int.from_bytes(descriptor[pos:pos + 8], byteorder='little', signed=False)
+            length = int.from_bytes(descriptor[pos + 8:pos + 16], byteorder='little', signed=False)
+            assert offset >= end and length > 0
+            end = offset + length
+            extents.append((offset, length))
+        assert end <= plain_size
+    return (chunk_size, plain_size, compression, extents)
+
+def data_size(plain_size, extents):
+    return plain_size if extents is None else sum(length for _, length in extents)
+
+def file_encrypt(key, plain_file, crypt_file, metadata, chunk_size, sealed=False, pipelined=False, compress=None,
+                 limiter=None, plain_stat=None, dir_fd=None):
+    """ Encrypt plain_file together with metadata into crypt_file and return the metadata """
+    if sealed:
+        return sealed_encrypt(key, plain_file, crypt_file, metadata, chunk_size, pipelined, compress, limiter,
+                              plain_stat, dir_fd)
     metadata_size = len(metadata)
-    plain_size = os.path.getsize(plain_file) if plain_file else 0
+    if plain_stat is not None:
+        plain_size = plain_stat.st_size
+    else:
+        plain_size = os.path.getsize(plain_file) if plain_file else 0
     assert metadata_size >=0 and metadata_size < exp2_32
     assert chunk_size >= 0 and chunk_size < exp2_32
     assert plain_size >= 0 and plain_size < exp2_64
-    with tempfile.NamedTemporaryFile(mode='wb', dir=os.path.dirname(crypt_file)) as crypt_fp:
+    with temp_file(os.path.dirname(crypt_file), dir_fd) as crypt_fp:
         descriptor = (
             metadata_size.to_bytes(4, byteorder='little', signed=False) +
             chunk_size.to_bytes(4, byteorder='little', signed=False) +
@@ -35,21 +590,90 @@ def file_encrypt(key, plain_file, crypt_file, metadata, chunk_size):
         ciphertext = crypto_push(state, descriptor + metadata)
         crypt_fp.write(ciphertext)
         if plain_file:
-            with open(plain_file, 'rb') as plain_fp:
-                while plain_size > 0:
-                    plaintext = plain_fp.read(chunk_size)
-                    assert len(plaintext) > 0
-                    tag = crypto_TAG_MESSAGE if plain_size >= chunk_size else crypto_TAG_FINAL
-                    ciphertext = crypto_push(state, plaintext, tag=tag)
-                    crypt_fp.write(ciphertext)
-                    plain_size -= chunk_size
-        if os.path.exists(crypt_file):
-            os.remove(crypt_file)
-        os.link(crypt_fp.name, crypt_file)
-
-def file_decrypt(key, crypt_file, plain_file, metadata_only=False, metadata_test=None):
+            with open_plain(plain_file) as plain_fp:
+                push_contents(state, throttled(plain_fp, limiter), crypt_fp, plain_size, chunk_size, False,
+                              pipelined=pipelined)
+            check_unchanged(plain_file, plain_stat)
+        install_file(crypt_fp, crypt_file, dir_fd)
+    return metadata
+
+def sealed_encrypt(key, plain_file, crypt_file, metadata, chunk_size, pipelined, compress=None, limiter=None,
+                   plain_stat=None, dir_fd=None):
+    if isinstance(plain_file, (bytes, bytearray)):
+        plain_size = len(plain_file)
+        plain_stat = None
+    elif plain_stat is not None:
+        plain_size = plain_stat.st_size
+    else:
+        plain_size = os.path.getsize(plain_file) if plain_file else 0
+    assert chunk_size > 0 and chunk_size < exp2_32
+    assert plain_size >= 0 and plain_size < exp2_64
+    hasher = hashlib.blake2b(key=derive_key(key, b'content'), digest_size=32) if callable(metadata) else None
+    with open_plain(plain_file if plain_size > 0 else b'') as plain_fp, \
+         temp_file(os.path.dirname(crypt_file), dir_fd) as crypt_fp:
+        extents = sparse_extents(plain_fp, plain_size)
+        size = data_size(plain_size, extents)
+        contents_hasher = hasher
+        if extents is not None:
+            # The content digest covers the holes too, so that it does not depend on sparseness.
+            plain_fp = SparseReader(plain_fp, extents, plain_size, hasher)
+            contents_hasher = None
+        compressor = None
+        if compress and size >= compress_min_size and is_compressible(plain_file, plain_size):
+            compressor = Compressor(compress)
+        descriptor = make_descriptor(chunk_size, plain_size, compressor, extents)
+        crypt_fp.write(sealed_magic + len(descriptor).to_bytes(4, byteorder='little', signed=False))
+        state = crypto_state()
+        header = crypto_init_push(state, key)
+        crypt_fp.write(header)
+        tag = crypto_TAG_MESSAGE if size > 0 else crypto_TAG_FINAL
+        crypt_fp.write(crypto_push(state, descriptor, tag=tag))
+        if compressor:
+            push_compressed(state, throttled(plain_fp, limiter), crypt_fp, size, chunk_size, compressor,
+                            contents_hasher)
+        elif size > 0:
+            push_contents(state, throttled(plain_fp, limiter), crypt_fp, size, chunk_size, True,
+                          contents_hasher, pipelined)
+        if extents is not None:
+            plain_fp.finish()
+        check_unchanged(plain_file, plain_stat)
+        if hasher:
+            metadata = metadata(hasher.digest())
+        crypt_fp.write(seal_metadata(key, header, metadata))
+        install_file(crypt_fp, crypt_file, dir_fd)
+    return metadata
+
+def file_reseal(key, crypt_file, metadata, dst_file=None):
+    """ Replace the metadata of the sealed crypt_file through a temporary file """
+    dst_file = crypt_file if dst_file is None else dst_file
+    with open(crypt_file, 'rb') as crypt_fp:
+        assert crypt_fp.read(len(sealed_magic)) == sealed_magic
+        crypt_fp.read(4)
+        header = crypt_fp.read(crypto_HEADERBYTES)
+        _, trailer_start = open_metadata(key, crypt_fp, header)
+        crypt_fp.seek(0)
+        dir_fd = os.open(os.path.dirname(dst_file) or '.', os.O_RDONLY)
+        try:
+            with TempFileAt(dir_fd) as temp_fp:
+                remaining = trailer_start
+                while remaining > 0:
+                    data = crypt_fp.read(min(remaining, reseal_block_size))
+                    assert data
+                    temp_fp.write(data)
+                    remaining -= len(data)
+                temp_fp.write(seal_metadata(key, header, metadata))
+                temp_fp.install(os.path.basename(dst_file))
+        finally:
+            os.close(dir_fd)
+
+def file_decrypt(key, crypt_file, plain_file, metadata_only=False, metadata_test=None, pipelined=False,
+                 limiter=None):
+    """ Decrypt crypt_file into plain_file and return its metadata """
     with open(crypt_file, 'rb') as crypt_fp:
-        descriptor = crypt_fp.read(16)
+        descriptor = crypt_fp.read(4)
+        if descriptor == sealed_magic:
+            return sealed_decrypt(key, crypt_fp, plain_file, metadata_only, metadata_test, pipelined, limiter)
+        descriptor += crypt_fp.read(12)
         metadata_size = int.from_bytes(descriptor[0:4], byteorder='little', signed=False)
         chunk_size = int.from_bytes(descriptor[4:8], byteorder='little', signed=False)
         plain_size = int.from_bytes(descriptor[8:16], byteorder='little', signed=False)
@@ -64,19 +688,76 @@ def file_decrypt(key, crypt_file, plain_file, metadata_only=False, metadata_test
             return metadata
         if metadata_test:
             assert metadata_test(metadata)
-        with tempfile.NamedTemporaryFile(mode='wb', dir=os.path.dirname(plain_file)) as plain_fp:
-            while plain_size > 0:
-                ciphertext = crypt_fp.read(chunk_size + crypto_ABYTES)
-                plaintext, tag = crypto_pull(state, ciphertext)
-                assert len(plaintext) > 0
-                plain_fp.write(plaintext)
-                if tag == crypto_TAG_FINAL:
-                    break
-                plain_size -= chunk_size
-            if os.path.exists(plain_file):
-                os.remove(plain_file)
-            os.link(plain_fp.name, plain_file)
+        if hasattr(plain_file, 'write'):
+            pull_contents(state, crypt_fp, throttled(plain_file, limiter), plain_size, chunk_size, False, pipelined)
+            return metadata
+        with temp_file(os.path.dirname(plain_file)) as plain_fp:
+            pull_contents(state, crypt_fp, throttled(plain_fp, limiter), plain_size, chunk_size, False, pipelined)
+            install_file(plain_fp, plain_file)
+        return metadata
+
+def sealed_decrypt(key, crypt_fp, plain_file, metadata_only, metadata_test, pipelined, limiter=None):
+    descriptor_size = int.from_bytes(crypt_fp.read(4), byteorder='little', signed=False)
+    header = crypt_fp.read(crypto_HEADERBYTES)
+    metadata, trailer_start = open_metadata(key, crypt_fp, header)
+    if metadata_only:
         return metadata
+    if metadata_test:
+        assert metadata_test(metadata)
+    crypt_fp.seek(len(sealed_magic) + 4 + crypto_HEADERBYTES)
+    state = crypto_state()
+    crypto_init_pull(state, header, key)
+    descriptor, tag = crypto_pull(state, crypt_fp.read(descriptor_size + crypto_ABYTES))
+    chunk_size, plain_size, compression, extents = parse_descriptor(descriptor)
+    size = data_size(plain_size, extents)
+    assert (tag == crypto_TAG_FINAL) == (size == 0)
+    def pull(plain_fp, seekable):
+        plain_fp = throttled(plain_fp, limiter)
+        if extents is not None:
+            plain_fp = SparseWriter(plain_fp, extents, seekable)
+        if compression:
+            pull_compressed(state, crypt_fp, plain_fp, size, chunk_size,
+                            Decompressor(compression), trailer_start)
+        else:
+            pull_contents(state, crypt_fp, plain_fp, size, chunk_size, True, pipelined)
+        if extents is not None:
+            plain_fp.finish(plain_size)
+        assert crypt_fp.tell() == trailer_start
+    if hasattr(plain_file, 'write'):
+        pull(plain_file, False)
+        return metadata
+    with temp_file(os.path.dirname(plain_file)) as plain_fp:
+        pull(plain_fp, True)
+        install_file(plain_fp, plain_file)
+    return metadata
+
+def expected_size(key, crypt_file):
+    """ Return the minimum size of crypt_file according to its descriptor, or None """
+    try:
+        with open(crypt_file, 'rb') as crypt_fp:
+            prefix = crypt_fp.read(4)
+            if prefix == sealed_magic:
+                descriptor_size = int.from_bytes(crypt_fp.read(4), byteorder='little', signed=False)
+                header = crypt_fp.read(crypto_HEADERBYTES)
+                state = crypto_state()
+                crypto_init_pull(state, header, key)
+                descriptor, _ = crypto_pull(state, crypt_fp.read(descriptor_size + crypto_ABYTES))
+                size = len(sealed_magic) + 4 + crypto_HEADERBYTES + descriptor_size + crypto_ABYTES + 4
+                chunk_size, plain_size, compression, extents = parse_descriptor(descriptor)
+                if compression:
+                    # The size of compressed contents is not recorded.
+                    return size
+                plain_size = data_size(plain_size, extents)
+            else:
+                descriptor = prefix + crypt_fp.read(12)
+                metadata_size = int.from_bytes(descriptor[0:4], byteorder='little', signed=False)
+                chunk_size = int.from_bytes(descriptor[4:8], byteorder='little', signed=False)
+                plain_size = int.from_bytes(descriptor[8:16], byteorder='little', signed=False)
+                size = 16 + crypto_HEADERBYTES + 16 + metadata_size + crypto_ABYTES
+            num_chunks = (plain_size + chunk_size - 1) // chunk_size if chunk_size else 0
+            return size + plain_size + num_chunks * crypto_ABYTES
+    except Exception:
+        return None
 
 def path_encode(path):
     return b'\x00'.join([ part.encode('utf-8') for part in path.parts ])
@@ -15,8 +15,15 @@ from .dirconfig import (
     crypt_change_password,
     crypt_rebuild_meta,
 )
-from .dirsync import DirSync
+from .dirconfig import open_dirapi
+from .dirsync import DirSync, FanoutSync
+from .shardsync import ShardSync
+from .verify import DirVerify
+from .compression import available_algorithms
+from .throttle import io_classes, set_priority
+from .schedule import schedule_orders
 from .watchsync import WatchSync
+from pathlib import Path
 import argparse
 import logging
 
@@ -34,23 +41,73 @@ def dirsync(command, prog, argv):
         prog=prog,
         description="""
     Synchronize two directories via push or pull
-    push: copy local_dir to remote_dir
+    push: copy local_dir to remote_dir (or to each of several remote_dirs)
     pull: copy remote_dir to local_dir
 """,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('local_dir',
                         help='local directory (unencrypted)')
-    parser.add_argument('remote_dir',
+    parser.add_argument('remote_dir', nargs='+' if command == 'push' else None,
                         help='remote directory (encrypted or unencrypted)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help='verbose output')
     parser.add_argument('-d', '--diffonly', action='store_true', default=False,
                         help='only compute diffs between local_dir and remote_dir')
+    parser.add_argument('--no-renames', dest='detect_renames', action='store_false', default=True,
+                        help='copy renamed files instead of moving them')
+    parser.add_argument('-p', '--path', dest='subpaths', action='append', default=None, metavar='SUBPATH',
+                        help='synchronize only this subtree, relative to local_dir and remote_dir; '
+                             'may be given several times')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files to copy concurrently (default: 1)')
+    parser.add_argument('--meta-jobs', type=int, default=None,
+                        help='number of metadata operations to run concurrently when jobs > 1 (default: 4 * jobs)')
+    parser.add_argument('--scan-jobs', type=int, default=1,
+                        help='number of unencrypted directories to scan concurrently (default: 1)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of processes synchronizing the shards of an encrypted remote_dir (default: 1)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of encrypted files to read ahead while pulling (default: 0)')
+    parser.add_argument('--prefetch-bytes', type=int, default=None,
+                        help='maximum number of bytes to read ahead while pulling (default: 256 MiB)')
+    parser.add_argument('--meta-cache', action='store_true', default=False,
+                        help='cache the decrypted metadata of an encrypted remote_dir locally')
+    parser.add_argument('--catalog', action='store_true', default=False,
+                        help='keep the collected paths in an on-disk catalog instead of in memory')
+    parser.add_argument('--memory-budget', type=int, default=None, metavar='BYTES',
+                        help='memory used by the pages of the catalog (default: 256 MiB)')
+    parser.add_argument('--order', choices=schedule_orders, default='path',
+                        help='order in which files are copied: by path, most recently modified first, '
+                             'or smallest first (default: path)')
+    parser.add_argument('--priority', action='append', default=None, metavar='GLOB',
+                        help='copy the files matching this glob first; may be given several times, '
+                             'in decreasing order of priority')
+    parser.add_argument('--io-rate', type=int, default=None, metavar='BYTES',
+                        help='maximum number of bytes to read or write per second (default: no limit)')
+    parser.add_argument('--ops-rate', type=int, default=None, metavar='N',
+                        help='maximum number of metadata operations per second (default: no limit)')
+    parser.add_argument('--nice', type=int, default=None,
+                        help='lower the CPU priority by this niceness increment')
+    parser.add_argument('--io-class', choices=sorted(io_classes), default=None,
+                        help='I/O priority class (Linux only)')
     args = parser.parse_args(argv)
     logger = make_logger('%(message)s')
     if args.verbose or args.diffonly:
         logger.setLevel(logging.INFO)
-    syncer = DirSync(logger, **vars(args))
+    set_priority(args.nice, args.io_class)
+    options = vars(args)
+    if command == 'push':
+        remote_dirs = options.pop('remote_dir')
+        if len(remote_dirs) > 1:
+            if args.processes > 1:
+                parser.error('--processes does not support multiple remote directories')
+            FanoutSync(logger, remote_dirs=remote_dirs, **options).sync(command)
+            return
+        options['remote_dir'] = remote_dirs[0]
+    if args.processes > 1:
+        ShardSync(logger, **options).sync(command)
+        return
+    syncer = DirSync(logger, **options)
     syncer.sync(command)
 
 def dirwatch(command, prog, argv):
@@ -70,12 +127,56 @@ def dirwatch(command, prog, argv):
                         help='verbose output')
     parser.add_argument('-d', '--diffonly', action='store_true', default=False,
                         help='only compute diffs between local_dir and remote_dir')
+    parser.add_argument('--no-renames', dest='detect_renames', action='store_false', default=True,
+                        help='copy renamed files instead of moving them')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files to copy concurrently (default: 1)')
+    parser.add_argument('--meta-jobs', type=int, default=None,
+                        help='number of metadata operations to run concurrently when jobs > 1 (default: 4 * jobs)')
+    parser.add_argument('--scan-jobs', type=int, default=1,
+                        help='number of unencrypted directories to scan concurrently (default: 1)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of encrypted files to read ahead while pulling (default: 0)')
+    parser.add_argument('--prefetch-bytes', type=int, default=None,
+                        help='maximum number of bytes to read ahead while pulling (default: 256 MiB)')
+    parser.add_argument('--meta-cache', action='store_true', default=False,
+                        help='cache the decrypted metadata of an encrypted remote_dir locally')
+    parser.add_argument('--catalog', action='store_true', default=False,
+                        help='keep the collected paths in an on-disk catalog instead of in memory')
+    parser.add_argument('--memory-budget', type=int, default=None, metavar='BYTES',
+                        help='memory used by the pages of the catalog (default: 256 MiB)')
+    parser.add_argument('--order', choices=schedule_orders, default='path',
+                        help='order in which files are copied: by path, most recently modified first, '
+                             'or smallest first (default: path)')
+    parser.add_argument('--priority', action='append', default=None, metavar='GLOB',
+                        help='copy the files matching this glob first; may be given several times, '
+                             'in decreasing order of priority')
+    parser.add_argument('--io-rate', type=int, default=None, metavar='BYTES',
+                        help='maximum number of bytes to read or write per second (default: no limit)')
+    parser.add_argument('--ops-rate', type=int, default=None, metavar='N',
+                        help='maximum number of metadata operations per second (default: no limit)')
+    parser.add_argument('--nice', type=int, default=None,
+                        help='lower the CPU priority by this niceness increment')
+    parser.add_argument('--io-class', choices=sorted(io_classes), default=None,
+                        help='I/O priority class (Linux only)')
     parser.add_argument('-s', '--settle', type=float, default=0.2,
                         help='Seconds to wait for changes to settle before synchronizing')
+    parser.add_argument('--max-delay', type=float, default=10.0,
+                        help='Seconds after a change by which a sync is started even if changes '
+                             'keep coming (default: 10; 0 means no limit)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve metrics in Prometheus format on this local port')
+    parser.add_argument('--metrics-addr', default='127.0.0.1',
+                        help='address to serve metrics on (default: 127.0.0.1)')
+    parser.add_argument('--metrics-file', default=None,
+                        help='periodically rewrite metrics to this file for a textfile collector')
+    parser.add_argument('--throttle-file', default=None,
+                        help='JSON file of io_rate and ops_rate, reread when it changes or on SIGUSR1')
     args = parser.parse_args(argv)
     logger = make_logger('%(asctime)s %(message)s')
     if args.verbose or args.diffonly:
         logger.setLevel(logging.INFO)
+    set_priority(args.nice, args.io_class)
     WatchSync(logger, command, **vars(args))
 
 def dirinit(command, prog, argv):
@@ -92,6 +193,13 @@ def dirinit(command, prog, argv):
                         help='Overwrite config file if it already exists')
     parser.add_argument('-x', '--exclude', action='append', default=[],
                         help='filename pattern to exclude (there may be multiple such patterns)')
+    if command == 'init-crypt':
+        parser.add_argument('-c', '--compress', choices=available_algorithms(), default=None,
+                            help='compress files before encrypting them')
+        parser.add_argument('-p', '--pack-threshold', type=int, default=None, metavar='BYTES',
+                            help='store files smaller than BYTES together in pack files')
+        parser.add_argument('-D', '--dedup', action='store_true', default=False,
+                            help='store the contents of identical files only once')
     args = parser.parse_args(argv)
     dir_type = 'crypt' if command == 'init-crypt' else 'plain'
     init_config(dir_type, **vars(args))
@@ -112,6 +220,39 @@ def dirmod(command, prog, argv):
     elif command == 'rebuild-meta':
         crypt_rebuild_meta(**vars(args))
 
+def dirverify(command, prog, argv):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="""
+    Verify the integrity of the encrypted files of an encrypted directory
+""",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dir_path',
+                        help='directory path')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='verbose output')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of files to verify concurrently (default: 4)')
+    parser.add_argument('--rate', type=int, default=None, metavar='BYTES',
+                        help='maximum number of bytes to verify per second (default: no limit)')
+    parser.add_argument('--max-age', type=float, default=30, metavar='DAYS',
+                        help='skip files verified less than DAYS days ago (default: 30)')
+    parser.add_argument('--state-file', default=None,
+                        help='file recording when files were last verified (default: under ~/.cache)')
+    args = parser.parse_args(argv)
+    logger = make_logger('%(message)s')
+    if args.verbose:
+        logger.setLevel(logging.INFO)
+    crypt_api = open_dirapi(Path(args.dir_path).resolve())
+    if crypt_api.dir_type != 'crypt':
+        raise ValueError(f"Error: {args.dir_path} is not an encrypted directory")
+    verifier = DirVerify(logger, crypt_api, jobs=args.jobs, rate=args.rate, max_age=args.max_age,
+                         state_file=args.state_file, verbose=args.verbose)
+    counts = verifier.run()
+    print(', '.join(f'{status}: {count}' for status, count in sorted(counts.items())))
+    if verifier.problems:
+        sys.exit(1)
+
 def main():
     parser = argparse.ArgumentParser(
         usage=f"{__pkg_name__} command [<args>]",
@@ -126,6 +267,7 @@ def main():
                             'watch-push', 'watch-pull',
                             'init-plain', 'init-crypt',
                             'change-password', 'rebuild-meta',
+                            'verify',
                         ],
                         help='command')
     command = parser.parse_args(sys.argv[1:2]).command
@@ -139,6 +281,8 @@ def main():
         dirinit(command, prog, argv)
     elif command in ['change-password', 'rebuild-meta']:
         dirmod(command, prog, argv)
+    elif command == 'verify':
+        dirverify(command, prog, argv)
     else:
         sys.stdout.write(f"Invalid command: {command}\n")
         sys.exit(1)
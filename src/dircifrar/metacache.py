@@ -0,0 +1,107 @@
+
+from .__init__ import __pkg_name__
+from .filecrypt import derive_key
+from nacl.secret import SecretBox
+from nacl.exceptions import CryptoError
+from pathlib import Path
+import os, hashlib, tempfile, threading
+
+def local_cache_file(dir_root, kind, suffix):
+    """ The local file under the XDG cache directory keeping the state of the given kind about dir_root """
+    cache_dir = Path(os.environ.get('XDG_CACHE_HOME', None) or Path.home() / '.cache') / __pkg_name__
+    digest = hashlib.blake2b(str(dir_root).encode('utf-8'), digest_size=16).hexdigest()
+    return cache_dir / f'{kind}-{digest}{suffix}'
+
+def default_cache_file(dir_root):
+    """ The local file caching the decrypted metadata of the encrypted directory dir_root """
+    return local_cache_file(dir_root, 'meta', '.bin')
+
+def stat_key(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+class MetaCache(object):
+    """ Encrypted local cache of the decrypted metadata files of an encrypted directory """
+
+    def __init__(self, cache_file, crypt_key):
+        self.cache_file = Path(cache_file)
+        self.box = SecretBox(derive_key(crypt_key, b'metacache'))
+        self.lock = threading.Lock()
+        self.entries = None
+        self.changed = False
+
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = dict()
+        try:
+            with open(self.cache_file, 'rb') as fp:
+                data = self.box.decrypt(fp.read())
+        except (OSError, CryptoError, ValueError):
+            # A missing, corrupted or foreign cache is just empty.
+            return
+        pos = 0
+        while pos < len(data):
+            name_size = int.from_bytes(data[pos : pos + 2], byteorder='little', signed=False)
+            name = data[pos + 2 : pos + 2 + name_size].decode('utf-8')
+            pos += 2 + name_size
+            key = tuple(int.from_bytes(data[pos + 8 * i : pos + 8 * (i + 1)], byteorder='little', signed=False)
+                        for i in range(3))
+            pos += 24
+            metadata_size = int.from_bytes(data[pos : pos + 4], byteorder='little', signed=False)
+            self.entries[name] = (key, data[pos + 4 : pos + 4 + metadata_size])
+            pos += 4 + metadata_size
+
+    def save(self):
+        """ Write the cache file if the cache has changed """
+        with self.lock:
+            if not self.changed:
+                return
+            data = []
+            for name, (key, metadata) in self.entries.items():
+                name_bytes = name.encode('utf-8')
+                data.append(len(name_bytes).to_bytes(2, byteorder='little', signed=False) + name_bytes)
+                data.extend(value.to_bytes(8, byteorder='little', signed=False) for value in key)
+                data.append(len(metadata).to_bytes(4, byteorder='little', signed=False) + metadata)
+            self.changed = False
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        fp = tempfile.NamedTemporaryFile(mode='wb', dir=self.cache_file.parent, delete=False)
+        try:
+            with fp:
+                fp.write(self.box.encrypt(b''.join(data)))
+            os.replace(fp.name, self.cache_file)
+        except:
+            os.unlink(fp.name)
+            with self.lock:
+                self.changed = True
+            raise
+
+    def get(self, crypt_path, st):
+        """ Return the cached metadata of crypt_path if it has not changed since st, and None otherwise """
+        with self.lock:
+            self.load()
+            entry = self.entries.get(crypt_path.as_posix(), None)
+        if entry is None or entry[0] != stat_key(st):
+            return None
+        return entry[1]
+
+    def put(self, crypt_path, st, metadata):
+        with self.lock:
+            self.load()
+            self.entries[crypt_path.as_posix()] = (stat_key(st), bytes(metadata))
+            self.changed = True
+
+    def discard(self, crypt_path):
+        with self.lock:
+            self.load()
+            if self.entries.pop(crypt_path.as_posix(), None) is not None:
+                self.changed = True
+
+    def retain(self, crypt_paths):
+        """ Drop the entries of the metadata files other than crypt_paths """
+        names = { crypt_path.as_posix() for crypt_path in crypt_paths }
+        with self.lock:
+            self.load()
+            for name in list(self.entries):
+                if name not in names:
+                    del self.entries[name]
+                    self.changed = True
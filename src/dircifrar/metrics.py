@@ -0,0 +1,183 @@
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import os, tempfile, threading, time
+
+# Each metric is described by (type, help, buckets), where buckets is only used by histograms.
+
+seconds_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+count_buckets = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+bytes_buckets = (0, 2 ** 10, 2 ** 15, 2 ** 20, 2 ** 25, 2 ** 30, 2 ** 35, 2 ** 40)
+
+metric_specs = {
+    'dircifrar_watch_events_total':
+        ('counter', 'Number of file change notifications received', None),
+    'dircifrar_watch_backlog':
+        ('gauge', 'Number of file change notifications not yet synchronized', None),
+    'dircifrar_watch_settle_seconds':
+        ('histogram', 'Time from the first change notification to the start of a sync', seconds_buckets),
+    'dircifrar_sync_total':
+        ('counter', 'Number of syncs started', None),
+    'dircifrar_sync_errors_total':
+        ('counter', 'Number of syncs that failed', None),
+    'dircifrar_sync_duration_seconds':
+        ('histogram', 'Duration of a sync', seconds_buckets),
+    'dircifrar_sync_files':
+        ('histogram', 'Number of files copied per sync', count_buckets),
+    'dircifrar_sync_bytes':
+        ('histogram', 'Number of bytes copied per sync', bytes_buckets),
+    'dircifrar_synced_files_total':
+        ('counter', 'Number of files copied', None),
+    'dircifrar_synced_bytes_total':
+        ('counter', 'Number of bytes copied', None),
+    'dircifrar_operations_total':
+        ('counter', 'Number of operations done by syncs, by kind', None),
+    'dircifrar_last_success_timestamp_seconds':
+        ('gauge', 'Unix time of the last successful sync', None),
+}
+
+# The kinds of operations counted by dircifrar_operations_total (in its op label), by the messages
+# that DirSyncRes counts.  Messages not listed here are counted as 'other'.
+operation_kinds = {
+    'PUSH FILE': 'copy_file',
+    'COPY FILE': 'copy_file',
+    'MOVE FILE': 'move_file',
+    'DEDUP FILE': 'dedup_file',
+    'REMOVE FILE': 'remove_file',
+    'ADD DIR': 'make_dir',
+    'REMOVE DIR': 'remove_dir',
+}
+# The metrics with a label, by the name of the label and its values.
+labeled_metrics = {
+    'dircifrar_operations_total': ('op', sorted(set(operation_kinds.values())) + ['other']),
+}
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+class SyncMetrics(object):
+    """ Object for collecting the metrics of a watch daemon in Prometheus format """
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self.lock = threading.Lock()
+        self.values = dict()
+        self.histograms = dict()
+        for name, (mtype, _, buckets) in metric_specs.items():
+            if mtype == 'histogram':
+                self.histograms[name] = {'buckets': [0] * len(buckets), 'count': 0, 'sum': 0}
+            elif name in labeled_metrics:
+                self.values[name] = { value: 0 for value in labeled_metrics[name][1] }
+            else:
+                self.values[name] = 0
+        self.server = None
+
+    def inc(self, name, value=1, label=None):
+        with self.lock:
+            if label is None:
+                self.values[name] += value
+            else:
+                self.values[name][label] += value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def observe(self, name, value):
+        buckets = metric_specs[name][2]
+        with self.lock:
+            hist = self.histograms[name]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+            hist['count'] += 1
+            hist['sum'] += value
+
+    def label_str(self, extra=None):
+        labels = sorted(self.labels.items()) + sorted((extra or {}).items())
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in labels) + '}'
+
+    def render(self):
+        """ Return all metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for name, (mtype, help, buckets) in metric_specs.items():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {mtype}')
+                if mtype == 'histogram':
+                    hist = self.histograms[name]
+                    for bound, count in zip(buckets, hist['buckets']):
+                        lines.append(f'{name}_bucket{self.label_str({"le": format_value(bound)})} {count}')
+                    lines.append(f'{name}_bucket{self.label_str({"le": "+Inf"})} {hist["count"]}')
+                    lines.append(f'{name}_sum{self.label_str()} {format_value(hist["sum"])}')
+                    lines.append(f'{name}_count{self.label_str()} {hist["count"]}')
+                elif name in labeled_metrics:
+                    label = labeled_metrics[name][0]
+                    for value, count in self.values[name].items():
+                        lines.append(f'{name}{self.label_str({label: value})} {format_value(count)}')
+                else:
+                    lines.append(f'{name}{self.label_str()} {format_value(self.values[name])}')
+        return '\n'.join(lines) + '\n'
+
+    def record_sync(self, start, res=None, error=False):
+        """ Record a finished sync started at time.time() == start """
+        self.observe('dircifrar_sync_duration_seconds', time.time() - start)
+        if error:
+            self.inc('dircifrar_sync_errors_total')
+            return
+        files = res.copied if res else 0
+        nbytes = res.nbytes if res else 0
+        self.observe('dircifrar_sync_files', files)
+        self.observe('dircifrar_sync_bytes', nbytes)
+        self.inc('dircifrar_synced_files_total', files)
+        self.inc('dircifrar_synced_bytes_total', nbytes)
+        for msg, count in (res.counts.items() if res else ()):
+            self.inc('dircifrar_operations_total', count, operation_kinds.get(msg, 'other'))
+        self.set('dircifrar_last_success_timestamp_seconds', time.time())
+
+    def serve(self, port, addr='127.0.0.1'):
+        """ Serve the metrics over HTTP in a daemon thread and return the bound port """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((addr, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self.server.server_address[1]
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def write_textfile(self, path):
+        """ Atomically rewrite path for the node_exporter textfile collector """
+        path = os.path.abspath(path)
+        fp = tempfile.NamedTemporaryFile(mode='w', dir=os.path.dirname(path), delete=False)
+        try:
+            with fp:
+                fp.write(self.render())
+            # NamedTemporaryFile is private to its owner, but the collector may run as another user.
+            os.chmod(fp.name, 0o644)
+            os.replace(fp.name, path)
+        except:
+            os.unlink(fp.name)
+            raise
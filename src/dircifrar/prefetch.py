@@ -0,0 +1,70 @@
+
+import os, threading
+
+# The number of bytes read from the beginning of a file to make it available locally.
+read_ahead_size = 2 ** 16
+
+def read_ahead(file):
+    """ Open file and read its beginning, so that an on-demand cloud client downloads it """
+    try:
+        fd = os.open(file, os.O_RDONLY)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            os.read(fd, read_ahead_size)
+        finally:
+            os.close(fd)
+    except OSError:
+        # The file is read again when it is actually needed, which reports any error.
+        pass
+
+class Prefetcher(object):
+    """ Read ahead a list of (file, size) in background threads """
+
+    def __init__(self, files, read, count, nbytes):
+        self.files = files
+        self.read = read
+        self.count = count
+        self.nbytes = nbytes
+        self.consumed = 0
+        self.next = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.threads = [ threading.Thread(target=self.worker, daemon=True)
+                         for _ in range(min(count, len(files))) ]
+        for thread in self.threads:
+            thread.start()
+
+    def in_window(self, i):
+        if i >= self.consumed + self.count:
+            return False
+        # The file right after the consumed ones is always read ahead, however large it is.
+        return i == self.consumed or \
+            sum(size for _, size in self.files[self.consumed : i + 1]) <= self.nbytes
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    i = max(self.next, self.consumed)
+                    if self.stopped or i >= len(self.files):
+                        return
+                    if self.in_window(i):
+                        break
+                    self.cond.wait()
+                self.next = i + 1
+            self.read(self.files[i][0])
+
+    def consume(self, i):
+        """ Record that the i-th file is being consumed, which moves the window past it """
+        with self.cond:
+            if i + 1 > self.consumed:
+                self.consumed = i + 1
+                self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,46 @@
+
+from .exclude import glob_prefix, parse_glob
+import re
+
+schedule_orders = ('path', 'recent', 'small')
+# While smaller files are waiting to be copied, files of at least this size are copied by at most
+# half of the workers, so that the smaller files keep flowing through the other workers.
+schedule_large_size = 2 ** 26
+
+class Scheduler(object):
+    """ Policy for ordering the files copied in a phase of a synchronization """
+
+    def __init__(self, order='path', priority=()):
+        if order not in schedule_orders:
+            raise ValueError(f'Error: unknown order: {order}')
+        self.order = order
+        self.globs = []
+        for glob in priority:
+            if glob.startswith(glob_prefix):
+                glob = glob[len(glob_prefix):]
+            # A directory has priority together with all of its contents.
+            if glob.endswith('/'):
+                glob += '**'
+            self.globs.append(re.compile(parse_glob(glob)[0]))
+
+    def rank(self, path):
+        posix = path.as_posix()
+        for i, regex in enumerate(self.globs):
+            if regex.fullmatch(posix):
+                return i
+        return len(self.globs)
+
+    def key(self, api, path):
+        meta = api.included.get(path, {})
+        if self.order == 'recent':
+            return (self.rank(path), -(meta.get('mtime', None) or 0), path)
+        if self.order == 'small':
+            return (self.rank(path), meta.get('size', None) or 0, path)
+        return (self.rank(path), path)
+
+    def sort(self, phase, api):
+        """ Sort the operations (kind, path, op) of phase, whose paths are those of api """
+        return sorted(phase, key=lambda item: self.key(api, item[1]))
+
+    def is_large(self, api, path):
+        return (api.included.get(path, {}).get('size', None) or 0) >= schedule_large_size
@@ -0,0 +1,220 @@
+
+from .__init__ import __pkg_name__
+from .dirsync import AbsDirSync, DirCmp, DirSync, DirSyncRes
+from .filecrypt import path_hash
+from logging.handlers import QueueHandler, QueueListener
+import logging, traceback, multiprocessing
+
+# The number of top-level directories (the first byte of path_hash) into which an encrypted
+# directory is partitioned, which are distributed among the worker processes.
+shard_count = 256
+
+def shard_names(index, processes):
+    """ The names of the top-level directories synchronized by the worker process index """
+    return [ f'{shard:02x}' for shard in range(shard_count) if shard % processes == index ]
+
+def shard_index(crypt_key, path, processes):
+    """ The index of the worker process that synchronizes path """
+    return int(path_hash(crypt_key, path).parts[0], 16) % processes
+
+class LogForwarder(logging.Handler):
+    """ Handler passing the log records of the worker processes on to the logger of the coordinator """
+
+    def __init__(self, logger):
+        super().__init__()
+        self.logger = logger
+
+    def emit(self, record):
+        self.logger.log(record.levelno, record.getMessage())
+
+class ShardSync(object):
+    """ Object for synchronizing with an encrypted directory by several processes """
+
+    def __init__(self, logger, local_dir, remote_dir, **options):
+        self.logger = logger
+        self.options = options
+        self.processes = max(1, options.get('processes', None) or 1)
+        self.syncer = DirSync(logger, local_dir, remote_dir, **options)
+
+    def fallback(self, command):
+        """ The reason why the sync cannot be done by several processes, or None if it can """
+        remote_api = self.syncer.remote_api
+        if remote_api.dir_type != 'crypt':
+            return 'remote_dir is not encrypted'
+        if command == 'push' and remote_api.dedup:
+            return 'remote_dir stores identical files only once'
+        if self.options.get('diffonly', False):
+            return 'only the diffs are computed'
+        if self.options.get('subpaths', None):
+            return 'only some subtrees are synchronized'
+        return None
+
+    def sync(self, command):
+        if command not in ('push', 'pull'):
+            raise ValueError("Error: command must be 'push' or 'pull'")
+        reason = self.fallback(command) if self.processes > 1 else None
+        if reason:
+            self.logger.warning(f'WARNING: {reason}, so it is synchronized by a single process')
+        if self.processes <= 1 or reason:
+            return self.syncer.sync(command)
+
+        local_api = self.syncer.local_api
+        remote_api = self.syncer.remote_api
+        if command == 'push':
+            remote_api.upgrade_format()
+        local_api.collect_paths()
+        remote_api.prepare_shards()
+        buckets = [ dict() for _ in range(self.processes) ]
+        for path, meta in local_api.included.items():
+            buckets[shard_index(remote_api.crypt_key, path, self.processes)][path] = meta
+        # The workers never prompt for the password: the master key is passed to them once, with their setup.
+        worker_options = dict(self.options, crypt_key=remote_api.crypt_key, detect_renames=False,
+                              meta_cache=False, diffonly=False)
+
+        ctx = multiprocessing.get_context('spawn')
+        log_queue = ctx.Queue()
+        listener = QueueListener(log_queue, LogForwarder(self.logger))
+        listener.start()
+        workers = []
+        try:
+            for index in range(self.processes):
+                conn, child_conn = ctx.Pipe()
+                proc = ctx.Process(target=shard_worker, args=(child_conn, log_queue), daemon=True)
+                proc.start()
+                child_conn.close()
+                workers.append((proc, conn))
+                conn.send({
+                    'command': command,
+                    'local_dir': self.syncer.local_dir,
+                    'remote_dir': self.syncer.remote_dir,
+                    'options': worker_options,
+                    'shards': shard_names(index, self.processes),
+                    'local_included': buckets[index],
+                    'level': self.logger.getEffectiveLevel(),
+                })
+            plans = [ self.receive(index, conn, 'planned') for index, (proc, conn) in enumerate(workers) ]
+            res = DirSyncRes(self.logger)
+            removed_dirs = self.sync_structure(command, plans, res)
+            for proc, conn in workers:
+                conn.send(removed_dirs)
+            pack_touched = set()
+            for index, (proc, conn) in enumerate(workers):
+                counts, errors, nbytes, touched = self.receive(index, conn, 'done')
+                for msg, count in counts.items():
+                    res.counts[msg] = res.counts.get(msg, 0) + count
+                res.errors += errors
+                res.nbytes += nbytes
+                pack_touched |= touched
+            if command == 'push':
+                remote_api.finish_shards(pack_touched)
+            return res
+        finally:
+            # A worker still waiting for the coordinator exits once its pipe is closed.
+            for proc, conn in workers:
+                conn.close()
+            for proc, conn in workers:
+                proc.join()
+            listener.stop()
+
+    def receive(self, index, conn, tag):
+        try:
+            kind, value = conn.recv()
+        except EOFError:
+            raise RuntimeError(f'Error: worker process {index} exited unexpectedly')
+        if kind == 'error':
+            raise RuntimeError(f'Error: worker process {index} failed:\n{value}')
+        assert kind == tag
+        return value
+
+    def sync_structure(self, command, plans, res):
+        """ Make, remove and replace the directories of all shards in single-process order """
+        made, removed, replaced = dict(), dict(), dict()
+        for shard_made, shard_removed, shard_replaced in plans:
+            made.update(shard_made)
+            removed.update(shard_removed)
+            replaced.update(shard_replaced)
+        local_api = self.syncer.local_api
+        remote_api = self.syncer.remote_api
+        if command == 'push':
+            src_api, dst_api, copy_file = local_api, remote_api, self.syncer.push_file
+            # The coordinator sees only the remote paths that it changes itself.
+            dst_api.included = { **removed, **{ path: dst_meta for path, (src_meta, dst_meta) in replaced.items() } }
+            dst_api.defer_tree = True
+        else:
+            src_api, dst_api, copy_file = remote_api, local_api, self.syncer.pull_file
+            src_api.included = { **made, **{ path: src_meta for path, (src_meta, dst_meta) in replaced.items() } }
+        removed_dirs = set(removed) | { path for path in replaced if dst_api.get_path_type(path) == 'DIR' }
+        dcmp = DirCmp(src_api.dir_root, dst_api.dir_root, set(), set(),
+                      set(made), set(removed), set(replaced), set(replaced))
+        ds = AbsDirSync(self.logger, src_api, dst_api, copy_file,
+                        dict(self.options, detect_renames=False, ops_limiter=self.syncer.ops_limiter))
+        ds.run_phases(ds.sync_phases(dcmp, res))
+        return removed_dirs
+
+class ShardWorker(object):
+    """ The synchronization of the shards of a worker process of ShardSync """
+
+    def __init__(self, logger, conn, setup):
+        self.logger = logger
+        self.conn = conn
+        self.setup = setup
+
+    def run(self):
+        setup = self.setup
+        syncer = DirSync(self.logger, setup['local_dir'], setup['remote_dir'], **setup['options'])
+        local_api = syncer.local_api
+        remote_api = syncer.remote_api
+        local_api.included = setup['local_included']
+        local_api.excluded = set()
+        remote_api.collect_shards(setup['shards'])
+        remote_api.defer_tree = True
+        if setup['command'] == 'push':
+            ds = syncer.engine(local_api, remote_api, syncer.push_file)
+        else:
+            ds = syncer.engine(remote_api, local_api, syncer.pull_file)
+        res = ds.sync_dirs(paths=(set(ds.src_api.included), set(ds.dst_api.included)), planned=self.planned(ds))
+        # The garbage in the touched pack files is collected by the coordinator.
+        pack_touched = getattr(remote_api, 'pack_touched', set())
+        return (res.counts, res.errors, res.nbytes, set(pack_touched))
+
+    def planned(self, ds):
+        def planned(dcmp):
+            src_api, dst_api = ds.src_api, ds.dst_api
+            made = { path: src_api.included[path] for path in dcmp.src_only
+                     if src_api.get_path_type(path) == 'DIR' }
+            removed = { path: dst_api.included[path] for path in dcmp.dst_only
+                        if dst_api.get_path_type(path) == 'DIR' }
+            replaced = { path: (src_api.included[path], dst_api.included[path]) for path in dcmp.truly_changed
+                         if src_api.get_path_type(path) != dst_api.get_path_type(path) }
+            self.conn.send(('planned', (made, removed, replaced)))
+            # The coordinator has made, removed and replaced these paths by the time it replies.
+            removed_dirs = self.conn.recv()
+            dcmp.src_only -= set(made)
+            dcmp.dst_only -= set(removed)
+            dcmp.changed -= set(replaced)
+            dcmp.truly_changed -= set(replaced)
+            if dst_api.dir_type == 'plain':
+                # The contents of the removed directories of local_dir are gone with them.
+                dcmp.dst_only = { path for path in dcmp.dst_only
+                                  if not any(parent in removed_dirs for parent in path.parents) }
+        return planned
+
+def shard_worker(conn, log_queue):
+    """ The main function of a worker process of ShardSync """
+    try:
+        setup = conn.recv()
+        logger = logging.getLogger(f'{__pkg_name__}.shard')
+        logger.setLevel(setup['level'])
+        logger.propagate = False
+        logger.addHandler(QueueHandler(log_queue))
+        conn.send(('done', ShardWorker(logger, conn, setup).run()))
+    except EOFError:
+        # The coordinator has given up.
+        pass
+    except BaseException:
+        try:
+            conn.send(('error', traceback.format_exc()))
+        except OSError:
+            pass
+    finally:
+        conn.close()
@@ -0,0 +1,92 @@
+
+import os, sys, ctypes, platform, shutil, threading, time
+
+class TokenBucket(object):
+    """ Thread-safe token bucket limiting a rate per second; a rate of None or 0 means no limit """
+
+    def __init__(self, rate=None, burst=None):
+        # The lock is reentrant so that the rate can be changed by a signal handler.
+        self.lock = threading.RLock()
+        # Consumers waiting for tokens are woken up when the rate is changed.
+        self.cond = threading.Condition(self.lock)
+        self.changes = 0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate or 0
+            self.burst = burst or self.rate
+            self.tokens = self.burst
+            self.last = time.monotonic()
+            self.changes += 1
+            self.cond.notify_all()
+
+    def consume(self, amount):
+        """ Take amount tokens, sleeping as long as needed to stay within the rate """
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # The tokens may become negative, in which case later consumers wait even longer.
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return
+            deadline = now - self.tokens / self.rate
+            changes = self.changes
+            # A new rate starts with a full bucket, so the consumers waiting for the old one stop waiting.
+            while self.changes == changes and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+
+class ThrottledFile(object):
+    """ Wrapper of a file object whose reads and writes are limited by a token bucket """
+
+    def __init__(self, fp, limiter):
+        self.fp = fp
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+    def readinto(self, buf):
+        count = self.fp.readinto(buf)
+        self.limiter.consume(count or 0)
+        return count
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        return self.fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+def throttled(fp, limiter):
+    return ThrottledFile(fp, limiter) if limiter else fp
+
+def throttled_copy(src_file, dst_file, limiter, block_size=2 ** 16):
+    """ Like shutil.copy2 for regular files, but at a rate limited by limiter """
+    with open(src_file, 'rb') as src_fp, open(dst_file, 'wb') as dst_fp:
+        shutil.copyfileobj(ThrottledFile(src_fp, limiter), dst_fp, block_size)
+    shutil.copystat(src_file, dst_file, follow_symlinks=False)
+
+# The I/O priority classes of Linux and the numbers of the ioprio_set system call.
+io_classes = {'best-effort': 2, 'idle': 3}
+ioprio_set_syscalls = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+
+def set_priority(nice=None, io_class=None):
+    """ Lower the CPU priority of this process by nice and put it in the I/O priority class io_class """
+    if nice:
+        os.nice(nice)
+    if io_class:
+        number = ioprio_set_syscalls.get(platform.machine(), None)
+        if not sys.platform.startswith('linux') or number is None:
+            raise ValueError(f"Error: I/O priority classes are not supported on this platform")
+        libc = ctypes.CDLL(None, use_errno=True)
+        # ioprio_set(IOPRIO_WHO_PROCESS, 0 (this process), class << 13 | level)
+        level = 0 if io_class == 'idle' else 4
+        if libc.syscall(number, 1, 0, (io_classes[io_class] << 13) | level) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
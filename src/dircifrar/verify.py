@@ -0,0 +1,168 @@
+
+from .dirapi_crypt import dest_metadata, dest_pack_index, dest_object_refs, dest_object_metadata, pack_name_pattern
+from .filecrypt import file_decrypt, expected_size, path_hash, derive_key, is_temp_name
+from .metacache import local_cache_file
+from .throttle import TokenBucket
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import os, sys, json, time, hashlib, tempfile, threading
+
+day_seconds = 24 * 60 * 60
+
+def exc_info():
+    return str(sys.exc_info()[1])
+
+def default_state_file(dir_root):
+    """ The local file recording when the files of dir_root were last verified """
+    return local_cache_file(dir_root, 'verify', '.json')
+
+class NullSink(object):
+    """ File-like object that discards what is written to it, at a rate limited by limiter """
+
+    def __init__(self, limiter, hasher=None):
+        self.limiter = limiter
+        self.hasher = hasher
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        if self.hasher:
+            self.hasher.update(data)
+        return len(data)
+
+class DirVerify(object):
+    """ Object for verifying the encrypted files of a directory without writing any plaintext """
+
+    def __init__(self, logger, crypt_api, jobs=4, rate=None, max_age=30, state_file=None, verbose=False):
+        assert crypt_api.dir_type == 'crypt'
+        self.logger = logger
+        self.api = crypt_api
+        self.jobs = max(1, jobs or 1)
+        self.limiter = TokenBucket(rate)
+        self.max_age = max_age or 0
+        self.state_file = Path(state_file) if state_file else default_state_file(crypt_api.dir_root)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.counts = dict()
+        self.problems = []
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return dict()
+
+    def save_state(self, state):
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='w', dir=self.state_file.parent, delete=False) as fp:
+            json.dump(state, fp)
+        os.replace(fp.name, self.state_file)
+
+    def report(self, status, name, detail=None):
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if detail is not None:
+                self.problems.append((status, name, detail))
+        if detail is not None:
+            self.logger.warning(f"{status}: {name}: {detail}")
+        elif self.verbose:
+            self.logger.info(f"{status}: {name}")
+
+    def collect_files(self):
+        """ Return the (kind, file, name) of the encrypted files, pack files and object files """
+        files = []
+        for object_id, object_file in self.api.list_objects():
+            files.append(('object', object_file, object_file.relative_to(self.api.crypt_object)))
+        for kind, top in [('crypt', self.api.crypt_dir), ('pack', self.api.crypt_pack)]:
+            for cwd, dirs, names in os.walk(top, followlinks=False):
+                for f in names:
+                    if is_temp_name(f):
+                        continue
+                    crypt_file = Path(cwd, f)
+                    crypt_path = crypt_file.relative_to(top)
+                    if self.api.exclude.excludes(crypt_path):
+                        continue
+                    if kind == 'pack' and not pack_name_pattern.fullmatch(f):
+                        continue
+                    files.append((kind, crypt_file, crypt_path))
+        return files
+
+    def check_meta(self, path, crypt_path, metadata):
+        meta_file = self.api.crypt_meta / crypt_path
+        if not meta_file.exists():
+            return 'metadata file does not exist'
+        if file_decrypt(self.api.crypt_key, meta_file, None, metadata_only=True) != metadata:
+            return 'metadata file differs from encrypted file'
+        return None
+
+    def verify_file(self, kind, crypt_file, crypt_path):
+        """ Decrypt crypt_file into a null sink and return (status, detail) """
+        key = self.api.crypt_key
+        hasher = hashlib.blake2b(key=derive_key(key, b'content'), digest_size=32) if kind == 'object' else None
+        try:
+            metadata = file_decrypt(key, crypt_file, NullSink(self.limiter, hasher), pipelined=True)
+        except Exception:
+            detail = exc_info() or 'authentication failed'
+            size = expected_size(key, crypt_file)
+            if size is not None and os.path.getsize(crypt_file) < size:
+                return ('TRUNCATED', f'{os.path.getsize(crypt_file)} bytes instead of at least {size}')
+            return ('CORRUPT', detail)
+        try:
+            if kind == 'object':
+                object_id = dest_object_metadata(metadata)
+                if object_id is None:
+                    dest_object_refs(metadata)
+                elif object_id.hex() != ''.join(crypt_path.parts):
+                    return ('MISLOCATED', 'metadata do not match the name of the object file')
+                if hasher.hexdigest() != ''.join(crypt_path.parts):
+                    return ('MISLOCATED', 'contents do not match the name of the object file')
+                return ('OK', None)
+            if kind == 'pack':
+                pack_id = bytes.fromhex(crypt_path.name)
+                for member in dest_pack_index(metadata):
+                    path, meta = dest_metadata(member)
+                    if meta.get('pack', None) != pack_id:
+                        return ('MISLOCATED', f'member {path} belongs to another pack file')
+                return ('OK', None)
+            path, meta = dest_metadata(metadata)
+            if path_hash(key, path) != crypt_path:
+                return ('MISLOCATED', f'contains {path}')
+            detail = self.check_meta(path, crypt_path, metadata)
+            if detail:
+                return ('META MISMATCH', detail)
+            return ('OK', None)
+        except Exception:
+            return ('CORRUPT', exc_info())
+
+    def run(self):
+        """ Verify the files that are due and return the counts of the results """
+        state = self.load_state()
+        now = time.time()
+        files = self.collect_files()
+        due = []
+        new_state = dict()
+        for kind, crypt_file, crypt_path in files:
+            name = f'{kind}/{crypt_path.as_posix()}'
+            st = os.stat(crypt_file)
+            stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+            last = state.get(name, None)
+            if last and last[1:] == stamp and now - last[0] < self.max_age * day_seconds:
+                new_state[name] = last
+                self.report('SKIPPED', name)
+            else:
+                due.append((kind, crypt_file, crypt_path, name, stamp))
+
+        def verify(item):
+            kind, crypt_file, crypt_path, name, stamp = item
+            status, detail = self.verify_file(kind, crypt_file, crypt_path)
+            self.report(status, name, detail)
+            return (name, [time.time()] + stamp) if status == 'OK' else None
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                for result in executor.map(verify, due):
+                    if result:
+                        new_state[result[0]] = result[1]
+        finally:
+            self.save_state(new_state)
+        return self.counts
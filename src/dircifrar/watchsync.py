@@ -4,10 +4,19 @@
 
 from .__init__ import (
     __pkg_name__,
+    __crypt_metadir__,
 )
 from .dirsync import DirSync
+from .filecrypt import is_temp_name
+from .metrics import SyncMetrics
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import pywatchman, os, sys
+import pywatchman, os, sys, json, time, signal, threading
+
+# If more metadata files than this have changed, a full pull is cheaper than pulling them one by one.
+incremental_max_changes = 100000
+# The interval in seconds at which the end of a running sync is checked for while events are read.
+sync_poll_interval = 0.1
 
 class Target(object):
     """ Base Class for a Target
@@ -17,24 +26,37 @@ class Target(object):
     When we receive notifications for that subscription, we know that
     we should execute the command.
     """
-    def __init__(self, syncer, command, logger):
+    def __init__(self, syncer, command, logger, metrics=None, subdir=None):
         self.name = __pkg_name__
         self.syncer = syncer
         self.command = command
         self.logger = logger
+        self.metrics = metrics
+        # If subdir is given, the changed files under it are pulled by syncer.pull_changes when possible.
+        self.subdir = subdir
+        self.lock = threading.Lock()
         self.triggered = False
+        self.first_event = None
+        self.last_event = None
+        self.backlog = 0
+        self.changes = set()
+        # The first sync is always a full one.
+        self.full_sync = True
 
     def start(self, client, root):
         query = {
             'expression': ['anyof', ['match', '**/*', 'wholename', {'includedotfiles': True}]],
             'fields': ['name']
         }
+        if self.subdir:
+            query['expression'] = ['allof', ['type', 'f'], query['expression']]
         watch = client.query('watch-project', root)
         if 'warning' in watch:
             self.logger.warning('WARNING: ' + watch['warning'])
         root_dir = watch['watch']
-        if 'relative_path' in watch:
-            query['relative_root'] = watch['relative_path']
+        relative_root = os.path.join(watch.get('relative_path', ''), self.subdir or '')
+        if relative_root:
+            query['relative_root'] = relative_root
         # get the initial clock value so that we only get updates
         query['since'] = client.query('clock', root_dir)['clock']
         sub = client.query('subscribe', root_dir, self.name, query)
@@ -43,13 +65,92 @@ class Target(object):
         data = client.getSubscription(self.name)
         if data is None:
             return
-        self.triggered = True
+        num_events = sum(len(item.get('files', [])) for item in data)
+        with self.lock:
+            self.triggered = True
+            self.last_event = time.time()
+            if self.first_event is None:
+                self.first_event = self.last_event
+            self.backlog += num_events
+            if self.subdir and not self.full_sync:
+                for item in data:
+                    # A fresh instance means that watchman may have missed some changes.
+                    if item.get('is_fresh_instance', False):
+                        self.full_sync = True
+                    self.changes.update(name for name in item.get('files', [])
+                                        if not is_temp_name(os.path.basename(name)))
+                if self.full_sync or len(self.changes) > incremental_max_changes:
+                    self.full_sync = True
+                    self.changes = set()
+            backlog = self.backlog
+        if self.metrics:
+            self.metrics.inc('dircifrar_watch_events_total', num_events)
+            self.metrics.set('dircifrar_watch_backlog', backlog)
+
+    def wait_time(self, settle, max_delay=None):
+        """ Return the seconds until the command is due, or None if no event is pending """
+        with self.lock:
+            if not self.triggered:
+                return None
+            due = self.last_event + settle
+            if max_delay:
+                due = min(due, self.first_event + max_delay)
+            return max(0.0, due - time.time())
 
     def execute(self, force=False):
-        if not (self.triggered or force):
+        with self.lock:
+            if not (self.triggered or force):
+                return
+            self.triggered = False
+            first_event = self.first_event
+            self.first_event = None
+            self.last_event = None
+            self.backlog = 0
+        if self.metrics is None:
+            self.run_sync()
             return
-        self.triggered = False
-        self.syncer.sync(self.command)
+        start = time.time()
+        if first_event is not None:
+            self.metrics.observe('dircifrar_watch_settle_seconds', start - first_event)
+        self.metrics.inc('dircifrar_sync_total')
+        try:
+            res = self.run_sync()
+        except:
+            self.metrics.record_sync(start, error=True)
+            raise
+        self.metrics.record_sync(start, res)
+        with self.lock:
+            backlog = self.backlog
+        self.metrics.set('dircifrar_watch_backlog', backlog)
+
+    def run_sync(self):
+        with self.lock:
+            changes = self.changes
+            full_sync = self.full_sync
+            self.changes = set()
+            self.full_sync = False
+        try:
+            if self.subdir and not full_sync:
+                res = self.syncer.pull_changes(changes)
+                if res is not None:
+                    if res.errors:
+                        # The changes that failed are retried by the next sync.
+                        with self.lock:
+                            if not self.full_sync:
+                                self.changes |= changes
+                    return res
+                self.logger.info('# FULL PULL')
+            res = self.syncer.sync(self.command)
+            if res is not None and res.errors and self.subdir:
+                with self.lock:
+                    self.full_sync = True
+                    self.changes = set()
+            return res
+        except:
+            # The changes may have been pulled only partly.
+            with self.lock:
+                self.full_sync = True
+            raise
 
 class WatchSync(object):
     """ Object for watching a directory for changes and copying the changes to another directory """
@@ -60,8 +161,34 @@ class WatchSync(object):
         self.local_dir = Path(local_dir).resolve()
         self.remote_dir = Path(remote_dir).resolve()
         self.settle = options.get('settle', 0.2)
+        # Under a continuous stream of changes, a sync is started max_delay seconds after the first change.
+        self.max_delay = options.get('max_delay', None)
         self.syncer = DirSync(self.logger, self.local_dir, self.remote_dir, **options)
 
+        # The rates can be changed at runtime by editing the throttle file, which is checked
+        # before each sync, and sending SIGUSR1 applies them at once, even in the middle of a sync.
+        throttle_file = options.get('throttle_file', None)
+        self.throttle_file = Path(throttle_file).resolve() if throttle_file else None
+        self.throttle_mtime = None
+        self.default_rates = {'io_rate': options.get('io_rate', None), 'ops_rate': options.get('ops_rate', None)}
+        if self.throttle_file:
+            self.load_throttle()
+            if hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, lambda signum, frame: self.load_throttle(force=True))
+
+        metrics_port = options.get('metrics_port', None)
+        self.metrics_file = options.get('metrics_file', None)
+        if metrics_port is not None or self.metrics_file:
+            self.metrics = SyncMetrics({'command': command,
+                                        'local_dir': self.local_dir,
+                                        'remote_dir': self.remote_dir})
+        else:
+            self.metrics = None
+        if metrics_port is not None:
+            metrics_addr = options.get('metrics_addr', '127.0.0.1')
+            port = self.metrics.serve(metrics_port, metrics_addr)
+            self.logger.info(f'# METRICS: http://{metrics_addr}:{port}/metrics')
+
         if self.watch_command == 'watch-push':
             self.sync_command = 'push'
             self.watch_root = self.local_dir
@@ -77,53 +204,88 @@ class WatchSync(object):
         try:
             self.client.capabilityCheck(required=['cmd-watch-project', 'wildmatch'])
             os.chdir(self.watch_root)
-            self.target = Target(self.syncer, self.sync_command, self.logger)
+            # Pulling from an encrypted directory needs only the changed metadata files.
+            subdir = __crypt_metadir__ if self.sync_command == 'pull' and \
+                     self.syncer.remote_api.dir_type == 'crypt' else None
+            if subdir:
+                (self.watch_root / subdir).mkdir(exist_ok=True)
+            self.target = Target(self.syncer, self.sync_command, self.logger, self.metrics, subdir)
             self.target.start(self.client, str(self.watch_root))
         except pywatchman.CommandError as ex:
             raise ValueError(f'Error: watchman exception: {str(ex)}')
 
         # We sync once at the beginning
         self.target.execute(force=True)
+        self.write_metrics()
 
+        # Syncs are run on another thread, so that events keep being read while a sync is
+        # running.  The events that arrive meanwhile are handled by the next sync.
+        executor = ThreadPoolExecutor(max_workers=1)
+        running = None
         logger.info('# Waiting for changes')
-        while True:
-            try:
-                # Wait for changes to start to occur.  We're happy to wait quite some time for this
-                self.client.setTimeout(600)
-
-                result = self.client.receive()
-                self.target.consumeEvents(self.client)
-
-                # Now we wait for events to settle
-                self.client.setTimeout(self.settle)
-                settled = False
-                while not settled:
+        try:
+            while True:
+                try:
+                    if running is not None and running.done():
+                        # This raises the exception of a failed sync.
+                        running.result()
+                        running = None
+                        self.write_metrics()
+                        logger.info('# Waiting for changes')
+                    wait = self.target.wait_time(self.settle, self.max_delay)
+                    if running is None and wait == 0:
+                        self.load_throttle()
+                        running = executor.submit(self.target.execute)
+                        continue
+                    idle = running is None and wait is None
+                    # Wait for changes to start to occur.  We're happy to wait quite some time for this
+                    self.client.setTimeout(600 if idle else sync_poll_interval if running else wait)
                     try:
                         result = self.client.receive()
-                        self.target.consumeEvents(self.client)
                     except pywatchman.SocketTimeout as ex:
-                        # Our short settle timeout hit, so we're now settled
-                        settled = True
-                        break
+                        if idle:
+                            # Let's check to see if we're still functional
+                            try:
+                                vers = self.client.query('version')
+                            except Exception as ex:
+                                raise ValueError(f'Error: watchman exception: {str(ex)}')
+                            self.write_metrics()
+                        continue
+                    self.target.consumeEvents(self.client)
 
-                # Now we sync
-                self.target.execute()
+                except pywatchman.WatchmanError as ex:
+                    raise ValueError(f'Error: watchman exception: {str(ex)}')
 
-                # Print this at the bottom of the loop rather than the top
-                # because we may timeout every so often and it looks weird
-                # to keep printing 'Waiting for changes' each time we do.
-                logger.info('# Waiting for changes')
+                except KeyboardInterrupt:
+                    # suppress ugly stack trace when they Ctrl-C
+                    break
+        finally:
+            # A running sync is allowed to finish.
+            executor.shutdown(wait=True)
 
-            except pywatchman.SocketTimeout as ex:
-                # Let's check to see if we're still functional
-                try:
-                    vers = self.client.query('version')
-                except Exception as ex:
-                    raise ValueError(f'Error: watchman exception: {str(ex)}')
+        if self.metrics:
+            self.metrics.shutdown()
 
-            except pywatchman.WatchmanError as ex:
-                raise ValueError(f'Error: watchman exception: {str(ex)}')
+    def load_throttle(self, force=False):
+        """ Apply the rates in the throttle file if it has changed since it was last read """
+        if not self.throttle_file:
+            return
+        try:
+            mtime = os.stat(self.throttle_file).st_mtime_ns
+            if mtime == self.throttle_mtime and not force:
+                return
+            self.throttle_mtime = mtime
+            with open(self.throttle_file, 'r') as fp:
+                rates = dict(self.default_rates, **json.load(fp))
+        except (OSError, ValueError, TypeError) as ex:
+            self.logger.warning(f'WARNING: cannot read throttle file: {str(ex)}')
+            return
+        self.syncer.set_rates(rates['io_rate'], rates['ops_rate'])
+        self.logger.info(f"# THROTTLE: io_rate={rates['io_rate']} ops_rate={rates['ops_rate']}")
 
-            except KeyboardInterrupt:
-                # suppress ugly stack trace when they Ctrl-C
-                break
+    def write_metrics(self):
+        if self.metrics and self.metrics_file:
+            try:
+                self.metrics.write_textfile(self.metrics_file)
+            except OSError as ex:
+                self.logger.warning(f'WARNING: cannot write metrics file: {str(ex)}')
@@ -2,11 +2,13 @@
 from dircifrar.dirconfig import (
     wrap_master_key,
     unwrap_master_key,
+    open_dirapi,
 )
+from dircifrar.__init__ import __config_filename__, __crypt_format__
 from nacl.utils import random as randombytes
 from nacl.bindings import crypto_secretstream_xchacha20poly1305_KEYBYTES as KEYBYTES
 from pathlib import Path
-import string, tempfile
+import os, string, tempfile, json, pytest
 
 from hypothesis import given, assume, settings
 from hypothesis.strategies import integers, lists, text
@@ -38,3 +40,28 @@ def test_master_key_wrap(password_1, password_2, version_list_1, version_list_2)
     master_key_2a, version_2a = unwrap_master_key(wrap_2, password_2)
     assert master_key_2a == master_key
     assert version_2a == version_2
+
+def test_crypt_format():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dir_path = Path(tmp_dir)
+        config_file = dir_path / __config_filename__
+        crypt_key = randombytes(KEYBYTES)
+        # A directory written by an earlier version is marked as being in the current format
+        # only once it is about to be modified.
+        with open(config_file, 'w') as f:
+            json.dump({ 'dir_type': 'crypt', 'version': '0.0.4', 'exclude': [] }, f)
+        api = open_dirapi(dir_path, crypt_key=crypt_key)
+        assert api.dir_type == 'crypt'
+        with open(config_file, 'r') as f:
+            assert 'format' not in json.load(f)
+        api.upgrade_format()
+        with open(config_file, 'r') as f:
+            config = json.load(f)
+        assert config['format'] == __crypt_format__
+        assert sorted(os.listdir(dir_path)) == [__config_filename__]
+        # A directory in a later format is refused.
+        config['format'] = __crypt_format__ + 1
+        with open(config_file, 'w') as f:
+            json.dump(config, f)
+        with pytest.raises(ValueError):
+            open_dirapi(dir_path, crypt_key=crypt_key)
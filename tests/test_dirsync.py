@@ -1,16 +1,30 @@
 
 from dircifrar.dirsync import (
     DirSync,
+    AbsDirSync,
+    AsyncDirSync,
+    FanoutSync,
     time_resolution_ns,
 )
+from dircifrar.dirconfig import open_dirapi
+from dircifrar.shardsync import ShardSync
+from dircifrar.catalog import CatalogObjects
+from dircifrar.dirapi_crypt import DirCrypt, make_object_refs
+from dircifrar.exclude import Excluder
+from dircifrar.filecrypt import path_hash, file_reseal
 from dircifrar.__init__ import (
+    __pkg_version__,
     __crypt_metadir__,
+    __crypt_treedir__,
+    __crypt_dirname__,
+    __crypt_packdir__,
+    __crypt_objdir__,
 )
 from nacl.utils import random as randombytes
 from nacl.bindings import crypto_secretstream_xchacha20poly1305_KEYBYTES as KEYBYTES
 from pathlib import Path
 from pprint import pprint
-import os, string, tempfile, time, shutil, logging, sys
+import os, string, tempfile, time, shutil, logging, sys, threading, pytest
 
 from hypothesis import given, assume, settings
 from hypothesis.strategies import booleans, integers, text, dictionaries, recursive, sampled_from
@@ -109,3 +123,808 @@ def test_push_pull(dtree, test_crypt, rebuild_meta):
         ds = DirSync(logger, local_dir_2, remote_dir, test_key=remote_key)
         ds.sync('pull')
         assert check_dirs(local_dir_1, local_dir_2)
+
+def test_move_files():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir_1 = tmp_dir / 'local_dir_1'
+        local_dir_2 = tmp_dir / 'local_dir_2'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir_1, {'a': {'b': 100, 'c': {'d': 5000}}, 'e': 0, 'f': 10})
+        make_dtree(local_dir_2, {})
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        DirSync(logger, local_dir_1, remote_dir, test_key=remote_key).sync('push')
+        DirSync(logger, local_dir_2, remote_dir, test_key=remote_key).sync('pull')
+        os.rename(local_dir_1 / 'a', local_dir_1 / 'x')
+        os.rename(local_dir_1 / 'f', local_dir_1 / 'x' / 'f')
+        res = DirSync(logger, local_dir_1, remote_dir, test_key=remote_key).sync('push')
+        assert res.counts.get('MOVE FILE', 0) == 3
+        assert res.copied == 0
+        res = DirSync(logger, local_dir_2, remote_dir, test_key=remote_key).sync('pull')
+        assert res.counts.get('MOVE FILE', 0) == 3
+        assert res.copied == 0
+        assert check_dirs(local_dir_1, local_dir_2)
+        shutil.rmtree(local_dir_2)
+        make_dtree(local_dir_2, {})
+        DirSync(logger, local_dir_2, remote_dir, test_key=remote_key).sync('pull')
+        assert check_dirs(local_dir_1, local_dir_2)
+
+def test_tree_pruning():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir_1 = tmp_dir / 'local_dir_1'
+        local_dir_2 = tmp_dir / 'local_dir_2'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir_1, {'a': {'b': 100, 'c': {'d': 50}}, 'e': {'f': 10}, 'g': 5})
+        make_dtree(local_dir_2, {})
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        DirSync(logger, local_dir_1, remote_dir, test_key=remote_key).sync('push')
+        assert (remote_dir / __crypt_treedir__).is_dir()
+        ds = DirSync(logger, local_dir_1, remote_dir, test_key=remote_key)
+        res = ds.sync('push')
+        assert ds.remote_api.pruned == {Path()}
+        assert res.copied == 0
+        time.sleep(0.001)
+        with open(local_dir_1 / 'a' / 'c' / 'd', 'wb') as fp:
+            fp.write(randombytes(60))
+        (local_dir_1 / 'a' / 'h').mkdir()
+        ds = DirSync(logger, local_dir_1, remote_dir, test_key=remote_key)
+        res = ds.sync('push')
+        assert ds.remote_api.pruned == {Path('e')}
+        assert res.copied == 1
+        ds = DirSync(logger, local_dir_2, remote_dir, test_key=remote_key)
+        ds.sync('pull')
+        assert check_dirs(local_dir_1, local_dir_2)
+        ds = DirSync(logger, local_dir_2, remote_dir, test_key=remote_key)
+        ds.sync('pull')
+        assert ds.remote_api.pruned == {Path()}
+        # Without the manifest version in the config, the manifests are not trusted.
+        assert not DirCrypt(remote_dir, __pkg_version__, [], {}, remote_key).check_tree()
+        # Metadata files written after the manifests, as by a version that does not maintain them, turn pruning off.
+        tree_dir = remote_dir / __crypt_treedir__
+        saved_dir = tmp_dir / 'saved_tree'
+        os.rename(tree_dir, saved_dir)
+        shutil.copytree(saved_dir, tree_dir)
+        time.sleep(0.001)
+        with open(local_dir_1 / 'e' / 'f', 'wb') as fp:
+            fp.write(randombytes(20))
+        DirSync(logger, local_dir_1, remote_dir, test_key=remote_key).sync('push')
+        shutil.rmtree(tree_dir)
+        os.rename(saved_dir, tree_dir)
+        assert not open_dirapi(remote_dir, test_key=remote_key).check_tree()
+        ds = DirSync(logger, local_dir_2, remote_dir, test_key=remote_key)
+        res = ds.sync('pull')
+        assert ds.remote_api.pruned == set() and res.copied == 1
+        assert check_dirs(local_dir_1, local_dir_2)
+        # The next push rewrites the manifests.
+        DirSync(logger, local_dir_1, remote_dir, test_key=remote_key).sync('push')
+        ds = DirSync(logger, local_dir_2, remote_dir, test_key=remote_key)
+        ds.sync('pull')
+        assert ds.remote_api.pruned == {Path()}
+
+def count_files(dir_path):
+    return sum(len(files) for _, _, files in os.walk(dir_path))
+
+def count_objects(remote_dir):
+    """ The number of object files, not counting their reference markers """
+    return sum(len(files) for cwd, _, files in os.walk(remote_dir / __crypt_objdir__) if not cwd.endswith('.refs'))
+
+def test_pack_files():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir_1 = tmp_dir / 'local_dir_1'
+        local_dir_2 = tmp_dir / 'local_dir_2'
+        remote_dir = tmp_dir / 'remote_dir'
+        dtree = { f'd{i}': { f'f{j}': 100 for j in range(10) } for i in range(5) }
+        dtree['big'] = 5000
+        make_dtree(local_dir_1, dtree)
+        make_dtree(local_dir_2, {})
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        def sync(local_dir, command):
+            ds = DirSync(logger, local_dir, remote_dir, test_key=remote_key)
+            ds.remote_api.pack_threshold = 1000
+            return ds.sync(command)
+        res = sync(local_dir_1, 'push')
+        assert res.copied == 51
+        assert count_files(remote_dir / __crypt_dirname__) == 1 + 5
+        assert count_files(remote_dir / __crypt_packdir__) == 1
+        sync(local_dir_2, 'pull')
+        assert check_dirs(local_dir_1, local_dir_2)
+        # Removing and replacing most members makes the old pack file mostly dead.
+        time.sleep(0.001)
+        for i in range(4):
+            shutil.rmtree(local_dir_1 / f'd{i}')
+        with open(local_dir_1 / 'd4' / 'f0', 'wb') as fp:
+            fp.write(randombytes(200))
+        with open(local_dir_1 / 'big', 'wb') as fp:
+            fp.write(randombytes(500))
+        res = sync(local_dir_1, 'push')
+        assert res.copied == 2
+        assert count_files(remote_dir / __crypt_dirname__) == 1
+        assert count_files(remote_dir / __crypt_packdir__) == 1
+        sync(local_dir_2, 'pull')
+        assert check_dirs(local_dir_1, local_dir_2)
+        # The metadata of packed files can be rebuilt from the pack index.
+        DirSync(logger, local_dir_2, remote_dir, test_key=remote_key).remote_api.collect_paths(rebuild_meta=True)
+        shutil.rmtree(local_dir_2)
+        make_dtree(local_dir_2, {})
+        sync(local_dir_2, 'pull')
+        assert check_dirs(local_dir_1, local_dir_2)
+
+def test_pack_empty_files():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir_1 = tmp_dir / 'local_dir_1'
+        local_dir_2 = tmp_dir / 'local_dir_2'
+        remote_dir = tmp_dir / 'remote_dir'
+        # Empty members have the same offsets as the members following them.
+        make_dtree(local_dir_1, { 'a': 0, 'b': 0, 'c': 100, 'd': { 'e': 0, 'f': 0 }, 'g': 0 })
+        make_dtree(local_dir_2, {})
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        def sync(local_dir, command):
+            ds = DirSync(logger, local_dir, remote_dir, test_key=remote_key)
+            ds.remote_api.pack_threshold = 1000
+            return ds.sync(command)
+        res = sync(local_dir_1, 'push')
+        assert res.errors == 0 and res.copied == 6
+        assert count_files(remote_dir / __crypt_packdir__) == 1
+        res = sync(local_dir_2, 'pull')
+        assert res.errors == 0 and res.copied == 6
+        assert check_dirs(local_dir_1, local_dir_2)
+
+def test_dedup_files():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir_1 = tmp_dir / 'local_dir_1'
+        local_dir_2 = tmp_dir / 'local_dir_2'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir_1, { 'a': { 'x': 3000 }, 'b': { 'y': 2000 }, 'c': 3000 })
+        data = randombytes(5000)
+        for path in ['a/f', 'b/f', 'c2']:
+            (local_dir_1 / path).write_bytes(data)
+        os.link(local_dir_1 / 'a' / 'x', local_dir_1 / 'b' / 'x')
+        make_dtree(local_dir_2, {})
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        def sync(local_dir, command):
+            ds = DirSync(logger, local_dir, remote_dir, test_key=remote_key)
+            ds.remote_api.dedup = True
+            return ds.sync(command)
+        res = sync(local_dir_1, 'push')
+        # 3 copies of data and 2 hard links are stored once each.
+        assert res.counts['PUSH FILE'] == 4 and res.counts['DEDUP FILE'] == 3
+        assert count_objects(remote_dir) == 4
+        sync(local_dir_2, 'pull')
+        assert check_dirs(local_dir_1, local_dir_2)
+        api = DirSync(logger, local_dir_2, remote_dir, test_key=remote_key).remote_api
+        api.collect_paths()
+        # A pull refuses object files that have been swapped.
+        (id_1, file_1), (id_2, file_2) = api.list_objects()[0:2]
+        swapped = [ path for path, meta in api.included.items() if meta.get('object', None) in (id_1, id_2) ]
+        os.rename(file_1, remote_dir / 'swap')
+        os.rename(file_2, file_1)
+        os.rename(remote_dir / 'swap', file_2)
+        local_dir_3 = tmp_dir / 'local_dir_3'
+        make_dtree(local_dir_3, {})
+        with pytest.raises(AssertionError):
+            sync(local_dir_3, 'pull')
+        assert not any((local_dir_3 / path).exists() for path in swapped)
+        os.rename(file_1, remote_dir / 'swap')
+        os.rename(file_2, file_1)
+        os.rename(remote_dir / 'swap', file_2)
+        # The references listed in the metadata of object files written by earlier versions are still honored.
+        refs = dict()
+        for path, meta in api.included.items():
+            if 'object' in meta:
+                refs.setdefault(meta['object'], []).append(path)
+        for object_id, object_file in api.list_objects():
+            file_reseal(remote_key, object_file, make_object_refs(refs[object_id]))
+            shutil.rmtree(api.object_refs_dir(object_id))
+        # An object file is kept as long as some path refers to it.
+        os.remove(local_dir_1 / 'a' / 'f')
+        os.remove(local_dir_1 / 'b' / 'f')
+        os.rename(local_dir_1 / 'c2', local_dir_1 / 'c3')
+        os.remove(local_dir_1 / 'c')
+        res = sync(local_dir_1, 'push')
+        assert res.counts['MOVE FILE'] == 1
+        assert count_objects(remote_dir) == 3
+        sync(local_dir_2, 'pull')
+        assert check_dirs(local_dir_1, local_dir_2)
+        # The references of the object files can be rebuilt.
+        DirSync(logger, local_dir_2, remote_dir, test_key=remote_key).remote_api.collect_paths(rebuild_meta=True)
+        os.remove(local_dir_1 / 'c3')
+        sync(local_dir_1, 'push')
+        assert count_objects(remote_dir) == 2
+        assert count_files(remote_dir / __crypt_objdir__) == 2 + 3
+        shutil.rmtree(local_dir_2)
+        make_dtree(local_dir_2, {})
+        sync(local_dir_2, 'pull')
+        assert check_dirs(local_dir_1, local_dir_2)
+
+class SlowDirApi(object):
+    """ A directory API whose operations are delayed to mimic a high-latency file system """
+
+    slow_ops = ['collect_paths', 'remove_dir', 'remove_file', 'make_dir', 'push_file', 'pull_file']
+
+    def __init__(self, api, latency):
+        self.api = api
+        self.latency = latency
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name not in self.slow_ops:
+            return attr
+        def slow_op(*args, **kwargs):
+            time.sleep(self.latency)
+            return attr(*args, **kwargs)
+        return slow_op
+
+@settings(
+    max_examples=5,
+    deadline=None,
+)
+@given(
+    test_crypt=booleans(),
+)
+def test_async_sync(test_crypt):
+    latency = 0.02
+    dtree = { f'd{i}': { f'f{j}': 100 for j in range(5) } for i in range(6) }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        remote_key = randombytes(KEYBYTES) if test_crypt else None
+        times = dict()
+        for engine in [AbsDirSync, AsyncDirSync]:
+            local_dir = tmp_dir / f'local_{engine.__name__}'
+            remote_dir = tmp_dir / f'remote_{engine.__name__}'
+            make_dtree(local_dir, dtree)
+            make_dtree(remote_dir, {})
+            local_api = SlowDirApi(open_dirapi(local_dir), latency)
+            remote_api = SlowDirApi(open_dirapi(remote_dir, test_key=remote_key), latency)
+            def push_file(path, res):
+                remote_api.push_file(path, local_dir / path, res)
+            ds = engine(logger, local_api, remote_api, push_file, {'jobs': 8})
+            start = time.time()
+            res = ds.sync_dirs()
+            times[engine] = time.time() - start
+            assert res.copied == 30
+            check_dir = tmp_dir / f'check_{engine.__name__}'
+            make_dtree(check_dir, {})
+            DirSync(logger, check_dir, remote_dir, test_key=remote_key).sync('pull')
+            assert check_dirs(local_dir, check_dir)
+        # 36 operations of 20 ms each take at least 0.72 sec when executed sequentially.
+        assert times[AbsDirSync] >= 36 * latency
+        assert times[AsyncDirSync] < times[AbsDirSync] / 2
+
+class OnDemandDirCrypt(DirCrypt):
+    """ An encrypted directory whose files are downloaded with some latency when they are first read """
+
+    def __init__(self, dir_root, crypt_key, latency):
+        super().__init__(dir_root, __pkg_version__, [], {}, crypt_key)
+        self.latency = latency
+        self.downloads = dict()
+        self.lock = threading.Lock()
+
+    def download(self, crypt_file):
+        with self.lock:
+            done = self.downloads.get(crypt_file, None)
+            first = done is None
+            if first:
+                done = self.downloads[crypt_file] = threading.Event()
+        if first:
+            time.sleep(self.latency)
+            done.set()
+        done.wait()
+
+    def read_ahead(self, crypt_file):
+        self.download(crypt_file)
+        super().read_ahead(crypt_file)
+
+    def pull_file(self, path, dst_file, res):
+        # The prefetcher has to learn that path is being pulled before it is downloaded.
+        if self.prefetcher and path in self.prefetch_index:
+            self.prefetcher.consume(self.prefetch_index[path])
+        self.download(self.crypt_dir / path_hash(self.crypt_key, path))
+        super().pull_file(path, dst_file, res)
+
+def test_pull_prefetch():
+    latency = 0.02
+    dtree = { f'd{i}': { f'f{j}': 1000 for j in range(10) } for i in range(3) }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir, dtree)
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        DirSync(logger, local_dir, remote_dir, test_key=remote_key).sync('push')
+        times = dict()
+        for prefetch in [0, 8]:
+            check_dir = tmp_dir / f'check_{prefetch}'
+            make_dtree(check_dir, {})
+            remote_api = OnDemandDirCrypt(remote_dir, remote_key, latency)
+            check_api = open_dirapi(check_dir)
+            def pull_file(path, res):
+                remote_api.pull_file(path, check_dir / path, res)
+            ds = AbsDirSync(logger, remote_api, check_api, pull_file, {'prefetch': prefetch})
+            start = time.time()
+            res = ds.sync_dirs()
+            times[prefetch] = time.time() - start
+            assert res.copied == 30
+            assert remote_api.prefetcher is None
+            assert check_dirs(local_dir, check_dir)
+        # 30 downloads of 20 ms each take at least 0.6 sec when made one at a time.
+        assert times[0] >= 30 * latency
+        assert times[8] < times[0] / 2
+
+@given(test_crypt=booleans())
+@settings(deadline=None, max_examples=2)
+def test_throttled_sync(test_crypt):
+    dtree = { f'd{i}': { f'f{j}': 10000 for j in range(5) } for i in range(6) }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir, dtree)
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES) if test_crypt else None
+        # 300000 bytes at 400000 bytes per second take no time beyond the initial burst,
+        # but 6 directories at 4 per second take at least 0.5 sec.
+        ds = DirSync(logger, local_dir, remote_dir, test_key=remote_key, io_rate=400000, ops_rate=4)
+        start = time.time()
+        ds.sync('push')
+        assert time.time() - start >= 0.45
+        # Beyond the burst of 100000 bytes, the other 200000 bytes take at least 2 sec.
+        check_dir = tmp_dir / 'check_dir'
+        make_dtree(check_dir, {})
+        start = time.time()
+        DirSync(logger, check_dir, remote_dir, test_key=remote_key, io_rate=100000, jobs=4).sync('pull')
+        assert time.time() - start >= 1.9
+        assert check_dirs(local_dir, check_dir)
+
+def test_resume_push(monkeypatch):
+    monkeypatch.setattr('dircifrar.dirsync.checkpoint_ops', 10)
+    dtree = { f'd{i}': { f'f{j}': 100 for j in range(10) } for i in range(5) }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir, dtree)
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        ds = DirSync(logger, local_dir, remote_dir, test_key=remote_key)
+        push_file = ds.remote_api.push_file
+        pushed = []
+        def failing_push_file(path, src_file, res):
+            if len(pushed) == 24:
+                raise OSError('interrupted')
+            pushed.append(path)
+            push_file(path, src_file, res)
+        ds.remote_api.push_file = failing_push_file
+        try:
+            ds.sync('push')
+            assert False
+        except OSError:
+            pass
+        # The manifests were last written after 20 files, and the journal lists the 4 pushed since then.
+        tree_dir = remote_dir / __crypt_treedir__
+        assert (tree_dir / 'dirty').exists()
+        assert len((tree_dir / 'journal').read_text().split()) == 4
+        # Temporary files left behind by the interruption are swept.
+        temp_files = [ remote_dir / __crypt_metadir__ / '.dircifrar-tmp-abc',
+                       next((remote_dir / __crypt_dirname__).iterdir()) / 'tmpabcd_123' ]
+        for temp_file in temp_files:
+            temp_file.write_bytes(b'garbage')
+        ds = DirSync(logger, local_dir, remote_dir, test_key=remote_key)
+        res = ds.sync('push')
+        assert res.copied == 26
+        assert ds.remote_api.pruned == {Path('d0'), Path('d1')}
+        assert not any(temp_file.exists() for temp_file in temp_files)
+        assert not (tree_dir / 'dirty').exists() and not (tree_dir / 'journal').exists()
+        check_dir = tmp_dir / 'check_dir'
+        make_dtree(check_dir, {})
+        DirSync(logger, check_dir, remote_dir, test_key=remote_key).sync('pull')
+        assert check_dirs(local_dir, check_dir)
+
+def test_pull_changes():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir_1 = tmp_dir / 'local_dir_1'
+        local_dir_2 = tmp_dir / 'local_dir_2'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir_1, {'a': {'b': 100, 'c': {'d': 50}}, 'e': {'f': 10, 'g': 20}, 'h': 5})
+        make_dtree(local_dir_2, {})
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        DirSync(logger, local_dir_1, remote_dir, test_key=remote_key).sync('push')
+        ds = DirSync(logger, local_dir_2, remote_dir, test_key=remote_key)
+        ds.sync('pull')
+        meta_dir = remote_dir / __crypt_metadir__
+        def snapshot():
+            return { (f.relative_to(meta_dir), f.stat().st_ino, f.stat().st_mtime_ns)
+                     for f in meta_dir.rglob('*') if f.is_file() }
+        def changes(old, new):
+            return { name for name, _, _ in old ^ new }
+        for step in range(2):
+            before = snapshot()
+            time.sleep(0.001)
+            if step == 0:
+                with open(local_dir_1 / 'a' / 'c' / 'd', 'wb') as fp:
+                    fp.write(randombytes(60))
+                shutil.rmtree(local_dir_1 / 'e')
+                os.rename(local_dir_1 / 'h', local_dir_1 / 'a' / 'h')
+                make_dtree(local_dir_1 / 'i', {'j': 30, 'k': {'l': 40}})
+            else:
+                os.remove(local_dir_1 / 'a' / 'b')
+                (local_dir_1 / 'a' / 'b').mkdir()
+            DirSync(logger, local_dir_1, remote_dir, test_key=remote_key).sync('push')
+            res = ds.pull_changes(changes(before, snapshot()))
+            assert res is not None and res.errors == 0
+            assert check_dirs(local_dir_1, local_dir_2)
+        assert res.counts == {'REMOVE FILE': 1, 'ADD DIR': 1}
+        # A file whose directory is not known has to be pulled by a full pull.
+        make_dtree(local_dir_1 / 'm', {'n': 10})
+        before = snapshot()
+        DirSync(logger, local_dir_1, remote_dir, test_key=remote_key).sync('push')
+        new_dir = path_hash(remote_key, Path('m'))
+        assert ds.pull_changes(changes(before, snapshot()) - {new_dir}) is None
+
+def test_fanout_push(monkeypatch):
+    import dircifrar.fanout
+    reads = []
+    pread = os.pread
+    def counting_pread(fd, size, offset):
+        data = pread(fd, size, offset)
+        reads.append(len(data))
+        return data
+    monkeypatch.setattr(dircifrar.fanout.os, 'pread', counting_pread)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        make_dtree(local_dir, {'a': {'b': 100, 'c': 5000}, 'big': 3 * 2 ** 20 + 5})
+        remote_dirs = [ tmp_dir / f'remote_dir_{i}' for i in range(4) ]
+        for remote_dir in remote_dirs:
+            make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        # The last remote directory is unencrypted.
+        syncer = FanoutSync(logger, local_dir, remote_dirs[0:3], test_key=remote_key, jobs=2)
+        syncer.syncers.append(DirSync(logger, local_dir, remote_dirs[3]))
+        syncer.syncers[3].local_api = syncer.local_api
+        results = syncer.sync('push')
+        assert [ res.copied for res in results ] == [3, 3, 3, 3]
+        # Each file is read once for the three encrypted remote directories.
+        assert sum(reads) == 3 * 2 ** 20 + 5 + 5000 + 100
+        for i, remote_dir in enumerate(remote_dirs):
+            check_dir = tmp_dir / f'check_dir_{i}'
+            make_dtree(check_dir, {})
+            DirSync(logger, check_dir, remote_dir, test_key=remote_key if i < 3 else None).sync('pull')
+            assert check_dirs(local_dir, check_dir)
+        time.sleep(0.001)
+        with open(local_dir / 'a' / 'b', 'wb') as fp:
+            fp.write(randombytes(200))
+        results = FanoutSync(logger, local_dir, remote_dirs[0:3], test_key=remote_key).sync('push')
+        assert [ res.copied for res in results ] == [1, 1, 1]
+        # With a window smaller than the big file and a single catalog, each file is still read once.
+        monkeypatch.setattr(dircifrar.fanout, 'fanout_max_blocks', 1)
+        monkeypatch.setattr(dircifrar.fanout, 'fanout_cache_blocks', 2)
+        new_remote_dirs = [ tmp_dir / f'new_remote_dir_{i}' for i in range(3) ]
+        for remote_dir in new_remote_dirs:
+            make_dtree(remote_dir, {})
+        reads.clear()
+        syncer = FanoutSync(logger, local_dir, new_remote_dirs, test_key=remote_key, jobs=2, catalog=True)
+        assert all(s.catalog is syncer.catalog for s in syncer.syncers)
+        results = syncer.sync('push')
+        assert [ res.copied for res in results ] == [3, 3, 3]
+        assert sum(reads) == 3 * 2 ** 20 + 5 + 5000 + 200
+        for i, remote_dir in enumerate(new_remote_dirs):
+            check_dir = tmp_dir / f'new_check_dir_{i}'
+            make_dtree(check_dir, {})
+            DirSync(logger, check_dir, remote_dir, test_key=remote_key).sync('pull')
+            assert check_dirs(local_dir, check_dir)
+
+def test_scheduled_sync(monkeypatch):
+    monkeypatch.setattr('dircifrar.schedule.schedule_large_size', 1000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        make_dtree(local_dir, {'a': 500, 'b': 100, 'd': {'c': 300}, 'e.doc': 200})
+        for i, name in enumerate(['b', 'e.doc', 'a', 'd/c']):
+            os.utime(local_dir / name, ns=(10 ** 18 + i * 10 ** 9, 10 ** 18 + i * 10 ** 9))
+        def copied_order(remote_dir, **options):
+            remote_api = open_dirapi(remote_dir)
+            order = []
+            def copy_file(path, res):
+                order.append(path.as_posix())
+                remote_api.push_file(path, local_dir / path, res)
+            AbsDirSync(logger, open_dirapi(local_dir), remote_api, copy_file, options).sync_dirs()
+            return order
+        expected = [
+            ({}, ['a', 'b', 'd/c', 'e.doc']),
+            ({'order': 'small'}, ['b', 'e.doc', 'd/c', 'a']),
+            ({'order': 'recent'}, ['d/c', 'a', 'e.doc', 'b']),
+            ({'priority': ['*.doc', 'd/']}, ['e.doc', 'd/c', 'a', 'b']),
+        ]
+        for i, (options, order) in enumerate(expected):
+            remote_dir = tmp_dir / f'remote_dir_{i}'
+            make_dtree(remote_dir, {})
+            assert copied_order(remote_dir, **options) == order
+        # A changed file is no longer copied before a new one that should come first.
+        time.sleep(0.001)
+        with open(local_dir / 'a', 'wb') as fp:
+            fp.write(randombytes(600))
+        with open(local_dir / 'f', 'wb') as fp:
+            fp.write(randombytes(50))
+        assert copied_order(tmp_dir / 'remote_dir_0') == ['a', 'f']
+        assert copied_order(tmp_dir / 'remote_dir_1', order='small') == ['f', 'a']
+        # Large files are copied by at most half of the jobs while small files are waiting.
+        local_dir = tmp_dir / 'local_async'
+        remote_dir = tmp_dir / 'remote_async'
+        make_dtree(local_dir, dict({ f'l{i}': 2000 for i in range(4) }, **{ f's{i}': 10 for i in range(8) }))
+        make_dtree(remote_dir, {})
+        remote_api = open_dirapi(remote_dir)
+        started = []
+        def copy_file(path, res):
+            started.append(path.name)
+            time.sleep(0.05)
+            remote_api.push_file(path, local_dir / path, res)
+        ds = AsyncDirSync(logger, open_dirapi(local_dir), remote_api, copy_file, {'jobs': 4, 'order': 'small'})
+        assert ds.sync_dirs().copied == 12
+        assert sorted(started[0:4]) == ['l0', 'l1', 's0', 's1']
+        assert check_dirs(local_dir, remote_dir)
+
+def test_meta_cache(monkeypatch):
+    import dircifrar.dirapi_crypt
+    decrypted = []
+    file_decrypt = dircifrar.dirapi_crypt.file_decrypt
+    def counting_decrypt(key, crypt_file, *args, **kwargs):
+        decrypted.append(crypt_file)
+        return file_decrypt(key, crypt_file, *args, **kwargs)
+    monkeypatch.setattr(dircifrar.dirapi_crypt, 'file_decrypt', counting_decrypt)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_dir / 'cache'))
+        local_dir = tmp_dir / 'local_dir'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir, {'a': {'b': 100, 'c': 200}, 'd': 300, 'e': {}})
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        DirSync(logger, local_dir, remote_dir, test_key=remote_key, meta_cache=True).sync('push')
+        cache_files = list((tmp_dir / 'cache').glob('*/meta-*'))
+        assert len(cache_files) == 1
+        def collect(meta_cache=True):
+            api = DirSync(logger, local_dir, remote_dir, test_key=remote_key, meta_cache=meta_cache).remote_api
+            decrypted.clear()
+            api.collect_paths()
+            if api.meta_cache:
+                api.meta_cache.save()
+            return api.included
+        expected = collect(meta_cache=False)
+        assert len(expected) == 5 and len(decrypted) == 5
+        # The metadata files written by the push are in the cache.
+        assert collect() == expected and decrypted == []
+        # A metadata file written without the cache is decrypted once.
+        time.sleep(0.001)
+        with open(local_dir / 'd', 'wb') as fp:
+            fp.write(randombytes(50))
+        DirSync(logger, local_dir, remote_dir, test_key=remote_key).sync('push')
+        expected = collect(meta_cache=False)
+        assert expected[Path('d')]['size'] == 50
+        assert collect() == expected and len(decrypted) == 1
+        assert collect() == expected and decrypted == []
+        # Removed files leave the cache, and a corrupted cache is just empty.
+        shutil.rmtree(local_dir / 'a')
+        DirSync(logger, local_dir, remote_dir, test_key=remote_key, meta_cache=True).sync('push')
+        expected = collect(meta_cache=False)
+        assert set(expected) == {Path('d'), Path('e')}
+        assert collect() == expected and decrypted == []
+        cache_files[0].write_bytes(randombytes(100))
+        assert collect() == expected and len(decrypted) == 2
+        assert collect() and decrypted == []
+        # A cache that cannot be saved leaves no temporary file behind.
+        api = DirSync(logger, local_dir, remote_dir, test_key=remote_key, meta_cache=True).remote_api
+        api.collect_paths()
+        api.meta_cache.changed = True
+        def failing_replace(src, dst):
+            raise OSError('replace failed')
+        with monkeypatch.context() as m:
+            m.setattr(os, 'replace', failing_replace)
+            with pytest.raises(OSError):
+                api.meta_cache.save()
+        assert os.listdir(cache_files[0].parent) == [cache_files[0].name]
+        assert api.meta_cache.changed
+
+def test_parallel_scan(monkeypatch):
+    latency = 0.02
+    dtree = { f'd{i}': { f'e{j}': { 'f': 10, 'g.tmp': 10 } for j in range(4) } for i in range(8) }
+    dtree.update({'build': {'h': 10}, 'skip': {'i': 10}, 'k': {'build': {}}})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        make_dtree(local_dir, dtree)
+        (local_dir / '.dircifrar-tmp-abc').write_bytes(b'')
+        os.symlink(local_dir / 'd0', local_dir / 'link_dir')
+        os.symlink(local_dir / 'build' / 'h', local_dir / 'link_file')
+        exclude = [r'.*\.tmp', 'glob:build/', 'glob:/skip/**']
+        def collect(scan_jobs):
+            api = open_dirapi(local_dir)
+            api.exclude = Excluder(exclude)
+            api.scan_jobs = scan_jobs
+            start = time.time()
+            api.collect_paths()
+            return (api.included, api.excluded, time.time() - start)
+        included, excluded, _ = collect(1)
+        assert Path('d7/e3/f') in included and Path('d7/e3/g.tmp') in excluded
+        assert Path('build') in excluded and Path('k/build') in excluded and Path('skip/i') not in included
+        assert Path('link_dir') in included and Path('link_dir/e0') not in included
+        assert Path('link_file') in excluded
+        # Every directory read takes some time, as on a network file system.
+        scandir = os.scandir
+        def slow_scandir(*args):
+            time.sleep(latency)
+            return scandir(*args)
+        monkeypatch.setattr(os, 'scandir', slow_scandir)
+        times = dict()
+        for scan_jobs in [1, 8]:
+            assert collect(scan_jobs)[0:2] == (included, excluded)
+            times[scan_jobs] = collect(scan_jobs)[2]
+        # 42 directories are read, which takes at least 0.84 sec one at a time.
+        assert times[1] >= 42 * latency
+        assert times[8] < times[1] / 2
+
+def test_shard_sync():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        remote_dir = tmp_dir / 'remote_dir'
+        make_dtree(local_dir, {'a': {'b': 100, 'c': {'d': 10, 'e': {}}}, 'f': 5000, 'g': {'h': 1}, 'i': 20})
+        make_dtree(remote_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        res = ShardSync(logger, local_dir, remote_dir, test_key=remote_key, processes=2).sync('push')
+        assert res.errors == 0 and res.copied == 5
+        assert open_dirapi(remote_dir, test_key=remote_key).check_tree()
+        pull_dir = tmp_dir / 'pull_dir'
+        make_dtree(pull_dir, {})
+        DirSync(logger, pull_dir, remote_dir, test_key=remote_key).sync('pull')
+        assert check_dirs(local_dir, pull_dir)
+        # Directories are removed and made across shards, and files and directories replace each other.
+        time.sleep(0.001)
+        shutil.rmtree(local_dir / 'a')
+        os.remove(local_dir / 'f')
+        shutil.rmtree(local_dir / 'g')
+        make_dtree(local_dir, {'f': {'x': {'y': {'z': 30}}}, 'g': 40, 'j': {'k': {}}})
+        res = ShardSync(logger, local_dir, remote_dir, test_key=remote_key, processes=3, jobs=2).sync('push')
+        assert res.errors == 0 and res.copied == 2
+        assert open_dirapi(remote_dir, test_key=remote_key).check_tree()
+        res = ShardSync(logger, pull_dir, remote_dir, test_key=remote_key, processes=3).sync('pull')
+        assert res.errors == 0 and res.copied == 2
+        assert check_dirs(local_dir, pull_dir)
+        res = ShardSync(logger, local_dir, remote_dir, test_key=remote_key, processes=2).sync('push')
+        assert res.errors == 0 and res.counts == {}
+
+def test_subtree_sync(monkeypatch):
+    import dircifrar.dirapi_crypt
+    decrypted = []
+    file_decrypt = dircifrar.dirapi_crypt.file_decrypt
+    def counting_decrypt(crypt_key, crypt_file, *args, **kwargs):
+        decrypted.append(Path(crypt_file))
+        return file_decrypt(crypt_key, crypt_file, *args, **kwargs)
+    monkeypatch.setattr(dircifrar.dirapi_crypt, 'file_decrypt', counting_decrypt)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        remote_dir = tmp_dir / 'remote_dir'
+        pull_dir = tmp_dir / 'pull_dir'
+        make_dtree(local_dir, {'p': {'foo': {'a': 10, 'b': {'c': 20}}, 'bar': {'d': 30}},
+                               'q': {f'f{i}': i for i in range(20)}})
+        make_dtree(remote_dir, {})
+        make_dtree(pull_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        DirSync(logger, local_dir, remote_dir, test_key=remote_key).sync('push')
+        DirSync(logger, pull_dir, remote_dir, test_key=remote_key).sync('pull')
+        time.sleep(0.001)
+        shutil.rmtree(local_dir / 'p' / 'foo' / 'b')
+        make_dtree(local_dir, {'p': {'foo': {'a': 11, 'e': {'f': 40}}, 'bar': {'d': 31}}, 'q': {'g': 50}})
+        decrypted.clear()
+        res = DirSync(logger, local_dir, remote_dir, test_key=remote_key, subpaths=['p/foo', 'p/foo/e']).sync('push')
+        assert res.counts == {'PUSH FILE': 2, 'ADD DIR': 1, 'REMOVE FILE': 1, 'REMOVE DIR': 1}
+        # Only the manifests of the root, p and p/foo and its subdirectory b are read.
+        assert len([ path for path in decrypted if __crypt_metadir__ in path.parts ]) == 0
+        assert len(decrypted) == 4
+        assert open_dirapi(remote_dir, test_key=remote_key).check_tree()
+        # A subtree is pulled, and a subtree that does not exist in the source is removed.
+        shutil.rmtree(local_dir / 'p' / 'bar')
+        res = DirSync(logger, local_dir, remote_dir, test_key=remote_key, subpaths=['p/bar', 'r/s']).sync('push')
+        assert res.counts == {'REMOVE FILE': 1, 'REMOVE DIR': 1}
+        res = DirSync(logger, pull_dir, remote_dir, test_key=remote_key, subpaths=['p']).sync('pull')
+        assert res.counts == {'COPY FILE': 2, 'ADD DIR': 1, 'REMOVE FILE': 2, 'REMOVE DIR': 2}
+        assert (pull_dir / 'q' / 'f0').exists() and not (pull_dir / 'q' / 'g').exists()
+        # The manifests are still valid for the whole directory.
+        res = DirSync(logger, local_dir, remote_dir, test_key=remote_key).sync('push')
+        assert res.counts == {'PUSH FILE': 1}
+        res = DirSync(logger, pull_dir, remote_dir, test_key=remote_key).sync('pull')
+        assert res.counts == {'COPY FILE': 1}
+        assert check_dirs(local_dir, pull_dir)
+
+def test_catalog_sync(monkeypatch):
+    import dircifrar.catalog, dircifrar.dirsync
+    # Small pages exercise the paging of the catalog and the splitting of phases.
+    monkeypatch.setattr(dircifrar.catalog, 'catalog_page', 3)
+    monkeypatch.setattr(dircifrar.dirsync, 'catalog_page', 3)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        remote_dir = tmp_dir / 'remote_dir'
+        pull_dir = tmp_dir / 'pull_dir'
+        dtree = {'a': {'b': 100, 'c': {'d': 10, 'e': {}}}, 'f': {f'g{i}': i for i in range(10)},
+                 'h': {'i': {'j': {'k': 1}}}, 'l': 20, 'm': 30}
+        make_dtree(local_dir, dtree)
+        make_dtree(remote_dir, {})
+        make_dtree(pull_dir, {})
+        remote_key = randombytes(KEYBYTES)
+        for test_crypt in (False, True):
+            shutil.rmtree(remote_dir)
+            make_dtree(remote_dir, {})
+            options = dict(test_key=remote_key if test_crypt else None, catalog=True, memory_budget=2 ** 20)
+            res = DirSync(logger, local_dir, remote_dir, **options).sync('push')
+            assert res.errors == 0 and res.copied == 15
+            res = DirSync(logger, pull_dir, remote_dir, **options).sync('pull')
+            assert check_dirs(local_dir, pull_dir)
+            if test_crypt:
+                assert open_dirapi(remote_dir, test_key=remote_key).check_tree()
+        time.sleep(0.001)
+        shutil.rmtree(local_dir / 'h')
+        os.remove(local_dir / 'l')
+        os.rename(local_dir / 'f', local_dir / 'n')
+        shutil.rmtree(local_dir / 'a' / 'c')
+        make_dtree(local_dir, {'a': {'c': 40}, 'l': {'o': {'p': 50}}, 'q': {'r': {}}})
+        with open(local_dir / 'm', 'wb') as fp:
+            fp.write(randombytes(31))
+        options = dict(test_key=remote_key, catalog=True, jobs=2)
+        res = DirSync(logger, local_dir, remote_dir, **options).sync('push')
+        assert res.errors == 0
+        assert res.counts['MOVE FILE'] == 10
+        assert res.copied == 3
+        assert open_dirapi(remote_dir, test_key=remote_key).check_tree()
+        res = DirSync(logger, pull_dir, remote_dir, **options).sync('pull')
+        assert res.errors == 0 and res.copied == 3 and res.counts['MOVE FILE'] == 10
+        assert check_dirs(local_dir, pull_dir)
+        # The manifests are consistent with a sync without the catalog.
+        res = DirSync(logger, local_dir, remote_dir, test_key=remote_key).sync('push')
+        assert res.counts == {}
+        # The object index of a deduplicated directory is kept in the catalog.
+        data = randombytes(5000)
+        for name in ('s1', 's2'):
+            (local_dir / name).write_bytes(data)
+        os.link(local_dir / 's1', local_dir / 's3')
+        dedup_dir = tmp_dir / 'dedup_dir'
+        make_dtree(dedup_dir, {})
+        ds = DirSync(logger, local_dir, dedup_dir, **options)
+        ds.remote_api.dedup = True
+        res = ds.sync('push')
+        assert res.errors == 0 and res.counts['DEDUP FILE'] == 2
+        assert isinstance(ds.remote_api.object_index, CatalogObjects)
+        assert count_objects(dedup_dir) == res.counts['PUSH FILE']
+        shutil.rmtree(pull_dir)
+        make_dtree(pull_dir, {})
+        res = DirSync(logger, pull_dir, dedup_dir, **options).sync('pull')
+        assert res.errors == 0
+        assert check_dirs(local_dir, pull_dir)
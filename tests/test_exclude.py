@@ -0,0 +1,62 @@
+
+from dircifrar.exclude import Excluder
+from dircifrar.dirapi_plain import DirPlain
+from pathlib import Path
+import re, tempfile
+
+from hypothesis import given
+from hypothesis.strategies import lists, sampled_from, text
+
+name_patterns = ['\\.DS_Store', '.*~', '#.*#', 'build', '[0-9]+\\.log', 'a(b|c)*', '(x)\\1']
+names = text('abcx019.~#_DSStorelog', min_size=1, max_size=10)
+
+@given(
+    patterns=lists(sampled_from(name_patterns)),
+    names=lists(names),
+)
+def test_exclude_names(patterns, names):
+    excluder = Excluder(patterns)
+    regexes = [ re.compile(pat) for pat in patterns ]
+    for name in names + names:
+        expected = any(pat.fullmatch(name) for pat in regexes)
+        assert excluder.excludes(Path(name)) == expected
+        assert excluder.excludes(Path('some', 'dir', name)) == expected
+
+def test_exclude_uncombinable():
+    excluder = Excluder(['(?i).*\\.TMP', '(?P<x>a)b', '(?P<x>c)d', 'e+', '(?P<y>f)(?P=y)'])
+    assert excluder.excludes('x.tmp') and excluder.excludes('X.TMP')
+    assert excluder.excludes('ab') and excluder.excludes('cd') and excluder.excludes('eee')
+    assert excluder.excludes('ff') and not excluder.excludes('fg') and not excluder.excludes('E')
+
+def test_exclude_cache():
+    excluder = Excluder(['a.*'])
+    excluder.name_cache.size = 4
+    for i in range(10):
+        assert excluder.excludes(f'a{i}') and not excluder.excludes(f'b{i}')
+    assert len(excluder.name_cache.entries) == 4
+
+def test_exclude_globs():
+    excluder = Excluder(['glob:*.o', 'src/build/**', '/top', 'cache/', '**/tmp/*.txt', 'doc/[!a]?.md'])
+    assert excluder.excludes('x.o') and excluder.excludes('a/b/x.o')
+    assert excluder.excludes('src/build/x') and excluder.excludes('src/build/x/y')
+    assert not excluder.excludes('src/build', is_dir=True)
+    assert excluder.prunes('src/build')
+    assert not excluder.prunes('build') and not excluder.excludes('build/x')
+    assert not excluder.excludes('lib/src/build/x')
+    assert excluder.excludes('top') and not excluder.excludes('a/top')
+    assert excluder.excludes('cache', is_dir=True) and excluder.excludes('a/cache', is_dir=True)
+    assert not excluder.excludes('cache')
+    assert excluder.excludes('tmp/a.txt') and excluder.excludes('a/b/tmp/a.txt')
+    assert not excluder.excludes('a/tmp/b/a.txt')
+    assert excluder.excludes('doc/b1.md') and not excluder.excludes('doc/a1.md')
+
+def test_exclude_walk():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        for path in ['a/build/x', 'a/build/y/z', 'b/build/x', 'b/keep', 'c/d', 'e/skip.o']:
+            (root / path).parent.mkdir(parents=True, exist_ok=True)
+            (root / path).write_bytes(b'data')
+        api = DirPlain(root, '0.0.0', Excluder(['a/build/**', 'c', 'glob:*.o']), {})
+        api.collect_paths()
+        assert set(api.included) == { Path(p) for p in ['a', 'a/build', 'b', 'b/build', 'b/build/x', 'b/keep', 'e'] }
+        assert api.excluded == { Path('c'), Path('e/skip.o') }
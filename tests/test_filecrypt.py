@@ -2,17 +2,25 @@
 from dircifrar.filecrypt import (
     file_encrypt,
     file_decrypt,
+    file_reseal,
     path_encode,
     path_decode,
     path_hash,
+    pipeline_block_size,
+    FileChangedError,
+    content_digest,
+    sparse_extents,
 )
+from dircifrar.compression import available_algorithms
+from dircifrar.dirfds import DirFds
 from nacl.utils import random as randombytes
 from nacl.bindings import crypto_secretstream_xchacha20poly1305_KEYBYTES as KEYBYTES
 import tempfile
 from pathlib import Path
 
-from hypothesis import given, assume
-from hypothesis.strategies import integers, booleans, characters, text, lists
+from hypothesis import given, assume, settings
+from hypothesis.strategies import integers, booleans, characters, text, lists, sampled_from
+import os, pytest
 
 plain_name = 'plain'
 crypt_name = 'crypt'
@@ -34,8 +42,12 @@ odd_chunk_size_max =  50
     odd_chunk_size=integers(odd_chunk_size_min, odd_chunk_size_max),
     crypt_exists=booleans(),
     plain_1_exists=booleans(),
+    sealed=booleans(),
+    pipelined_encrypt=booleans(),
+    pipelined_decrypt=booleans(),
 )
-def test_file_crypt(metadata_size, num_chunks, odd_chunk_size, crypt_exists, plain_1_exists):
+def test_file_crypt(metadata_size, num_chunks, odd_chunk_size, crypt_exists, plain_1_exists, sealed,
+                    pipelined_encrypt, pipelined_decrypt):
     plain_size = chunk_size * num_chunks + odd_chunk_size
     assume(plain_size >= 0)
     with tempfile.TemporaryDirectory() as tmp_dir:
@@ -54,17 +66,212 @@ def test_file_crypt(metadata_size, num_chunks, odd_chunk_size, crypt_exists, pla
         if plain_1_exists:
             with open(plain_file_1, 'wb') as plain_1:
                 plain_1.write(some_data)
-        file_encrypt(key, plain_file_0, crypt_file, metadata, chunk_size)
+        file_encrypt(key, plain_file_0, crypt_file, metadata, chunk_size, sealed=sealed, pipelined=pipelined_encrypt)
         md = file_decrypt(key, crypt_file, plain_file_1, metadata_only=True)
         assert md == metadata
+        if sealed:
+            # Resealing into another file leaves the original as it was.
+            resealed_file = tmp_dir / (crypt_name + '_1')
+            file_reseal(key, crypt_file, some_data, resealed_file)
+            assert file_decrypt(key, crypt_file, plain_file_1, metadata_only=True) == metadata
+            os.replace(resealed_file, crypt_file)
+            md = file_decrypt(key, crypt_file, plain_file_1, metadata_only=True)
+            assert md == some_data
+            file_reseal(key, crypt_file, metadata)
+            assert file_decrypt(key, crypt_file, plain_file_1, metadata_only=True) == metadata
+            assert not any(name.startswith('.') for name in os.listdir(tmp_dir))
+            metadata = some_data
+            file_reseal(key, crypt_file, metadata)
         def md_test(md):
             return md == metadata
-        md = file_decrypt(key, crypt_file, plain_file_1, metadata_test=md_test)
+        md = file_decrypt(key, crypt_file, plain_file_1, metadata_test=md_test, pipelined=pipelined_decrypt)
         assert md == metadata
         with open(plain_file_1, 'rb') as plain_1:
             plain_data_1 = plain_1.read()
             assert plain_data_1 == plain_data
 
+@settings(
+    max_examples=10,
+    deadline=None,
+)
+@given(
+    extra_size=integers(0, 2 * chunk_size),
+    sealed=booleans(),
+    pipelined_encrypt=booleans(),
+    pipelined_decrypt=booleans(),
+)
+def test_file_crypt_pipelined(extra_size, sealed, pipelined_encrypt, pipelined_decrypt):
+    # The file spans several pipeline blocks.
+    plain_size = 3 * pipeline_block_size + extra_size
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        key = randombytes(KEYBYTES)
+        plain_data = randombytes(plain_size)
+        plain_file_0 = tmp_dir / (plain_name + '_0')
+        plain_file_1 = tmp_dir / (plain_name + '_1')
+        crypt_file = tmp_dir / crypt_name
+        with open(plain_file_0, 'wb') as plain_0:
+            plain_0.write(plain_data)
+        file_encrypt(key, plain_file_0, crypt_file, some_data, chunk_size, sealed=sealed, pipelined=pipelined_encrypt)
+        md = file_decrypt(key, crypt_file, plain_file_1, pipelined=pipelined_decrypt)
+        assert md == some_data
+        with open(plain_file_1, 'rb') as plain_1:
+            assert plain_1.read() == plain_data
+
+@pytest.mark.parametrize('sealed', [False, True])
+def test_file_crypt_fallback(monkeypatch, sealed):
+    import dircifrar.filecrypt
+    plain_data = randombytes(3 * chunk_size + 7)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        key = randombytes(KEYBYTES)
+        plain_file_0 = tmp_dir / (plain_name + '_0')
+        plain_file_1 = tmp_dir / (plain_name + '_1')
+        crypt_file = tmp_dir / crypt_name
+        with open(plain_file_0, 'wb') as plain_0:
+            plain_0.write(plain_data)
+        # Files encrypted without the private bindings of PyNaCl can be decrypted with them, and conversely.
+        for encrypt_zero_copy in [False, True]:
+            monkeypatch.setattr(dircifrar.filecrypt, 'zero_copy', encrypt_zero_copy)
+            file_encrypt(key, plain_file_0, crypt_file, some_data, chunk_size, sealed=sealed)
+            monkeypatch.setattr(dircifrar.filecrypt, 'zero_copy', not encrypt_zero_copy)
+            assert file_decrypt(key, crypt_file, plain_file_1) == some_data
+            with open(plain_file_1, 'rb') as plain_1:
+                assert plain_1.read() == plain_data
+
+@settings(
+    deadline=None,
+)
+@given(
+    algorithm=sampled_from(available_algorithms()),
+    num_lines=integers(0, 5000),
+    random_size=integers(0, 3 * chunk_size),
+    suffix=sampled_from(['.txt', '.jpg']),
+    pipelined=booleans(),
+)
+def test_file_crypt_compressed(algorithm, num_lines, random_size, suffix, pipelined):
+    text_data = b''.join(b'%d: ' % i + some_data + b'\n' for i in range(num_lines))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        key = randombytes(KEYBYTES)
+        for plain_data in [ text_data, randombytes(random_size) ]:
+            plain_file_0 = tmp_dir / (plain_name + '_0' + suffix)
+            plain_file_1 = tmp_dir / (plain_name + '_1')
+            crypt_file = tmp_dir / crypt_name
+            with open(plain_file_0, 'wb') as plain_0:
+                plain_0.write(plain_data)
+            file_encrypt(key, plain_file_0, crypt_file, some_data, chunk_size,
+                         sealed=True, pipelined=pipelined, compress=algorithm)
+            if plain_data is text_data and suffix == '.txt' and num_lines >= 100:
+                assert os.path.getsize(crypt_file) < len(plain_data) // 2
+            elif plain_data is not text_data or suffix == '.jpg':
+                # Incompressible files are stored uncompressed.
+                assert os.path.getsize(crypt_file) > len(plain_data)
+            md = file_decrypt(key, crypt_file, plain_file_1, pipelined=pipelined)
+            assert md == some_data
+            with open(plain_file_1, 'rb') as plain_1:
+                assert plain_1.read() == plain_data
+
+@settings(deadline=None, max_examples=20)
+@given(
+    size=sampled_from([ 3 * chunk_size + 5, pipeline_block_size + 5 ]),
+    sealed=booleans(),
+    pipelined=booleans(),
+    grow=booleans(),
+)
+def test_file_crypt_changed(size, sealed, pipelined, grow):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        key = randombytes(KEYBYTES)
+        plain_file = tmp_dir / plain_name
+        crypt_file = tmp_dir / crypt_name
+        plain_file.write_bytes(randombytes(size))
+        st = os.stat(plain_file)
+        file_encrypt(key, plain_file, crypt_file, some_data, chunk_size,
+                     sealed=sealed, pipelined=pipelined, plain_stat=st)
+        old_crypt = crypt_file.read_bytes()
+        # The file changes after it is stat-ed but before it is encrypted.
+        with open(plain_file, 'ab' if grow else 'r+b') as fp:
+            if grow:
+                fp.write(b'more')
+            else:
+                fp.truncate(size // 2)
+        with pytest.raises(FileChangedError):
+            file_encrypt(key, plain_file, crypt_file, some_data, chunk_size,
+                         sealed=sealed, pipelined=pipelined, plain_stat=st)
+        assert crypt_file.read_bytes() == old_crypt
+
+@settings(deadline=None, max_examples=20)
+@given(
+    extents=lists(integers(min_value=0, max_value=63), max_size=4, unique=True),
+    tail=booleans(),
+    compressed=booleans(),
+    pipelined=booleans(),
+)
+def test_file_crypt_sparse(extents, tail, compressed, pipelined):
+    block = 2 ** 16
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        key = randombytes(KEYBYTES)
+        plain_file_0 = tmp_dir / (plain_name + '_0')
+        plain_file_1 = tmp_dir / (plain_name + '_1')
+        crypt_file = tmp_dir / crypt_name
+        size = 64 * block + (5 if tail else 0)
+        with open(plain_file_0, 'wb') as plain_0:
+            plain_0.truncate(size)
+            for i in extents:
+                plain_0.seek(i * block)
+                plain_0.write(randombytes(block))
+        with open(plain_file_0, 'rb') as plain_0:
+            assume(sparse_extents(plain_0, size) is not None)
+        algorithm = available_algorithms()[0] if compressed else None
+        digest = file_encrypt(key, plain_file_0, crypt_file, lambda digest: digest, chunk_size,
+                              sealed=True, pipelined=pipelined, compress=algorithm)
+        # The digest covers the holes, and only the data is encrypted.
+        assert digest == content_digest(key, plain_file_0)
+        assert os.path.getsize(crypt_file) < (len(extents) + 1) * block
+        md = file_decrypt(key, crypt_file, plain_file_1, pipelined=pipelined)
+        assert md == digest
+        assert plain_file_1.read_bytes() == plain_file_0.read_bytes()
+        assert os.stat(plain_file_1).st_blocks * 512 <= (len(extents) + 1) * block
+
+@settings(deadline=None, max_examples=10)
+@given(
+    sealed=booleans(),
+    crypt_exists=booleans(),
+)
+def test_file_crypt_dir_fd(sealed, crypt_exists):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        key = randombytes(KEYBYTES)
+        plain_file = tmp_dir / plain_name
+        plain_data = randombytes(3 * chunk_size + 5)
+        plain_file.write_bytes(plain_data)
+        dir_fds = DirFds(tmp_dir / 'root', size=2)
+        crypt_path = Path('ab', 'cd', crypt_name)
+        if crypt_exists:
+            with dir_fds(crypt_path.parent) as dir_fd:
+                file_encrypt(key, None, crypt_name, b'old', chunk_size, dir_fd=dir_fd)
+        with dir_fds(crypt_path.parent) as dir_fd:
+            file_encrypt(key, plain_file, crypt_name, some_data, chunk_size, sealed=sealed, dir_fd=dir_fd)
+        # Only the encrypted file is left in its directory.
+        crypt_file = tmp_dir / 'root' / crypt_path
+        assert os.listdir(crypt_file.parent) == [crypt_name]
+        assert file_decrypt(key, crypt_file, tmp_dir / 'plain_1') == some_data
+        assert (tmp_dir / 'plain_1').read_bytes() == plain_data
+        # The least recently used fds are closed, but not while they are in use.
+        with dir_fds('x') as fd_x:
+            for name in ['y', 'z', 'w']:
+                with dir_fds(name):
+                    pass
+            assert list(dir_fds.entries) == ['x', 'w']
+            os.fstat(fd_x)
+        with dir_fds('v'):
+            pass
+        assert list(dir_fds.entries) == ['w', 'v']
+        dir_fds.close()
+        assert dir_fds.entries == {} and dir_fds.root_fd is None
+
 @given(
     names=lists(text(alphabet=characters(
         whitelist_categories=['L', 'N', 'Pd'],
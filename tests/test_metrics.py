@@ -0,0 +1,60 @@
+
+from dircifrar.metrics import SyncMetrics
+from dircifrar.dirsync import DirSyncRes
+from pathlib import Path
+import os, stat, logging, tempfile, time, urllib.request, pytest
+
+def test_metrics_http():
+    metrics = SyncMetrics({'command': 'watch-push', 'local_dir': '/tmp/a "b"'})
+    port = metrics.serve(0)
+    try:
+        res = DirSyncRes(logging.getLogger('test_metrics'))
+        res.log('PUSH FILE', Path('x'))
+        res.log('PUSH FILE', Path('y'))
+        res.log('REMOVE FILE', Path('z'))
+        res.log('MOVE FILE', 'u -> v')
+        res.log('DEDUP FILE', Path('w'))
+        res.nbytes = 5000
+        metrics.inc('dircifrar_watch_events_total', 3)
+        metrics.observe('dircifrar_watch_settle_seconds', 0.3)
+        metrics.record_sync(time.time(), res)
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as resp:
+            assert resp.status == 200
+            text = resp.read().decode('utf-8')
+    finally:
+        metrics.shutdown()
+    labels = 'command="watch-push",local_dir="/tmp/a \\"b\\""'
+    assert '# TYPE dircifrar_watch_events_total counter' in text
+    assert f'dircifrar_watch_events_total{{{labels}}} 3' in text
+    assert f'dircifrar_synced_files_total{{{labels}}} 2' in text
+    assert f'dircifrar_synced_bytes_total{{{labels}}} 5000' in text
+    assert f'dircifrar_watch_settle_seconds_bucket{{{labels},le="0.25"}} 0' in text
+    assert f'dircifrar_watch_settle_seconds_bucket{{{labels},le="0.5"}} 1' in text
+    assert f'dircifrar_watch_settle_seconds_count{{{labels}}} 1' in text
+    assert f'dircifrar_sync_errors_total{{{labels}}} 0' in text
+    assert f'dircifrar_operations_total{{{labels},op="copy_file"}} 2' in text
+    assert f'dircifrar_operations_total{{{labels},op="move_file"}} 1' in text
+    assert f'dircifrar_operations_total{{{labels},op="dedup_file"}} 1' in text
+    assert f'dircifrar_operations_total{{{labels},op="remove_file"}} 1' in text
+    assert f'dircifrar_operations_total{{{labels},op="other"}} 0' in text
+
+def test_metrics_textfile(monkeypatch):
+    metrics = SyncMetrics()
+    metrics.record_sync(time.time(), error=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prom_file = Path(tmp_dir) / 'dircifrar.prom'
+        metrics.write_textfile(prom_file)
+        text = prom_file.read_text()
+        assert 'dircifrar_sync_errors_total 1' in text
+        assert 'dircifrar_sync_duration_seconds_count 1' in text
+        assert stat.S_IMODE(os.stat(prom_file).st_mode) == 0o644
+        # A failed rewrite leaves neither a temporary file nor a changed file behind.
+        metrics.record_sync(time.time(), error=True)
+        def failing_replace(src, dst):
+            raise OSError('replace failed')
+        with monkeypatch.context() as m:
+            m.setattr(os, 'replace', failing_replace)
+            with pytest.raises(OSError):
+                metrics.write_textfile(prom_file)
+        assert os.listdir(tmp_dir) == ['dircifrar.prom']
+        assert 'dircifrar_sync_errors_total 1' in prom_file.read_text()
@@ -0,0 +1,17 @@
+from dircifrar.throttle import TokenBucket
+import threading, time
+
+def test_token_bucket_set_rate():
+    bucket = TokenBucket(1000)
+    bucket.consume(1000)
+    start = time.monotonic()
+    bucket.consume(100)
+    assert time.monotonic() - start >= 0.09
+    # A consumer waiting for tokens at the old rate stops waiting when the rate is changed.
+    timer = threading.Timer(0.1, bucket.set_rate, args=(None,))
+    timer.start()
+    start = time.monotonic()
+    bucket.consume(10000)
+    assert time.monotonic() - start < 5
+    timer.join()
+    bucket.consume(10 ** 9)
@@ -0,0 +1,62 @@
+
+from dircifrar.dirsync import DirSync
+from dircifrar.dirconfig import open_dirapi
+from dircifrar.verify import DirVerify
+from dircifrar.filecrypt import path_hash
+from nacl.utils import random as randombytes
+from nacl.bindings import crypto_secretstream_xchacha20poly1305_KEYBYTES as KEYBYTES
+from pathlib import Path
+import os, tempfile, time, logging, sys
+
+def make_logger():
+    logger = logging.getLogger('test_verify')
+    logger.setLevel(logging.ERROR)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        logger.addHandler(handler)
+    return logger
+
+def test_verify():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = make_logger()
+        tmp_dir = Path(tmp_dir)
+        local_dir = tmp_dir / 'local_dir'
+        remote_dir = tmp_dir / 'remote_dir'
+        state_file = tmp_dir / 'state.json'
+        local_dir.mkdir()
+        remote_dir.mkdir()
+        (local_dir / 'd').mkdir()
+        for i in range(6):
+            (local_dir / 'd' / f'f{i}').write_bytes(randombytes(10000))
+        (local_dir / 'small').write_bytes(b'small')
+        remote_key = randombytes(KEYBYTES)
+        ds = DirSync(logger, local_dir, remote_dir, test_key=remote_key)
+        ds.remote_api.pack_threshold = 100
+        ds.sync('push')
+        api = open_dirapi(remote_dir, test_key=remote_key)
+        def verify(rate=None):
+            verifier = DirVerify(logger, api, jobs=3, rate=rate, max_age=1, state_file=state_file)
+            return verifier.run()
+        # 1 directory, 6 files and 1 pack file
+        assert verify() == {'OK': 8}
+        assert verify() == {'SKIPPED': 8}
+        def crypt_file(name):
+            return api.crypt_dir / path_hash(remote_key, Path('d', name))
+        with open(crypt_file('f0'), 'r+b') as fp:
+            fp.seek(5000)
+            byte = fp.read(1)
+            fp.seek(5000)
+            fp.write(bytes([byte[0] ^ 1]))
+        with open(crypt_file('f1'), 'r+b') as fp:
+            fp.truncate(6000)
+        os.replace(crypt_file('f2'), crypt_file('f3'))
+        os.remove(api.crypt_meta / path_hash(remote_key, Path('d', 'f4')))
+        # Only the modified files are verified again.
+        assert verify() == {'SKIPPED': 4, 'CORRUPT': 1, 'TRUNCATED': 1, 'MISLOCATED': 1}
+        os.remove(state_file)
+        start = time.time()
+        counts = verify(rate=20000)
+        assert counts == {'OK': 3, 'CORRUPT': 1, 'TRUNCATED': 1, 'MISLOCATED': 1, 'META MISMATCH': 1}
+        # At least 30000 bytes are decrypted, of which the 10000 beyond the initial burst
+        # of 20000 take at least 0.5 sec at this rate.
+        assert time.time() - start >= 0.4
@@ -0,0 +1,75 @@
+
+from dircifrar.watchsync import Target
+import logging, threading
+
+class FakeSyncer(object):
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.commands = []
+
+    def sync(self, command):
+        self.commands.append(command)
+        self.started.set()
+        self.release.wait(5)
+        return None
+
+class FakeResult(object):
+    def __init__(self, errors):
+        self.errors = errors
+
+class FakePuller(object):
+    def __init__(self, errors):
+        self.errors = errors
+        self.pulled = []
+
+    def pull_changes(self, changes):
+        self.pulled.append(set(changes))
+        return FakeResult(self.errors.pop(0))
+
+    def sync(self, command):
+        return FakeResult(0)
+
+class FakeClient(object):
+    def __init__(self, names):
+        self.names = names
+
+    def getSubscription(self, name):
+        return [{'files': self.names}]
+
+def test_target_schedule():
+    syncer = FakeSyncer()
+    target = Target(syncer, 'push', logging.getLogger('test_watchsync'))
+    assert target.wait_time(0.2, 1.0) is None
+    target.consumeEvents(FakeClient(['a']))
+    assert 0.1 < target.wait_time(0.2, 1.0) <= 0.2
+    # Under a continuous stream of events, the sync is due max_delay after the first one.
+    target.first_event -= 0.95
+    target.consumeEvents(FakeClient(['b']))
+    assert target.wait_time(0.2, 1.0) <= 0.05
+    assert target.wait_time(0.2) > 0.1
+    # Events that arrive while a sync is running are left for the next sync.
+    thread = threading.Thread(target=target.execute)
+    thread.start()
+    assert syncer.started.wait(5)
+    assert target.wait_time(0.2, 1.0) is None
+    target.consumeEvents(FakeClient(['c', 'd']))
+    syncer.release.set()
+    thread.join()
+    assert target.backlog == 2
+    assert target.wait_time(0.2, 1.0) is not None
+    target.execute()
+    assert syncer.commands == ['push', 'push']
+    assert target.wait_time(0.2, 1.0) is None
+
+def test_target_retry():
+    syncer = FakePuller([1, 0])
+    target = Target(syncer, 'pull', logging.getLogger('test_watchsync'), subdir='meta')
+    target.full_sync = False
+    target.consumeEvents(FakeClient(['a', 'b']))
+    target.execute()
+    # The changes of a pull with errors are pulled again with the next ones.
+    target.consumeEvents(FakeClient(['c']))
+    target.execute()
+    assert syncer.pulled == [{'a', 'b'}, {'a', 'b', 'c'}]
+    assert target.changes == set()